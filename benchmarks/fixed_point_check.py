@@ -0,0 +1,137 @@
+# Validates the fixed point mode against the float pipeline over a large synthetic history (see
+# benchmarks.synthetic_data), and times both.
+#  * same inputs: the statement is read once, as floats, and matched and taxed by both paths. Gains must agree to
+#    within --tolerance AUD per match until the float path's remainders drift far enough to pair lots differently, and
+#    the fixed point path must not leave any dust matches.
+#  * fixed reader: the statement is also read in fixed point mode, whose micro-rounded prices move gains slightly;
+#    only the totals are reported.
+# Run from the repository root: python -m benchmarks.fixed_point_check --trades 1000000 [--json results.json]
+# Exits with status 1 if the same-input comparison fails.
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple, Union
+
+from benchmarks.synthetic_data import RATE_START, rate_end_date, write_rba_rates, write_statement
+from capital_gains_tax import CapitalGainsTax, CapitalGainsTaxAggregator, CapitalGainsTaxMethod, \
+    DiscountCapitalGainsTaxMethod, FixedPointDiscountCapitalGainsTaxMethod
+from foreign_asset_translator import ForeignAssetTranslator, required_rate_codes
+from inventory_accounting import FirstInFirstOutInventory, FixedPointFirstInFirstOutInventory, InventoryState, \
+    QueuedFirstInFirstOutInventory
+from model import TranslatedTrade
+from proceeds_calculator import ForeignCurrencyProceedsCalculator
+from read_writer import InteractiveBrokersReadWriter
+
+Result = Dict[str, Union[float, int]]
+# Statement quantities are whole contracts or at least 1e-4 of a currency, so a smaller match is a drift remainder.
+_DUST = 1e-5
+
+
+def _run_path(trades: List[TranslatedTrade],
+              engine: FirstInFirstOutInventory[TranslatedTrade],
+              capital_gains_tax_method: CapitalGainsTaxMethod) -> Tuple[List[CapitalGainsTax], int, float, float]:
+    state = InventoryState[TranslatedTrade]()
+    start = time.perf_counter()
+    _, matches = ForeignCurrencyProceedsCalculator(engine, engine).calculate_proceeds_and_matches(trades, state)
+    match_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    gains = CapitalGainsTaxAggregator(capital_gains_tax_method).calculate(0, matches)
+    tax_seconds = time.perf_counter() - start
+    return gains, sum(len(lots) for lots in state.open_lots.values()), match_seconds, tax_seconds
+
+
+def _read(statement_path: str, rates_path: str, fixed_point: bool) -> List[TranslatedTrade]:
+    reader = InteractiveBrokersReadWriter(fixed_point)
+    trades = list(reader.iter_trades(statement_path))
+    rates = reader.read_rba_rates(rates_path, required_rate_codes(trades))
+    return ForeignAssetTranslator(rates).convert_trades(trades)
+
+
+def run(number_of_trades: int, rate_days: int, seed: int) -> Result:
+    with tempfile.TemporaryDirectory() as directory, open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        statement_path = os.path.join(directory, 'trades.csv')
+        rates_path = os.path.join(directory, 'f11.1-data.csv')
+        with open(rates_path, 'w', newline='') as file:
+            write_rba_rates(file, rate_days, seed)
+        with open(statement_path, 'w', newline='') as file:
+            write_statement(file, number_of_trades, RATE_START, rate_end_date(rate_days), seed)
+        float_trades = _read(statement_path, rates_path, False)
+        fixed_trades = _read(statement_path, rates_path, True)
+
+        float_gains, float_open_lots, float_match_seconds, float_tax_seconds = _run_path(
+            float_trades, QueuedFirstInFirstOutInventory[TranslatedTrade](), DiscountCapitalGainsTaxMethod())
+        fixed_gains, fixed_open_lots, fixed_match_seconds, fixed_tax_seconds = _run_path(
+            float_trades, FixedPointFirstInFirstOutInventory[TranslatedTrade](),
+            FixedPointDiscountCapitalGainsTaxMethod())
+        reader_gains, _, _, _ = _run_path(fixed_trades, FixedPointFirstInFirstOutInventory[TranslatedTrade](),
+                                          FixedPointDiscountCapitalGainsTaxMethod())
+
+    # Matches are compared by value, since proxy trades are rebuilt by each path. The float path can pair lots
+    # differently once a remainder has drifted past the matching tolerance, so rows are compared up to the first
+    # difference in pairing, and the float path's dust matches (drift remainders closed as matches) are counted.
+    first_divergence = None
+    differences: List[Tuple[float, float, float]] = []
+    for i, (float_gain, fixed_gain) in enumerate(zip(float_gains, fixed_gains)):
+        if _pairing(float_gain) != _pairing(fixed_gain):
+            first_divergence = i
+            break
+        differences.append((abs(float_gain.matched_inventory.quantity - fixed_gain.matched_inventory.quantity),
+                            abs(float_gain.taxable_gain - fixed_gain.taxable_gain),
+                            abs(float_gain.carried_capital_losses - fixed_gain.carried_capital_losses)))
+    if first_divergence is None and len(float_gains) != len(fixed_gains):
+        first_divergence = min(len(float_gains), len(fixed_gains))
+    return {'float_matches': len(float_gains),
+            'fixed_matches': len(fixed_gains),
+            'first_divergence': first_divergence if first_divergence is not None else -1,
+            'max_quantity_difference': max((d[0] for d in differences), default=0),
+            'max_taxable_gain_difference': max((d[1] for d in differences), default=0),
+            'max_carried_losses_difference': max((d[2] for d in differences), default=0),
+            'float_dust_matches': sum(gain.matched_inventory.quantity < _DUST for gain in float_gains),
+            'fixed_dust_matches': sum(gain.matched_inventory.quantity < _DUST for gain in fixed_gains),
+            'float_open_lots': float_open_lots,
+            'fixed_open_lots': fixed_open_lots,
+            'float_taxable_gains': sum(gain.taxable_gain for gain in float_gains),
+            'fixed_taxable_gains': sum(gain.taxable_gain for gain in fixed_gains),
+            'fixed_reader_taxable_gains': sum(gain.taxable_gain for gain in reader_gains),
+            'float_match_seconds': float_match_seconds,
+            'fixed_match_seconds': fixed_match_seconds,
+            'float_tax_seconds': float_tax_seconds,
+            'fixed_tax_seconds': fixed_tax_seconds}
+
+
+def _pairing(gain: CapitalGainsTax) -> Tuple[object, ...]:
+    buy_trade = gain.matched_inventory.buy_trade
+    sell_trade = gain.matched_inventory.sell_trade
+    return (buy_trade.asset_code, buy_trade.date, buy_trade.quantity, buy_trade.source,
+            sell_trade.date, sell_trade.quantity, sell_trade.source)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Fixed point against float pipeline on a synthetic history.')
+    parser.add_argument('--trades', type=int, default=100000)
+    parser.add_argument('--rate-days', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tolerance', type=float, default=1e-3,
+                        help='Largest difference in taxable gain or carried losses per match before the paths pair '
+                             'lots differently, in AUD.')
+    parser.add_argument('--json', help='Also write the results to this file.')
+    arguments = parser.parse_args()
+    results = run(arguments.trades, arguments.rate_days, arguments.seed)
+    for name, value in results.items():
+        print('{:<30} {}'.format(name, value))
+    if arguments.json is not None:
+        with open(arguments.json, 'w') as file:
+            json.dump(results, file, indent=2)
+    if results['max_taxable_gain_difference'] > arguments.tolerance \
+            or results['max_carried_losses_difference'] > arguments.tolerance or results['fixed_dust_matches'] > 0:
+        print('Fixed point results differ from the float pipeline.', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# Measures memory held per trade for the different trade representations:
+#  * dict: the previous dict-backed Trade/TranslatedTrade/Amount classes (reproduced below for comparison).
+#  * slots: the current __slots__ classes in model.py.
+#  * table: TradeTable columns.
+# Run from the repository root: python -m benchmarks.memory_benchmark --trades 100000 [--json results.json]
+import argparse
+import json
+import tracemalloc
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Final
+
+from model import Amount, Trade, TranslatedTrade
+from trade_table import TradeTable
+
+
+class _DictAmount:
+    def __init__(self, value: float, currency: str):
+        self.value: Final = value
+        self.currency: Final = currency
+
+
+class _DictTrade:
+    def __init__(self, asset_code: str, asset_category: str, date: datetime, price: float, currency: str,
+                 quantity: float, commission: _DictAmount, source: str):
+        self.asset_code: Final = asset_code
+        self.asset_category: Final = asset_category
+        self.price: Final = price
+        self.date: Final = date
+        self.quantity: Final = quantity
+        self.commission: Final = commission
+        self.currency: Final = currency
+        self.source: Final = source
+
+
+class _DictTranslatedTrade(_DictTrade):
+    def __init__(self, trade: _DictTrade, translated_price: float, exchange_rate: float,
+                 translated_commission: float, translated_currency: str):
+        super().__init__(trade.asset_code, trade.asset_category, trade.date, trade.price, trade.currency,
+                         trade.quantity, trade.commission, trade.source)
+        self.translated_price: Final = translated_price
+        self.translated_commission: Final = translated_commission
+        self.exchange_rate: Final = exchange_rate
+        self.translated_currency: Final = translated_currency
+
+
+# Strings are rebuilt per row, as they are when parsed out of a statement, rather than shared literals.
+def _text(value: str) -> str:
+    return ''.join(list(value))
+
+
+def _dict_trades(number_of_trades: int) -> List[_DictTranslatedTrade]:
+    start = datetime(2015, 1, 1)
+    return [_DictTranslatedTrade(_DictTrade(_text('ES'), _text('FUTURES'), start + timedelta(seconds=i), 3000.0 + i,
+                                            _text('USD'), float(i % 7 - 3), _DictAmount(-2.5 - i % 3, _text('USD')),
+                                            _text('BROKER_REPORT')),
+                                 (3000.0 + i) * 1.4, 1.4, (-2.5 - i % 3) * 1.4, _text('AUD'))
+            for i in range(number_of_trades)]
+
+
+def _slots_trades(number_of_trades: int) -> List[TranslatedTrade]:
+    start = datetime(2015, 1, 1)
+    return [TranslatedTrade(Trade(_text('ES'), _text('FUTURES'), start + timedelta(seconds=i), 3000.0 + i,
+                                  _text('USD'), float(i % 7 - 3), Amount(-2.5 - i % 3, _text('USD')),
+                                  _text('BROKER_REPORT')),
+                            (3000.0 + i) * 1.4, 1.4, (-2.5 - i % 3) * 1.4, _text('AUD'))
+            for i in range(number_of_trades)]
+
+
+def _measure(build: Callable[[], object], number_of_trades: int) -> float:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    held = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del held
+    return (after - before) / number_of_trades
+
+
+def run(number_of_trades: int) -> Dict[str, float]:
+    slots_trades = _slots_trades(number_of_trades)
+    results: Dict[str, float] = {
+        'dict': _measure(lambda: _dict_trades(number_of_trades), number_of_trades),
+        'slots': _measure(lambda: _slots_trades(number_of_trades), number_of_trades),
+        'table': _measure(lambda: TradeTable.from_trades(slots_trades), number_of_trades),
+    }
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Bytes held per trade for each trade representation.')
+    parser.add_argument('--trades', type=int, default=100000)
+    parser.add_argument('--json', help='Also write the results to this file.')
+    arguments = parser.parse_args()
+    results = run(arguments.trades)
+    for name, bytes_per_trade in results.items():
+        print('{:<6} {:>8.1f} bytes/trade'.format(name, bytes_per_trade))
+    if arguments.json is not None:
+        with open(arguments.json, 'w') as file:
+            json.dump({'trades': arguments.trades, 'bytes_per_trade': results}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+# Times each stage of the pipeline separately over synthetic inputs (see benchmarks.synthetic_data), so a regression
+# can be traced to the stage that caused it. Results can be written as JSON, tagged with the current commit, and
+# compared against an earlier results file.
+# Run from the repository root:
+#   python -m benchmarks.pipeline_benchmark --trades 1000000 [--json results.json] [--baseline previous.json]
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar
+
+from benchmarks.synthetic_data import RATE_START, rate_end_date, write_rba_rates, write_statement
+from capital_gains_tax import CapitalGainsTaxAggregator, DiscountCapitalGainsTaxMethod
+from foreign_asset_translator import ForeignAssetTranslator, required_rate_codes
+from inventory_accounting import QueuedFirstInFirstOutInventory
+from model import TranslatedTrade
+from proceeds_calculator import ForeignCurrencyProceedsCalculator
+from read_writer import InteractiveBrokersReadWriter
+
+R = TypeVar('R')
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class _Stages:
+    def __init__(self) -> None:
+        self.seconds: Dict[str, float] = dict()
+        self.rows: Dict[str, int] = dict()
+
+    def time(self, name: str, stage: Callable[[], R], rows: Callable[[R], int]) -> R:
+        start = time.perf_counter()
+        result = stage()
+        self.seconds[name] = time.perf_counter() - start
+        self.rows[name] = rows(result)
+        return result
+
+
+# Stages run in pipeline order, each on the previous stage's output. calculate_proceeds and match_trades are the two
+# pass pipeline (proxy trades, then a full re-match), as in ForeignCurrencyProceedsCalculator.calculate_proceeds.
+def run(number_of_trades: int, rate_days: int, seed: int) -> Tuple[Dict[str, float], Dict[str, int], float]:
+    reader = InteractiveBrokersReadWriter()
+    stages = _Stages()
+    with tempfile.TemporaryDirectory() as directory:
+        statement_path = os.path.join(directory, 'trades.csv')
+        rates_path = os.path.join(directory, 'f11.1-data.csv')
+        start = time.perf_counter()
+        with open(rates_path, 'w', newline='') as file:
+            write_rba_rates(file, rate_days, seed)
+        with open(statement_path, 'w', newline='') as file:
+            write_statement(file, number_of_trades, RATE_START, rate_end_date(rate_days), seed)
+        generation_seconds = time.perf_counter() - start
+
+        trades = stages.time('read_trades', lambda: list(reader.iter_trades(statement_path)), len)
+        rates = stages.time('read_rba_rates',
+                            lambda: reader.read_rba_rates(rates_path, required_rate_codes(trades)),
+                            lambda result: sum(len(values) for values in result.values()))
+        translated: List[TranslatedTrade] = stages.time(
+            'convert_trades', lambda: ForeignAssetTranslator(rates).convert_trades(trades), len)
+        proceeds = stages.time(
+            'calculate_proceeds',
+            lambda: ForeignCurrencyProceedsCalculator(QueuedFirstInFirstOutInventory[TranslatedTrade]())
+            .calculate_proceeds(translated),
+            len)
+        matches = stages.time('match_trades',
+                              lambda: QueuedFirstInFirstOutInventory[TranslatedTrade]().match_trades(proceeds), len)
+        gains = stages.time('aggregate',
+                            lambda: CapitalGainsTaxAggregator(DiscountCapitalGainsTaxMethod()).calculate(0, matches),
+                            len)
+        stages.time('write_capital_gains',
+                    lambda: reader.write_capital_gains(os.path.join(directory, 'gains.csv'), gains),
+                    lambda _: len(gains))
+        stages.time('write_trades',
+                    lambda: reader.write_trades(os.path.join(directory, 'processed_trades.csv'), proceeds),
+                    lambda _: len(proceeds))
+    return stages.seconds, stages.rows, generation_seconds
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Per-stage pipeline timings over synthetic statements.')
+    parser.add_argument('--trades', type=int, default=100000, help='Orders in the synthetic statement (1e3 to 1e7).')
+    parser.add_argument('--rate-days', type=int, default=2000, help='Business days of synthetic RBA rates.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='Also write the results to this file.')
+    parser.add_argument('--baseline', help='Results file from an earlier run to compare against.')
+    arguments = parser.parse_args()
+
+    seconds, rows, generation_seconds = run(arguments.trades, arguments.rate_days, arguments.seed)
+    baseline: Dict[str, float] = dict()
+    if arguments.baseline is not None:
+        with open(arguments.baseline) as file:
+            baseline = json.load(file)['seconds']
+    print('generated inputs in {:.2f}s'.format(generation_seconds))
+    for name, elapsed in seconds.items():
+        line = '{:<20} {:>10,} rows {:>9.3f}s'.format(name, rows[name], elapsed)
+        if name in baseline and baseline[name] > 0:
+            line += ' {:>7.2f}x baseline'.format(elapsed / baseline[name])
+        print(line)
+    if arguments.json is not None:
+        results: Dict[str, object] = {'commit': _commit(),
+                                      'python': platform.python_version(),
+                                      'trades': arguments.trades,
+                                      'rate_days': arguments.rate_days,
+                                      'seed': arguments.seed,
+                                      'seconds': seconds,
+                                      'rows': rows}
+        with open(arguments.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+# Generates synthetic inputs in the formats the readers expect, at any size:
+#  * IB activity statements with a Futures and a Forex 'Trades' table. Orders are split over one or more fills (only
+#    the Order rows are read as trades), some orders share a timestamp to the second, and positions are opened short
+#    as well as long.
+#  * RBA F11.1 exchange rate files with one row per business day and the occasional missing rate.
+# Output is deterministic for a given seed.
+# Run from the repository root:
+#   python -m benchmarks.synthetic_data --trades 1000000 --rate-days 2000 --statement trades.csv --rates f11.1.csv
+import argparse
+import csv
+import random
+from datetime import datetime, timedelta
+from typing import Dict, Final, List, TextIO, Tuple
+
+RATE_START: Final = datetime(2000, 1, 3)
+
+_FUTURES_HEADER: Final = ['Trades', 'Header', 'DataDiscriminator', 'Asset Category', 'Currency', 'Account', 'Symbol',
+                          'Date/Time', 'Exchange', 'Quantity', 'T. Price', 'Notional Value', 'Comm/Fee', 'Code']
+_FOREX_HEADER: Final = ['Trades', 'Header', 'DataDiscriminator', 'Asset Category', 'Currency', 'Account', 'Symbol',
+                        'Date/Time', 'Exchange', 'Quantity', 'T. Price', 'Proceeds', 'Comm in AUD', 'Code']
+
+# Symbol: (currency, contract multiplier, starting price, commission per contract).
+_FUTURES: Final[Dict[str, Tuple[str, float, float, float]]] = {
+    'ES': ('USD', 50, 2700.0, -2.05),
+    'NQ': ('USD', 20, 6500.0, -2.05),
+    'FESX': ('EUR', 10, 3400.0, -1.5),
+    'AP': ('AUD', 25, 6000.0, -3.6)}
+
+# RBA column (units): starting AUD rate. 'Index' is the trade-weighted index column, which the reader skips.
+_RATES: Final[Dict[str, float]] = {'USD': 0.78, 'Index': 65.0, 'EUR': 0.65, 'JPY': 88.0, 'GBP': 0.58}
+
+# Share of orders that are AUD.USD conversions rather than futures.
+_FOREX_SHARE: Final = 0.1
+
+
+def _business_days(start: datetime, number_of_days: int) -> List[datetime]:
+    days: List[datetime] = []
+    day = start
+    while len(days) < number_of_days:
+        if day.weekday() < 5:
+            days.append(day)
+        day += timedelta(days=1)
+    return days
+
+
+def rate_end_date(number_of_days: int) -> datetime:
+    return _business_days(RATE_START, number_of_days)[-1]
+
+
+# Dates must fit in the reader's four-digit '%d-%b-%Y' format, which allows about 2 million business days.
+def write_rba_rates(file: TextIO, number_of_days: int, seed: int = 0) -> None:
+    rng = random.Random(seed)
+    writer = csv.writer(file, lineterminator='\n')
+    units = list(_RATES)
+    writer.writerow(['F11.1  EXCHANGE RATES'])
+    writer.writerow(['Title'] + ['A$1=' + unit for unit in units])
+    writer.writerow(['Description'] + ['AUD/' + unit + ' Exchange Rate' for unit in units])
+    writer.writerow(['Frequency'] + ['Daily'] * len(units))
+    writer.writerow(['Type'] + ['Indicative'] * len(units))
+    writer.writerow(['Units'] + units)
+    writer.writerow([])
+    writer.writerow(['Source'] + ['RBA'] * len(units))
+    writer.writerow(['Series ID'] + ['FXR' + unit for unit in units])
+    rates = dict(_RATES)
+    for day in _business_days(RATE_START, number_of_days):
+        row: List[str] = [day.strftime('%d-%b-%Y')]
+        for unit in units:
+            rates[unit] *= 1 + rng.gauss(0, 0.005)
+            # Holidays in a single market leave a gap for that currency only.
+            row.append('' if rng.random() < 0.01 and unit != 'USD' else '{:.4f}'.format(rates[unit]))
+        writer.writerow(row)
+
+
+def _quantity_text(quantity: float) -> str:
+    return '{:,}'.format(quantity)
+
+
+# Trades are spread evenly, on average, from the day after start up to end. Some orders share a timestamp with the
+# previous one. The statement is written in timestamp order within each table.
+def write_statement(file: TextIO, number_of_trades: int, start: datetime, end: datetime, seed: int = 0) -> None:
+    rng = random.Random(seed)
+    first = start + timedelta(days=1, hours=9)
+    mean_step = max((end - first).total_seconds() / max(number_of_trades, 1), 1.0)
+    forex_rows: List[List[str]] = []
+    prices: Dict[str, float] = {symbol: price for symbol, (_, _, price, _) in _FUTURES.items()}
+    fx_price = 0.75
+    date = first
+    writer = csv.writer(file, lineterminator='\n')
+    writer.writerow(_FUTURES_HEADER)
+    for i in range(number_of_trades):
+        if i > 0 and rng.random() >= 0.05:
+            date += timedelta(seconds=max(1, int(rng.expovariate(1 / mean_step))))
+        date_text = date.strftime('%Y-%m-%d, %H:%M:%S')
+        if rng.random() < _FOREX_SHARE:
+            fx_price *= 1 + rng.gauss(0, 0.002)
+            quantity = rng.choice([-1, 1]) * rng.randint(1, 50000)
+            commission = -2.0 if rng.random() < 0.8 else 0
+            forex_rows.append(['Trades', 'Data', 'Order', 'Forex', 'USD', 'U111111', 'AUD.USD', date_text, '-',
+                               _quantity_text(quantity), '{:.5f}'.format(fx_price),
+                               repr(-quantity * round(fx_price, 5)), repr(commission), ''])
+            continue
+        symbol = rng.choice(list(_FUTURES))
+        currency, multiplier, _, commission_per_contract = _FUTURES[symbol]
+        prices[symbol] *= 1 + rng.gauss(0, 0.001)
+        price = round(prices[symbol] * 4) / 4
+        quantity = rng.choice([-1, 1]) * rng.randint(1, 10)
+        writer.writerow(['Trades', 'Data', 'Order', 'Futures', currency, 'U111111', symbol, date_text, '-',
+                         _quantity_text(quantity), repr(price), repr(-quantity * price * multiplier),
+                         repr(round(abs(quantity) * commission_per_contract, 2)), 'O'])
+        # Partial fills of the order, which the reader skips in favour of the Order row.
+        remaining = quantity
+        while remaining != 0:
+            fill = remaining if abs(remaining) == 1 or rng.random() < 0.6 else remaining // 2 or remaining
+            writer.writerow(['Trades', 'Data', 'Trade', 'Futures', currency, 'U111111', symbol, date_text, 'GLOBEX',
+                             _quantity_text(fill), repr(price), repr(-fill * price * multiplier),
+                             repr(round(abs(fill) * commission_per_contract, 2)), 'P'])
+            remaining -= fill
+    writer.writerow(_FOREX_HEADER)
+    writer.writerows(forex_rows)
+
+
+# Parsed command line, with the options declared so that they are typed where they are read.
+class _Arguments(argparse.Namespace):
+    trades: int
+    rate_days: int
+    seed: int
+    statement: str
+    rates: str
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Writes a synthetic IB statement and RBA rate file.')
+    parser.add_argument('--trades', type=int, default=100000, help='Number of orders in the statement.')
+    parser.add_argument('--rate-days', type=int, default=2000, help='Number of business days of rates.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--statement', required=True)
+    parser.add_argument('--rates', required=True)
+    arguments = parser.parse_args(namespace=_Arguments())
+    with open(arguments.rates, 'w', newline='') as file:
+        write_rba_rates(file, arguments.rate_days, arguments.seed)
+    with open(arguments.statement, 'w', newline='') as file:
+        write_statement(file, arguments.trades, RATE_START, rate_end_date(arguments.rate_days), arguments.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+# Measures how fast capital gains rows are written to csv, for the current writer and for the previous row-at-a-time
+# writer (reproduced below for comparison). A pool of distinct gains is built up front and streamed to the writer
+# repeatedly, so the timing is of the writer rather than of building gain objects.
+# Run from the repository root: python -m benchmarks.write_benchmark --rows 1000000 [--json results.json]
+# Exits with status 1 if the current writer is below --target rows per second.
+import argparse
+import csv
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from itertools import cycle, islice
+from typing import Callable, Dict, Iterable, Iterator, List
+
+from capital_gains_tax import CapitalGainsTax
+from inventory_accounting import MatchedInventory
+from model import Amount, Trade, TranslatedTrade
+from read_writer import InteractiveBrokersReadWriter
+
+# Rows per second the current writer is expected to sustain. The previous writer managed about 125k on the machine
+# this was set on, the current one about 240k.
+TARGET_ROWS_PER_SECOND = 200000
+_POOL_SIZE = 20000
+
+
+def _legacy_write_capital_gains(file_path: str, gains: Iterable[CapitalGainsTax]) -> None:
+    with open(file_path, mode='w') as file:
+        writer = csv.writer(file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        header: List[str] = ['asset_code', 'buy_price', 'translated_buy_price', 'buy_date', 'sell_price',
+                             'translated_sell_price','sell_date', 'quantity', 'taxable_gain',
+                             'carried_capital_losses', 'buy_commission', 'sell_commission']
+        writer.writerow(header)
+        for gain in gains:
+            row: List[str] = [gain.matched_inventory.buy_trade.asset_code,
+                              str(gain.matched_inventory.buy_trade.price),
+                              str(gain.matched_inventory.buy_trade.translated_price),
+                              str(gain.matched_inventory.buy_trade.date),
+                              str(gain.matched_inventory.sell_trade.price),
+                              str(gain.matched_inventory.sell_trade.translated_price),
+                              str(gain.matched_inventory.sell_trade.date),
+                              str(gain.matched_inventory.quantity),
+                              str(gain.taxable_gain),
+                              str(gain.carried_capital_losses),
+                              str(gain.buy_commission),
+                              str(gain.sell_commission)]
+            writer.writerow(row)
+
+
+# Each buy is closed by several sells, as happens when a position is scaled out of.
+def _gains(number_of_rows: int) -> Iterator[CapitalGainsTax]:
+    start = datetime(2015, 1, 1, 9, 30)
+    buy_trade = TranslatedTrade(Trade('ES', 'FUTURES', start, 3000.25, 'USD', 8, Amount(-2.5, 'USD'), 'BROKER_REPORT'),
+                                4200.35, 1.4, -3.5, 'AUD')
+    carried_capital_losses = -1000.0
+    for i in range(number_of_rows):
+        if i % 4 == 0:
+            date = start + timedelta(minutes=i)
+            buy_trade = TranslatedTrade(Trade('ES', 'FUTURES', date, 3000.25 + i % 97, 'USD', 8, Amount(-2.5, 'USD'),
+                                              'BROKER_REPORT'),
+                                        (3000.25 + i % 97) * 1.4, 1.4, -3.5, 'AUD')
+        sell_date = buy_trade.date + timedelta(days=400, minutes=i % 4)
+        sell_trade = TranslatedTrade(Trade('ES', 'FUTURES', sell_date, 3010.5 + i % 89, 'USD', -2, Amount(-2.5, 'USD'),
+                                           'BROKER_REPORT'),
+                                     (3010.5 + i % 89) * 1.41, 1.41, -3.525, 'AUD')
+        taxable_gain = (sell_trade.translated_price - buy_trade.translated_price) * 2
+        carried_capital_losses = min(carried_capital_losses + max(taxable_gain, 0), 0)
+        yield CapitalGainsTax(MatchedInventory(buy_trade, sell_trade, 2), taxable_gain, carried_capital_losses,
+                              -0.875, -3.525)
+
+
+def _time(write: Callable[[str, Iterable[CapitalGainsTax]], None],
+          pool: List[CapitalGainsTax],
+          number_of_rows: int) -> float:
+    with tempfile.TemporaryDirectory() as directory:
+        file_path = os.path.join(directory, 'gains.csv')
+        gains = islice(cycle(pool), number_of_rows)
+        start = time.perf_counter()
+        write(file_path, gains)
+        elapsed = time.perf_counter() - start
+    return number_of_rows / elapsed
+
+
+def run(number_of_rows: int) -> Dict[str, float]:
+    pool: List[CapitalGainsTax] = list(_gains(min(number_of_rows, _POOL_SIZE)))
+    return {'legacy': _time(_legacy_write_capital_gains, pool, number_of_rows),
+            'current': _time(InteractiveBrokersReadWriter().write_capital_gains, pool, number_of_rows)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Capital gains csv write throughput.')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--target', type=float, default=TARGET_ROWS_PER_SECOND,
+                        help='Rows per second the current writer must reach.')
+    parser.add_argument('--json', help='Also write the results to this file.')
+    arguments = parser.parse_args()
+    results = run(arguments.rows)
+    for name, rows_per_second in results.items():
+        print('{:<8} {:>12,.0f} rows/s'.format(name, rows_per_second))
+    if arguments.json is not None:
+        with open(arguments.json, 'w') as file:
+            json.dump({'rows': arguments.rows, 'target_rows_per_second': arguments.target,
+                       'rows_per_second': results}, file, indent=2)
+    if results['current'] < arguments.target:
+        print('Below target of {:,.0f} rows/s'.format(arguments.target), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
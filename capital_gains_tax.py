@@ -1,8 +1,13 @@
 from abc import ABC, abstractmethod
 from inventory_accounting import MatchedInventory
 from model import TranslatedTrade
-from typing import Final, List
+from typing import Final, Iterable, Iterator, List, Sequence
 from datetime import datetime
+from itertools import islice
+from math import copysign
+import numpy as np
+from tax_calendar import discount_eligibility_date
+from fixed_point import div_round, from_micros, scale_micros, to_micros
 
 
 class CapitalGainsTax:
@@ -26,6 +31,19 @@ class CapitalGainsTaxMethod(ABC):
                                matched_inventory: MatchedInventory[TranslatedTrade]) -> CapitalGainsTax:
         ...
 
+    # Gains for a run of matches, carrying losses from one to the next. Results are the same as calling
+    # calculate_taxable_gain on each match in turn, which is what this default does.
+    def calculate_taxable_gains(self,
+                                carried_capital_losses: float,
+                                matched_inventories: Sequence[MatchedInventory[TranslatedTrade]]) \
+            -> List[CapitalGainsTax]:
+        capital_gains: List[CapitalGainsTax] = []
+        for matched_inventory in matched_inventories:
+            capital_gain = self.calculate_taxable_gain(carried_capital_losses, matched_inventory)
+            carried_capital_losses = capital_gain.carried_capital_losses
+            capital_gains.append(capital_gain)
+        return capital_gains
+
 
 # Method per:
 # https://www.ato.gov.au/general/capital-gains-tax/working-out-your-capital-gain-or-loss/working-out-your-capital-gain/the-discount-method-of-calculating-your-capital-gain/
@@ -78,12 +96,8 @@ class DiscountCapitalGainsTaxMethod(CapitalGainsTaxMethod):
             net_taxable_gain = 0
             remaining_carried_capital_losses = (carried_capital_losses + taxable_gain)  # Adding two negative numbers.
 
-        # Determine date considered '1 year' after purchase. See example below.
-        buy_date: datetime = matched_inventory.buy_trade.date
-        # 1 calendar year later. Starts day after purchase (see example below)
-        test_date: datetime = datetime(buy_date.year + 1,
-                                       buy_date.month,
-                                       buy_date.day + 1)
+        # Date considered '1 year' after purchase. See example below.
+        test_date: datetime = discount_eligibility_date(matched_inventory.buy_trade.date)
         if matched_inventory.sell_trade.date >= test_date and taxable_gain > 0:
             return CapitalGainsTax(matched_inventory,
                                    net_taxable_gain / 2,
@@ -97,6 +111,160 @@ class DiscountCapitalGainsTaxMethod(CapitalGainsTaxMethod):
                                    buy_side_pro_rata_commission,
                                    sell_side_pro_rata_commission)
 
+    # Same results as calculate_taxable_gain over each match in turn, bit for bit. One pass over the matches picks out
+    # the prices, commissions and quantities each asset category uses and tests discount eligibility. Pro-rata
+    # commissions and raw gains are then computed as arrays, with the same operations in the same order as the scalar
+    # method. Netting against carried losses is sequential, but long runs of losses are a single cumulative sum and
+    # gains pass straight through once the carried losses are used up.
+    def calculate_taxable_gains(self,
+                                carried_capital_losses: float,
+                                matched_inventories: Sequence[MatchedInventory[TranslatedTrade]]) \
+            -> List[CapitalGainsTax]:
+        if carried_capital_losses > 0:
+            raise ValueError("Capital losses cannot be a positive number.")
+        if len(matched_inventories) == 0:
+            return []
+
+        # Per match: quantity, buy quantity, sell quantity, buy commission, sell commission, buy price, sell price and
+        # the rate the accrual is translated at (1 for FOREX, which is already in AUD).
+        fields: List[float] = []
+        discountable: List[bool] = []
+        for matched_inventory in matched_inventories:
+            buy_trade = matched_inventory.buy_trade
+            sell_trade = matched_inventory.sell_trade
+            if buy_trade.translated_currency != 'AUD' or sell_trade.translated_currency != 'AUD':
+                raise ValueError("CGT can only be calculated on trades translated to AUD.")
+            if buy_trade.asset_category == 'FOREX':
+                fields.extend((matched_inventory.quantity, buy_trade.quantity, sell_trade.quantity,
+                               buy_trade.translated_commission, sell_trade.translated_commission,
+                               buy_trade.translated_price, sell_trade.translated_price, 1.0))
+            elif buy_trade.asset_category == 'FUTURES':
+                fields.extend((matched_inventory.quantity, buy_trade.quantity, sell_trade.quantity,
+                               buy_trade.commission.value, sell_trade.commission.value,
+                               buy_trade.price, sell_trade.price, sell_trade.exchange_rate))
+            else:
+                raise NotImplementedError('Tax treatment for asset classes other than forex and futures have not been '
+                                          'implemented.')
+            if buy_trade.quantity == 0 or sell_trade.quantity == 0:
+                zero_trade = buy_trade if buy_trade.quantity == 0 else sell_trade
+                raise ValueError("Cannot pro-rate the commission of a zero quantity trade: " + zero_trade.asset_code
+                                 + " on " + str(zero_trade.date) + ".")
+            discountable.append(sell_trade.date >= discount_eligibility_date(buy_trade.date))
+
+        (quantity, buy_quantity, sell_quantity, buy_commission, sell_commission, buy_price, sell_price,
+         exchange_rate) = np.array(fields, dtype=np.float64).reshape(-1, 8).T
+        buy_quantity = np.abs(buy_quantity)
+        sell_quantity = np.abs(sell_quantity)
+        buy_side_pro_rata_commission = buy_commission * quantity / buy_quantity
+        sell_side_pro_rata_commission = sell_commission * quantity / sell_quantity
+        # Multiplying by an exchange rate of exactly 1.0 leaves FOREX gains unchanged.
+        taxable_gain = ((sell_price - buy_price) * quantity + sell_side_pro_rata_commission
+                        + buy_side_pro_rata_commission) * exchange_rate
+
+        is_gain = taxable_gain > 0
+        gains: List[float] = taxable_gain.tolist()
+        net_taxable_gains: List[float] = []
+        remaining_carried_capital_losses: List[float] = []
+        run_ends: List[int] = (np.flatnonzero(is_gain[1:] != is_gain[:-1]) + 1).tolist() + [len(gains)]
+        start = 0
+        for end in run_ends:
+            if gains[start] > 0:
+                i = start
+                # Once the carried losses are used up (and not -0.0) they no longer change and gains pass through.
+                while i < end and (carried_capital_losses != 0 or copysign(1, carried_capital_losses) < 0):
+                    nettable_amount: float = min(-carried_capital_losses, gains[i])
+                    net_taxable_gains.append(gains[i] - nettable_amount)
+                    carried_capital_losses = carried_capital_losses + nettable_amount
+                    remaining_carried_capital_losses.append(carried_capital_losses)
+                    i += 1
+                net_taxable_gains.extend(gains[i:end])
+                remaining_carried_capital_losses.extend([carried_capital_losses] * (end - i))
+            elif end - start >= _CUMULATIVE_RUN_LENGTH:
+                # Strictly left to right, so each sum is the scalar method's carried_capital_losses + taxable_gain.
+                carried = np.add.accumulate(np.concatenate([[carried_capital_losses], taxable_gain[start:end]]))[1:]
+                net_taxable_gains.extend([0.0] * (end - start))
+                remaining_carried_capital_losses.extend(carried.tolist())
+                carried_capital_losses = remaining_carried_capital_losses[-1]
+            else:
+                for gain in gains[start:end]:
+                    carried_capital_losses = carried_capital_losses + gain
+                    remaining_carried_capital_losses.append(carried_capital_losses)
+                net_taxable_gains.extend([0.0] * (end - start))
+            start = end
+
+        net_taxable_gain = np.array(net_taxable_gains, dtype=np.float64)
+        taxable_gains: List[float] = np.where(np.array(discountable) & is_gain,
+                                              net_taxable_gain / 2,
+                                              net_taxable_gain).tolist()
+        for i in np.flatnonzero(~is_gain).tolist():
+            taxable_gains[i] = 0  # The scalar method reports losses as an int 0.
+        return list(map(CapitalGainsTax,
+                        matched_inventories,
+                        taxable_gains,
+                        remaining_carried_capital_losses,
+                        buy_side_pro_rata_commission.tolist(),
+                        sell_side_pro_rata_commission.tolist()))
+
+
+# The discount method in exact integer arithmetic (see fixed_point.py). Quantities, commissions and carried losses are
+# taken to micros; each pro-rata commission, quantity-times-price and currency translation is rounded to micros once
+# from its exact value; and everything is summed and netted as ints, so carried losses do not pick up float error over
+# a long history. Results agree with DiscountCapitalGainsTaxMethod to within a few micros per match.
+class FixedPointDiscountCapitalGainsTaxMethod(CapitalGainsTaxMethod):
+    def calculate_taxable_gain(self,
+                               carried_capital_losses: float,
+                               matched_inventory: MatchedInventory[TranslatedTrade]) -> CapitalGainsTax:
+        if carried_capital_losses > 0:
+            raise ValueError("Capital losses cannot be a positive number.")
+        buy_trade = matched_inventory.buy_trade
+        sell_trade = matched_inventory.sell_trade
+        if sell_trade.translated_currency != 'AUD' or buy_trade.translated_currency != 'AUD':
+            raise ValueError("CGT can only be calculated on trades translated to AUD.")
+
+        quantity = to_micros(matched_inventory.quantity)
+        buy_quantity = abs(to_micros(buy_trade.quantity))
+        sell_quantity = abs(to_micros(sell_trade.quantity))
+        buy_side_pro_rata_commission: int
+        sell_side_pro_rata_commission: int
+        taxable_gain: int
+        if buy_trade.asset_category == 'FOREX':
+            buy_side_pro_rata_commission = div_round(to_micros(buy_trade.translated_commission) * quantity,
+                                                     buy_quantity)
+            sell_side_pro_rata_commission = div_round(to_micros(sell_trade.translated_commission) * quantity,
+                                                      sell_quantity)
+            taxable_gain = scale_micros(quantity, sell_trade.translated_price) \
+                - scale_micros(quantity, buy_trade.translated_price) \
+                + sell_side_pro_rata_commission + buy_side_pro_rata_commission
+        elif buy_trade.asset_category == 'FUTURES':
+            buy_side_pro_rata_commission = div_round(to_micros(buy_trade.commission.value) * quantity, buy_quantity)
+            sell_side_pro_rata_commission = div_round(to_micros(sell_trade.commission.value) * quantity,
+                                                      sell_quantity)
+            special_accrual_amount = scale_micros(quantity, sell_trade.price) \
+                - scale_micros(quantity, buy_trade.price) \
+                + sell_side_pro_rata_commission + buy_side_pro_rata_commission
+            taxable_gain = scale_micros(special_accrual_amount, sell_trade.exchange_rate)
+        else:
+            raise NotImplementedError(
+                'Tax treatment for asset classes other than forex and futures have not been implemented.')
+
+        carried = to_micros(carried_capital_losses)
+        net_taxable_gain: int
+        if taxable_gain > 0:
+            nettable_amount = min(-carried, taxable_gain)
+            net_taxable_gain = taxable_gain - nettable_amount
+            carried += nettable_amount
+        else:
+            net_taxable_gain = 0
+            carried += taxable_gain
+
+        if taxable_gain > 0 and sell_trade.date >= discount_eligibility_date(buy_trade.date):
+            net_taxable_gain = div_round(net_taxable_gain, 2)
+        return CapitalGainsTax(matched_inventory,
+                               from_micros(net_taxable_gain) if taxable_gain > 0 else 0,
+                               from_micros(carried),
+                               from_micros(buy_side_pro_rata_commission),
+                               from_micros(sell_side_pro_rata_commission))
+
 
 # Strange Day counting method:
 # https://www.ato.gov.au/General/Capital-gains-tax/Working-out-your-capital-gain-or-loss/Working-out-your-capital-gain/
@@ -107,22 +275,37 @@ class DiscountCapitalGainsTaxMethod(CapitalGainsTaxMethod):
 # because she hasn't owned the asset for at least 12 months.
 
 
+_BATCH_SIZE = 4096
+# Runs of losses at least this long are carried with one cumulative sum rather than one match at a time.
+_CUMULATIVE_RUN_LENGTH = 16
+
+
 # Tracks past capital losses and passes them to the CGT calculator for netting.
 class CapitalGainsTaxAggregator:
     def __init__(self, capital_gains_tax_method: CapitalGainsTaxMethod):
         self._capital_gains_tax_method: Final = capital_gains_tax_method
+        # Losses carried after the last gain yielded by iter_calculate.
+        self.carried_capital_losses: float = 0
 
     # existing_capital_losses as negative number.
-    def calculate(self, existing_capital_losses: float, trades: List[MatchedInventory[TranslatedTrade]]) -> List[CapitalGainsTax]:
+    def calculate(self, existing_capital_losses: float, trades: Iterable[MatchedInventory[TranslatedTrade]]) -> List[CapitalGainsTax]:
+        return list(self.iter_calculate(existing_capital_losses, trades))
+
+    # Yields one gain per match as the matches arrive. Matches are taxed in batches of _BATCH_SIZE, and only the running
+    # carried loss is kept between batches, so this can sit between a streaming matcher and a streaming writer.
+    def iter_calculate(self,
+                       existing_capital_losses: float,
+                       trades: Iterable[MatchedInventory[TranslatedTrade]]) -> Iterator[CapitalGainsTax]:
         if existing_capital_losses > 0:
             raise ValueError("Capital losses cannot be a positive number.")
 
-        capital_gains: List[CapitalGainsTax] = []
-        carried_losses: float
-        for i, trade in enumerate(trades):
-            if i == 0:
-                carried_losses = existing_capital_losses
-            else:
-                carried_losses = capital_gains[i - 1].carried_capital_losses
-            capital_gains.append(self._capital_gains_tax_method.calculate_taxable_gain(carried_losses, trade))
-        return capital_gains
+        self.carried_capital_losses = existing_capital_losses
+        iterator = iter(trades)
+        while True:
+            batch: List[MatchedInventory[TranslatedTrade]] = list(islice(iterator, _BATCH_SIZE))
+            if len(batch) == 0:
+                return
+            for capital_gain in self._capital_gains_tax_method.calculate_taxable_gains(self.carried_capital_losses,
+                                                                                       batch):
+                self.carried_capital_losses = capital_gain.carried_capital_losses
+                yield capital_gain
@@ -0,0 +1,205 @@
+import json
+import zipfile
+from itertools import islice
+from datetime import datetime
+from typing import Callable, Dict, Final, Generic, Iterable, Iterator, List, Optional, Tuple, TypeVar, Union
+
+import numpy as np
+import numpy.typing as npt
+
+from capital_gains_tax import CapitalGainsTax
+from model import TranslatedTrade
+from read_writer import OutputWriter
+
+# pyarrow is optional. Without it, files are written in the .npz layout described on ColumnarWriter.
+try:
+    import pyarrow  # type: ignore[import-not-found]
+    import pyarrow.parquet  # type: ignore[import-not-found]
+    _HAS_PYARROW = True
+except ImportError:
+    _HAS_PYARROW = False
+
+R = TypeVar('R')
+
+# Value of one row in one column.
+Cell = Union[str, float, datetime]
+# A column as written or read back: text codes and categories, dates, numbers, or strings read back from text columns.
+ColumnArray = npt.NDArray[Union[np.int32, np.str_, np.datetime64, np.float64, np.object_]]
+
+# Column kinds. Text columns are dictionary encoded, dates are microsecond timestamps and numbers are float64.
+TEXT = 'text'
+DATE = 'date'
+FLOAT = 'float'
+
+_NPZ_FORMAT_ENTRY = 'format.json'
+_NPZ_FORMAT_VERSION = 1
+
+
+class Column(Generic[R]):
+    def __init__(self, name: str, kind: str, value: Callable[[R], Cell]):
+        self.name: Final = name
+        self.kind: Final = kind
+        self.value: Final = value
+
+
+# Same columns, in the same order, as ReadWriter.write_capital_gains.
+CAPITAL_GAINS_COLUMNS: Final[List[Column[CapitalGainsTax]]] = [
+    Column('asset_code', TEXT, lambda gain: gain.matched_inventory.buy_trade.asset_code),
+    Column('buy_price', FLOAT, lambda gain: gain.matched_inventory.buy_trade.price),
+    Column('translated_buy_price', FLOAT, lambda gain: gain.matched_inventory.buy_trade.translated_price),
+    Column('buy_date', DATE, lambda gain: gain.matched_inventory.buy_trade.date),
+    Column('sell_price', FLOAT, lambda gain: gain.matched_inventory.sell_trade.price),
+    Column('translated_sell_price', FLOAT, lambda gain: gain.matched_inventory.sell_trade.translated_price),
+    Column('sell_date', DATE, lambda gain: gain.matched_inventory.sell_trade.date),
+    Column('quantity', FLOAT, lambda gain: gain.matched_inventory.quantity),
+    Column('taxable_gain', FLOAT, lambda gain: gain.taxable_gain),
+    Column('carried_capital_losses', FLOAT, lambda gain: gain.carried_capital_losses),
+    Column('buy_commission', FLOAT, lambda gain: gain.buy_commission),
+    Column('sell_commission', FLOAT, lambda gain: gain.sell_commission)]
+
+# Same columns, in the same order, as ReadWriter.write_trades.
+TRADES_COLUMNS: Final[List[Column[TranslatedTrade]]] = [
+    Column('asset_code', TEXT, lambda trade: trade.asset_code),
+    Column('date', DATE, lambda trade: trade.date),
+    Column('price', FLOAT, lambda trade: trade.price),
+    Column('currency', TEXT, lambda trade: trade.currency),
+    Column('quantity', FLOAT, lambda trade: trade.quantity),
+    Column('commission.value', FLOAT, lambda trade: trade.commission.value),
+    Column('commission.currency', TEXT, lambda trade: trade.commission.currency),
+    Column('aud_price', FLOAT, lambda trade: trade.translated_price),
+    Column('exchange_rate', FLOAT, lambda trade: trade.exchange_rate),
+    Column('aud_commission', FLOAT, lambda trade: trade.translated_commission),
+    Column('trade_source', TEXT, lambda trade: trade.source)]
+
+
+def _row_groups(rows: Iterable[R], row_group_size: int) -> Iterator[List[R]]:
+    iterator = iter(rows)
+    while True:
+        row_group = list(islice(iterator, row_group_size))
+        if len(row_group) == 0:
+            return
+        yield row_group
+
+
+# Dictionary encodes a text column: int32 codes into the distinct values, in order of first appearance.
+def _encode(values: List[Cell]) -> Tuple[npt.NDArray[np.int32], npt.NDArray[np.str_]]:
+    positions: Dict[str, int] = dict()
+    codes: List[int] = [positions.setdefault(str(value), len(positions)) for value in values]
+    return np.array(codes, dtype=np.int32), np.array(list(positions), dtype=np.str_)
+
+
+# Writes gains and processed trades as typed columnar files instead of csv text, so they can be loaded without
+# re-parsing numbers and dates. Rows are consumed row_group_size at a time and each group is written out before the
+# next is read, so only one group is ever held in memory.
+#
+# With pyarrow installed the files are Parquet, one Parquet row group per group. Otherwise they are .npz (zip) archives
+# holding format.json (version, columns and their kinds, number of row groups) and, per row group i and column c:
+#  * float and date columns: 'i/c.npy', float64 or datetime64[us].
+#  * text columns: 'i/c.codes.npy' (int32) and 'i/c.categories.npy' (the distinct values). Categories are per row
+#    group.
+# read_columnar reads either format back.
+class ColumnarWriter(OutputWriter):
+    def __init__(self, row_group_size: int = 65536, use_parquet: Optional[bool] = None):
+        if row_group_size <= 0:
+            raise ValueError("Row group size must be positive.")
+        if use_parquet and not _HAS_PYARROW:
+            raise ValueError("Parquet output requires pyarrow.")
+        self.row_group_size: Final = row_group_size
+        self.use_parquet: Final = _HAS_PYARROW if use_parquet is None else use_parquet
+
+    @property
+    def extension(self) -> str:
+        return '.parquet' if self.use_parquet else '.npz'
+
+    def write_capital_gains(self, file_path: str, gains: Iterable[CapitalGainsTax]) -> None:
+        self._write(file_path, CAPITAL_GAINS_COLUMNS, gains)
+
+    def write_trades(self, file_path : str, trades: Iterable[TranslatedTrade]) -> None:
+        self._write(file_path, TRADES_COLUMNS, trades)
+
+    def _write(self, file_path: str, columns: List[Column[R]], rows: Iterable[R]) -> None:
+        if self.use_parquet:
+            self._write_parquet(file_path, columns, rows)
+        else:
+            self._write_npz(file_path, columns, rows)
+
+    def _write_parquet(self, file_path: str, columns: List[Column[R]], rows: Iterable[R]) -> None:
+        types: Dict[str, object] = {TEXT: pyarrow.dictionary(pyarrow.int32(), pyarrow.string()),
+                                 DATE: pyarrow.timestamp('us'),
+                                 FLOAT: pyarrow.float64()}
+        schema = pyarrow.schema([(column.name, types[column.kind]) for column in columns])
+        with pyarrow.parquet.ParquetWriter(file_path, schema) as writer:
+            for row_group in _row_groups(rows, self.row_group_size):
+                arrays: List[object] = []
+                for column in columns:
+                    values: List[Cell] = [column.value(row) for row in row_group]
+                    if column.kind == TEXT:
+                        codes, categories = _encode(values)
+                        arrays.append(pyarrow.DictionaryArray.from_arrays(codes, categories.tolist()))
+                    else:
+                        arrays.append(pyarrow.array(values, type=types[column.kind]))
+                writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+
+    def _write_npz(self, file_path: str, columns: List[Column[R]], rows: Iterable[R]) -> None:
+        number_of_row_groups = 0
+        with zipfile.ZipFile(file_path, mode='w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+            for i, row_group in enumerate(_row_groups(rows, self.row_group_size)):
+                for column in columns:
+                    values = [column.value(row) for row in row_group]
+                    if column.kind == TEXT:
+                        codes, categories = _encode(values)
+                        _write_array(archive, str(i) + '/' + column.name + '.codes.npy', codes)
+                        _write_array(archive, str(i) + '/' + column.name + '.categories.npy', categories)
+                    elif column.kind == DATE:
+                        _write_array(archive, str(i) + '/' + column.name + '.npy',
+                                     np.array(values, dtype='datetime64[us]'))
+                    else:
+                        _write_array(archive, str(i) + '/' + column.name + '.npy', np.array(values, dtype=np.float64))
+                number_of_row_groups += 1
+            archive.writestr(_NPZ_FORMAT_ENTRY, json.dumps({
+                'version': _NPZ_FORMAT_VERSION,
+                'columns': [[column.name, column.kind] for column in columns],
+                'row_groups': number_of_row_groups}))
+
+
+def _write_array(archive: zipfile.ZipFile, name: str, array: ColumnArray) -> None:
+    with archive.open(name, mode='w', force_zip64=True) as entry:
+        np.lib.format.write_array(entry, array, allow_pickle=False)
+
+
+def _read_array(archive: zipfile.ZipFile, name: str) -> ColumnArray:
+    with archive.open(name) as entry:
+        array: ColumnArray = np.lib.format.read_array(entry, allow_pickle=False)
+        return array
+
+
+# Reads a file written by ColumnarWriter back into one array per column: float64, datetime64[us] or, for text columns,
+# an object array of strings.
+def read_columnar(file_path: str) -> Dict[str, ColumnArray]:
+    if not zipfile.is_zipfile(file_path):
+        if not _HAS_PYARROW:
+            raise ValueError("Reading Parquet files requires pyarrow.")
+        table = pyarrow.parquet.read_table(file_path)
+        return {name: np.array(table.column(name).to_pylist(),
+                               dtype=object if pyarrow.types.is_dictionary(table.schema.field(name).type)
+                               else 'datetime64[us]' if pyarrow.types.is_timestamp(table.schema.field(name).type)
+                               else np.float64)
+                for name in table.column_names}
+
+    with zipfile.ZipFile(file_path) as archive:
+        file_format = json.loads(archive.read(_NPZ_FORMAT_ENTRY))
+        if file_format['version'] != _NPZ_FORMAT_VERSION:
+            raise ValueError("Unsupported columnar file version: " + str(file_format['version']))
+        results: Dict[str, ColumnArray] = dict()
+        for name, kind in file_format['columns']:
+            parts: List[ColumnArray] = []
+            for i in range(file_format['row_groups']):
+                if kind == TEXT:
+                    codes = _read_array(archive, str(i) + '/' + name + '.codes.npy')
+                    categories = _read_array(archive, str(i) + '/' + name + '.categories.npy').astype(object)
+                    parts.append(categories[codes] if len(categories) > 0 else np.empty(0, dtype=object))
+                else:
+                    parts.append(_read_array(archive, str(i) + '/' + name + '.npy'))
+            empty = np.empty(0, dtype=object if kind == TEXT else 'datetime64[us]' if kind == DATE else np.float64)
+            results[name] = np.concatenate(parts) if len(parts) > 0 else empty
+        return results
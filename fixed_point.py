@@ -0,0 +1,43 @@
+from decimal import Decimal, ROUND_HALF_EVEN
+from typing import Final
+
+# Fixed-point values are Python ints counting millionths ("micros") of a unit: of an asset for quantities, of a
+# currency for amounts. Ints never round, so sums and differences of micros are exact and a quantity that should net
+# to zero does.
+SCALE: Final = 1000000
+
+_MICRO: Final = Decimal(1).scaleb(-6)
+
+
+# Rounds numerator / denominator to the nearest int, ties to even, without going through a float.
+def div_round(numerator: int, denominator: int) -> int:
+    if denominator < 0:
+        numerator, denominator = -numerator, -denominator
+    quotient, remainder = divmod(numerator, denominator)
+    twice_remainder = 2 * remainder
+    if twice_remainder > denominator or (twice_remainder == denominator and quotient % 2 == 1):
+        quotient += 1
+    return quotient
+
+
+# Exact value of a float, rounded to micros.
+def to_micros(value: float) -> int:
+    numerator, denominator = value.as_integer_ratio()
+    return div_round(numerator * SCALE, denominator)
+
+
+# Statement text such as '31,944' or '-29.86525478', rounded to micros as a decimal, so '0.1' is exactly 100000.
+def parse_micros(text: str) -> int:
+    return int(Decimal(text.replace(',', '')).quantize(_MICRO, rounding=ROUND_HALF_EVEN).scaleb(6))
+
+
+# Nearest float, e.g. 100000 -> 0.1.
+def from_micros(micros: int) -> float:
+    return micros / SCALE
+
+
+# micros * factor, rounded once from the exact product, e.g. a quantity in micros times a price gives an amount in
+# micros.
+def scale_micros(micros: int, factor: float) -> int:
+    numerator, denominator = factor.as_integer_ratio()
+    return div_round(micros * numerator, denominator)
@@ -1,7 +1,11 @@
 from profile import DatedProfile, LeftPiecewiseConstantProfile
-from typing import List, Final, Dict
+from typing import List, Final, Dict, Iterable, Sequence, Set
 from datetime import datetime
 from model import Trade, TranslatedTrade
+from trade_table import TradeTable
+import numpy as np
+import numpy.typing as npt
+import instrumentation
 
 # Converts foreign asset transactions to AUD equivalents and creates implied
 # FX trades using provided ATO mandated rates (from the RBA at the time of writing).
@@ -14,35 +18,125 @@ from model import Trade, TranslatedTrade
 # "As outlined on our website, taxpayers are able to use the ATO rates or any appropriate exchange rate.
 # This can be provided by a banking institution operating in Australia including, where relevant, the banking
 # institution through which your foreign income is received, or another reliable external source ."
+
+
+# Column-wise result of translating a batch of trades. Row i corresponds to the i-th trade given to the translator.
+class TranslatedColumns:
+    def __init__(self,
+                 translated_price: npt.NDArray[np.float64],
+                 exchange_rate: npt.NDArray[np.float64],
+                 translated_commission: npt.NDArray[np.float64],
+                 translated_currency: str):
+        self.translated_price: Final = translated_price
+        self.exchange_rate: Final = exchange_rate
+        self.translated_commission: Final = translated_commission
+        self.translated_currency: Final = translated_currency
+
+    def __len__(self) -> int:
+        return len(self.translated_price)
+
+    # Only builds the object representation when asked. trades must be in the same order as the translated columns.
+    # AUD trades keep the int rate 1 that convert_trade gives them, so written trades read the same either way.
+    def to_translated_trades(self, trades: Sequence[Trade]) -> List[TranslatedTrade]:
+        if len(trades) != len(self):
+            raise ValueError("Number of trades does not match the number of translated rows.")
+        return [TranslatedTrade(trade, price, rate if trade.currency != 'AUD' else 1, commission,
+                                self.translated_currency)
+                for trade, price, rate, commission in zip(trades,
+                                                          self.translated_price.tolist(),
+                                                          self.exchange_rate.tolist(),
+                                                          self.translated_commission.tolist())]
+
+
+# RBA rate codes (e.g. 'USD.AUD') needed to translate the given trades.
+def required_rate_codes(trades: Iterable[Trade]) -> Set[str]:
+    rate_codes: Set[str] = set()
+    for trade in trades:
+        if trade.currency != 'AUD':
+            rate_codes.add(trade.currency + '.AUD')
+        if trade.commission.currency != 'AUD':
+            rate_codes.add(trade.commission.currency + '.AUD')
+    return rate_codes
+
+
 class ForeignAssetTranslator:
+        # Profiles are only built the first time a currency is used, so unused RBA columns cost nothing.
         def __init__(self, fx_rates : Dict[str,Dict[datetime, float]]):
+            self._fx_rates: Final = fx_rates
             self.fx_profiles: Dict[str,DatedProfile[float]] = dict()
-            for asset_code in fx_rates:
-                self.fx_profiles[asset_code] = LeftPiecewiseConstantProfile(asset_code, fx_rates[asset_code])
+
+        def _fx_profile(self, rate_code: str) -> DatedProfile[float]:
+            profile = self.fx_profiles.get(rate_code)
+            if profile is None:
+                profile = LeftPiecewiseConstantProfile(rate_code, self._fx_rates[rate_code])
+                self.fx_profiles[rate_code] = profile
+            return profile
 
         def convert_trade(self, trade : Trade) -> TranslatedTrade:
             aud_price : float
             aud_commission : float
             price_fx_rate : float
             if trade.currency != 'AUD':
-                price_fx_rate =  self.fx_profiles[trade.currency + '.AUD'][trade.date]
+                instrumentation.count('profile_lookups')
+                price_fx_rate =  self._fx_profile(trade.currency + '.AUD')[trade.date]
                 aud_price = trade.price * price_fx_rate
             else:
                 aud_price = trade.price
                 price_fx_rate = 1
 
             if trade.commission.currency != "AUD":
-                commission_fx_rate = self.fx_profiles[trade.commission.currency+ '.AUD'][trade.date]
+                instrumentation.count('profile_lookups')
+                commission_fx_rate = self._fx_profile(trade.commission.currency + '.AUD')[trade.date]
                 aud_commission = trade.commission.value * commission_fx_rate
             else:
                 aud_commission = trade.commission.value
 
             return TranslatedTrade(trade, aud_price, price_fx_rate, aud_commission, 'AUD')
 
-        def convert_trades(self, trades : List[Trade]) -> List[TranslatedTrade]:
-            converted_trades : List[TranslatedTrade] = []
-            for trade in trades:
-                converted_trades.append(self.convert_trade(trade))
-            return converted_trades
+        def convert_trades(self, trades : Iterable[Trade]) -> List[TranslatedTrade]:
+            trade_list: List[Trade] = list(trades)
+            columns = self.convert_columns(np.array([trade.date for trade in trade_list], dtype='datetime64[us]'),
+                                           np.array([trade.price for trade in trade_list], dtype=np.float64),
+                                           np.array([trade.currency for trade in trade_list], dtype=object),
+                                           np.array([trade.commission.value for trade in trade_list], dtype=np.float64),
+                                           np.array([trade.commission.currency for trade in trade_list], dtype=object))
+            return columns.to_translated_trades(trade_list)
+
+        # Translates a batch of trades held as columns. Rates are gathered per currency with a single
+        # searchsorted over the RBA dates, so there is no per-trade profile lookup.
+        def convert_columns(self,
+                            dates: npt.NDArray[np.datetime64],
+                            prices: npt.NDArray[np.float64],
+                            currencies: npt.NDArray[np.object_],
+                            commissions: npt.NDArray[np.float64],
+                            commission_currencies: npt.NDArray[np.object_]) -> TranslatedColumns:
+            price_fx_rates = self._gather_rates(dates, currencies)
+            commission_fx_rates = self._gather_rates(dates, commission_currencies)
+            return TranslatedColumns(prices * price_fx_rates,
+                                     price_fx_rates,
+                                     commissions * commission_fx_rates,
+                                     'AUD')
 
+        # Translates a TradeTable without building any trade objects.
+        def convert_table(self, table: TradeTable) -> TradeTable:
+            columns = self.convert_columns(table.date,
+                                           table.price,
+                                           table.currency.values(),
+                                           table.commission,
+                                           table.commission_currency.values())
+            return table.with_translation(columns.translated_price,
+                                          columns.exchange_rate,
+                                          columns.translated_commission,
+                                          columns.translated_currency)
 
+        def _gather_rates(self,
+                          dates: npt.NDArray[np.datetime64],
+                          currencies: npt.NDArray[np.object_]) -> npt.NDArray[np.float64]:
+            rates = np.ones(len(dates), dtype=np.float64)
+            for currency in np.unique(currencies):
+                if currency == 'AUD':
+                    continue
+                rows = currencies == currency
+                rates[rows] = self._fx_profile(str(currency) + '.AUD').lookup_array(dates[rows])
+                instrumentation.count('profile_lookups', int(np.count_nonzero(rows)))
+            return rates
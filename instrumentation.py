@@ -0,0 +1,185 @@
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from typing import ContextManager, Dict, Final, Iterator, List, Optional, TextIO
+
+# resource is Unix only. Without it, the report has no peak RSS.
+try:
+    import resource
+    _HAS_RESOURCE = True
+except ImportError:
+    _HAS_RESOURCE = False
+
+# Setting this environment variable to anything but '' or '0' turns instrumentation on, as main.py's --instrument does.
+# Setting it to 'memory' also traces memory per stage, as --instrument-memory does.
+ENVIRONMENT_VARIABLE: Final = 'CGT_INSTRUMENT'
+
+
+# Wall time, CPU time and, with memory tracing, peak traced memory of every run of one stage, summed (times) or maxed
+# (memory) over runs.
+class StageTiming:
+    def __init__(self, name: str):
+        self.name: Final = name
+        self.runs: int = 0
+        self.wall_seconds: float = 0
+        self.cpu_seconds: float = 0
+        # Peak memory allocated during the stage, above what was allocated when it started. 0 without memory tracing.
+        self.peak_bytes: int = 0
+
+
+class _OpenStage:
+    def __init__(self, timing: StageTiming, trace_memory: bool):
+        self.timing: Final = timing
+        self.start_wall: Final = time.perf_counter()
+        self.start_cpu: Final = time.process_time()
+        self.start_bytes: Final = tracemalloc.get_traced_memory()[0] if trace_memory else 0
+        self.peak_bytes: int = self.start_bytes
+
+
+# Stage timings and counters for one run. Stages may nest; a stage's peak includes the peaks of stages inside it.
+# tracemalloc hooks every allocation and slows allocation heavy stages several times over, so peaks per stage are only
+# traced with trace_memory. Timings taken that way are not comparable with untraced ones. Either way the report has the
+# process's peak resident set size, which costs nothing to collect.
+class Recorder:
+    def __init__(self, trace_memory: bool = False) -> None:
+        self.trace_memory: Final = trace_memory
+        self.stages: Final[Dict[str, StageTiming]] = dict()
+        self.counters: Final[Dict[str, int]] = dict()
+        self._open_stages: Final[List[_OpenStage]] = []
+
+    def count(self, name: str, amount: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    # tracemalloc only keeps one peak, so it is folded into every open stage before being reset for the next one.
+    def _fold_peak(self) -> None:
+        if not self.trace_memory:
+            return
+        peak = tracemalloc.get_traced_memory()[1]
+        for open_stage in self._open_stages:
+            open_stage.peak_bytes = max(open_stage.peak_bytes, peak)
+        tracemalloc.reset_peak()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        timing = self.stages.get(name)
+        if timing is None:
+            timing = StageTiming(name)
+            self.stages[name] = timing
+        self._fold_peak()
+        open_stage = _OpenStage(timing, self.trace_memory)
+        self._open_stages.append(open_stage)
+        try:
+            yield
+        finally:
+            self._fold_peak()
+            self._open_stages.pop()
+            timing.runs += 1
+            timing.wall_seconds += time.perf_counter() - open_stage.start_wall
+            timing.cpu_seconds += time.process_time() - open_stage.start_cpu
+            timing.peak_bytes = max(timing.peak_bytes, open_stage.peak_bytes - open_stage.start_bytes)
+
+    # JSON-ready: stages by name, in the order they first ran, counters by name, and the process's peak RSS. Stages
+    # only have peak_bytes with memory tracing.
+    def report(self) -> Dict[str, Dict[str, object]]:
+        stages: Dict[str, object] = dict()
+        for timing in self.stages.values():
+            stage: Dict[str, object] = {'runs': timing.runs, 'wall_seconds': timing.wall_seconds,
+                                        'cpu_seconds': timing.cpu_seconds}
+            if self.trace_memory:
+                stage['peak_bytes'] = timing.peak_bytes
+            stages[timing.name] = stage
+        return {'stages': stages, 'counters': dict(self.counters), 'process': {'peak_rss_bytes': peak_rss_bytes()}}
+
+    def write_table(self, file: TextIO) -> None:
+        print('{:<24} {:>5} {:>10} {:>10} {:>12}'.format('stage', 'runs', 'wall_s', 'cpu_s', 'peak_mib'), file=file)
+        for timing in self.stages.values():
+            peak_mib = '{:.1f}'.format(timing.peak_bytes / (1 << 20)) if self.trace_memory else '-'
+            print('{:<24} {:>5} {:>10.3f} {:>10.3f} {:>12}'.format(
+                timing.name, timing.runs, timing.wall_seconds, timing.cpu_seconds, peak_mib), file=file)
+        for name, count in self.counters.items():
+            print('{:<24} {:>12,}'.format(name, count), file=file)
+        peak_rss = peak_rss_bytes()
+        if peak_rss is not None:
+            print('{:<24} {:>12.1f}'.format('peak_rss_mib', peak_rss / (1 << 20)), file=file)
+
+
+# Peak resident set size of this process so far, or None where the resource module is unavailable.
+def peak_rss_bytes() -> Optional[int]:
+    if not _HAS_RESOURCE:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+# Module-wide recorder, None while instrumentation is off. Off, stage() hands back a shared no-op context manager and
+# count() returns straight away, so instrumented code costs a function call per stage or count. Counters in per-row
+# loops are kept in locals and counted once per call for the same reason.
+_recorder: Optional[Recorder] = None
+_started_tracing: bool = False
+_NO_STAGE: Final = nullcontext()
+
+
+# With trace_memory, stages also record their peak traced memory (see Recorder).
+def enable(trace_memory: bool = False) -> Recorder:
+    global _recorder, _started_tracing
+    if _recorder is None:
+        _started_tracing = trace_memory and not tracemalloc.is_tracing()
+        if _started_tracing:
+            tracemalloc.start()
+        _recorder = Recorder(trace_memory)
+    return _recorder
+
+
+def disable() -> None:
+    global _recorder, _started_tracing
+    if _started_tracing:
+        tracemalloc.stop()
+        _started_tracing = False
+    _recorder = None
+
+
+def is_enabled() -> bool:
+    return _recorder is not None
+
+
+def enabled_by_environment() -> bool:
+    return os.environ.get(ENVIRONMENT_VARIABLE, '') not in ('', '0')
+
+
+def memory_tracing_by_environment() -> bool:
+    return os.environ.get(ENVIRONMENT_VARIABLE, '') == 'memory'
+
+
+def recorder() -> Optional[Recorder]:
+    return _recorder
+
+
+def stage(name: str) -> ContextManager[None]:
+    if _recorder is None:
+        return _NO_STAGE
+    return _recorder.stage(name)
+
+
+def count(name: str, amount: int = 1) -> None:
+    if _recorder is not None:
+        _recorder.count(name, amount)
+
+
+# Records nothing inside, e.g. for work repeated only to recover state, so the counts describe each step once.
+@contextmanager
+def suspended() -> Iterator[None]:
+    global _recorder
+    recorder = _recorder
+    _recorder = None
+    try:
+        yield
+    finally:
+        _recorder = recorder
+
+
+def write_table(file: Optional[TextIO] = None) -> None:
+    if _recorder is not None:
+        _recorder.write_table(file if file is not None else sys.stderr)
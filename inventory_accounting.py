@@ -1,7 +1,11 @@
-from typing import List, Final, Dict, TypeVar, Generic
+from typing import List, Final, Dict, TypeVar, Generic, Deque, Iterable, Iterator, Optional, Set, Tuple
+from abc import ABC, abstractmethod
 from datetime import datetime
 from model import *
-from collections import OrderedDict
+from collections import OrderedDict, deque
+import heapq
+import instrumentation
+from fixed_point import from_micros, to_micros
 
 _ROUNDING_TOLERANCE = 1e-6
 
@@ -34,17 +38,77 @@ class TradePartialMatch(Generic[T]):
         self.remaining_quantity = trade.quantity
 
 
-class Inventory(Dict[str, OrderedDict[datetime, TradePartialMatch[T]]]):
+# Open lots and balances carried from one match_trades call to the next, e.g. between yearly runs. Lots are held per
+# asset in matching order; fully matched lots are not kept.
+class InventoryState(Generic[T]):
+    def __init__(self) -> None:
+        self.open_lots: Dict[str, List[TradePartialMatch[T]]] = dict()
+        self.current_balance: CurrentBalance = CurrentBalance()
+
+    # Independent copy (new TradePartialMatch objects) of the given assets, or of every asset if asset_codes is None.
+    def copy(self, asset_codes: Optional[Set[str]] = None) -> 'InventoryState[T]':
+        state = InventoryState[T]()
+        for asset_code, lots in self.open_lots.items():
+            if asset_codes is None or asset_code in asset_codes:
+                state.open_lots[asset_code] = [_copy_lot(lot) for lot in lots]
+                state.current_balance[asset_code] = self.current_balance[asset_code]
+        return state
+
+    def update(self, other: 'InventoryState[T]') -> None:
+        self.open_lots.update(other.open_lots)
+        self.current_balance.update(other.current_balance)
+
+    def _set_lots(self, asset_code: str, lots: Iterable[TradePartialMatch[T]], balance: float) -> None:
+        open_lots = [lot for lot in lots if abs(lot.remaining_quantity) > _ROUNDING_TOLERANCE]
+        if len(open_lots) > 0:
+            self.open_lots[asset_code] = open_lots
+        else:
+            self.open_lots.pop(asset_code, None)
+        self.current_balance[asset_code] = balance
+
+
+def _copy_lot(lot: TradePartialMatch[T]) -> TradePartialMatch[T]:
+    copy = TradePartialMatch(lot.trade)
+    copy.remaining_quantity = lot.remaining_quantity
+    return copy
+
+
+# Open lots per asset, keyed by the trade's sequence number in the date-sorted trade stream. Keying by date would let
+# fills sharing a timestamp overwrite each other.
+class Inventory(Dict[str, OrderedDict[int, TradePartialMatch[T]]]):
     asset_code: str
-    trades: OrderedDict[datetime, TradePartialMatch[T]]
+    trades: OrderedDict[int, TradePartialMatch[T]]
+
+# Matches opening and closing trades (parcel identification). Engines differ only in which open lot a closing trade
+# is matched against; see FirstInFirstOutInventory and the lot selection engines below.
+class InventoryAccountant(ABC, Generic[T]):
+    # If state is given, matching continues from its open lots (which come before any of the trades) and state is
+    # updated with the lots left open at the end.
+    def match_trades(self, trades: Iterable[T], state: Optional[InventoryState[T]] = None) -> List[MatchedInventory[T]]:
+        # Static method to help with sorting
+        def get_date(t: Trade) -> datetime:
+            return t.date
+
+        return list(self.iter_match_trades(sorted(trades, key=get_date), state))
+
+    # Streaming form of match_trades: trades must already be in date order, and matches are yielded as each closing
+    # trade is processed. Only the open lots are held, so memory does not grow with the length of the history. The
+    # state update happens once the trades are exhausted.
+    @abstractmethod
+    def iter_match_trades(self,
+                          sorted_trades: Iterable[T],
+                          state: Optional[InventoryState[T]] = None) -> Iterator[MatchedInventory[T]]:
+        ...
+
 
 # Note: Generally FX must be FIFO: http://classic.austlii.edu.au/au/legis/cth/consol_act/itaa1997240/s775.145.html
 
-class FirstInFirstOutInventory(Generic[T]):
+class FirstInFirstOutInventory(InventoryAccountant[T]):
     def _record_matches(self,
                         current_balance: CurrentBalance,
-                        past_trades: OrderedDict[datetime, TradePartialMatch[T]],
-                        new_trade: TradePartialMatch[T]) -> List[MatchedInventory[T]]:
+                        past_trades: OrderedDict[int, TradePartialMatch[T]],
+                        new_trade: TradePartialMatch[T],
+                        sequence_number: int) -> List[MatchedInventory[T]]:
         matched_inventory: List[MatchedInventory[T]] = []
         trade_quantity_remaining = new_trade.remaining_quantity
         # If buy trade, check if short
@@ -103,32 +167,480 @@ class FirstInFirstOutInventory(Generic[T]):
 
         # If trade not fully matched, then remainder gets added to inventory.
         if abs(trade_quantity_remaining) > _ROUNDING_TOLERANCE:
-            past_trades[new_trade.trade.date] = new_trade
+            past_trades[sequence_number] = new_trade
 
         return matched_inventory
 
-    def match_trades(self, trades: List[T]) -> List[MatchedInventory[T]]:
-        # Static method to help with sorting
-        def get_date(t: Trade) -> datetime:
-            return t.date
-
-        sorted_trades = sorted(trades, key=get_date)
-        matched_inventory: List[MatchedInventory[T]] = []
+    # Trades are matched in date order. The sort is stable, so trades sharing a timestamp (e.g. partial fills reported
+    # to the second) are matched in the order they appear in the input, and an earlier fill is always closed first.
+    def iter_match_trades(self,
+                          sorted_trades: Iterable[T],
+                          state: Optional[InventoryState[T]] = None) -> Iterator[MatchedInventory[T]]:
         current_balance: CurrentBalance = CurrentBalance()  # str : float
-        inventory: Inventory[T] = Inventory[T]()  # str : {datetime, TradePartialMatch}
+        inventory: Inventory[T] = Inventory[T]()  # str : {int, TradePartialMatch}
+        if state is not None:
+            # Carried lots take the sequence numbers before the first new trade.
+            sequence_number = -sum(len(lots) for lots in state.open_lots.values())
+            for asset_code, lots in state.open_lots.items():
+                inventory[asset_code] = OrderedDict()
+                for lot in lots:
+                    inventory[asset_code][sequence_number] = lot
+                    sequence_number += 1
+                current_balance[asset_code] = state.current_balance[asset_code]
 
-        for trade in sorted_trades:
+        last_date: Optional[datetime] = None
+        for sequence_number, trade in enumerate(sorted_trades):
+            last_date = check_date_order(last_date, trade)
             if trade.asset_code not in inventory:
                 inventory[trade.asset_code] = OrderedDict()
             if len(inventory[trade.asset_code]) == 0:  # Simple case. No other trades, just add it to inventory.
-                inventory[trade.asset_code][trade.date] = TradePartialMatch(trade)
+                inventory[trade.asset_code][sequence_number] = TradePartialMatch(trade)
                 current_balance[trade.asset_code] = trade.quantity
             else:
-                matched_inventory.extend(
-                    self._record_matches(current_balance, inventory[trade.asset_code], TradePartialMatch(trade)))
+                yield from self._record_matches(current_balance,
+                                                inventory[trade.asset_code],
+                                                TradePartialMatch(trade),
+                                                sequence_number)
 
         for code in inventory:
-            for date in inventory[code]:
-                if abs(inventory[code][date].remaining_quantity) > _ROUNDING_TOLERANCE:
-                    print('unmatched inventory: ' + str(inventory[code][date].trade.date) + ' ' + str(inventory[code][date].remaining_quantity))
+            _count_open_lots(inventory[code].values())
+            if state is not None:
+                state._set_lots(code, inventory[code].values(), current_balance[code])
+
+
+# Lots left open at the end of a run, for instrumentation. The lots themselves are reported from the state at the end of
+# a run (see inventory_manager.write_open_lots_report).
+def _count_open_lots(lots: Iterable[TradePartialMatch[T]]) -> None:
+    if instrumentation.is_enabled():
+        instrumentation.count('unmatched_lots',
+                              sum(1 for lot in lots if abs(lot.remaining_quantity) > _ROUNDING_TOLERANCE))
+
+
+def check_date_order(last_date: Optional[datetime], trade: Trade) -> datetime:
+    if last_date is not None and trade.date < last_date:
+        raise ValueError("Trades must be in date order. " + str(trade.date) + " follows " + str(last_date) + ".")
+    return trade.date
+
+
+# Open lots for a single asset, one queue per side. Lots are appended in the order they are opened, so the front of
+# each queue is always the oldest open lot on that side.
+class OpenLots(Generic[T]):
+    def __init__(self) -> None:
+        self.long: Final[Deque[TradePartialMatch[T]]] = deque()
+        self.short: Final[Deque[TradePartialMatch[T]]] = deque()
+
+    def add(self, lot: TradePartialMatch[T]) -> None:
+        if lot.remaining_quantity > 0:
+            self.long.append(lot)
+        elif lot.remaining_quantity < 0:
+            self.short.append(lot)
+
+
+# Same matching as FirstInFirstOutInventory, but open lots are kept in a queue per side so that a new trade only ever
+# looks at lots it can close. Exhausted lots are popped from the front of the queue, so matching is amortised O(1)
+# per fill rather than a scan over every past trade of the asset.
+class QueuedFirstInFirstOutInventory(FirstInFirstOutInventory[T]):
+    def _match_lots(self,
+                    current_balance: CurrentBalance,
+                    open_lots: OpenLots[T],
+                    new_trade: TradePartialMatch[T]) -> List[MatchedInventory[T]]:
+        matched_inventory: List[MatchedInventory[T]] = []
+        asset_code = new_trade.trade.asset_code
+        trade_quantity_remaining = new_trade.remaining_quantity
+        # Direction of the new trade. Lets buys and sells share the one matching loop; multiplying by -1 is exact so
+        # the arithmetic is identical to the separate buy/sell branches in FirstInFirstOutInventory.
+        sign: float
+        opposite_lots: Deque[TradePartialMatch[T]]
+        if trade_quantity_remaining > _ROUNDING_TOLERANCE:
+            sign = 1
+            opposite_lots = open_lots.short
+        elif trade_quantity_remaining < -_ROUNDING_TOLERANCE:
+            sign = -1
+            opposite_lots = open_lots.long
+        else:
+            return matched_inventory
+
+        if sign * current_balance[asset_code] < -_ROUNDING_TOLERANCE:  # New trade closes an open position.
+            i = 0
+            while i < len(opposite_lots):
+                past_trade = opposite_lots[i]
+                if sign * past_trade.remaining_quantity < -_ROUNDING_TOLERANCE:
+                    closed_amount_past_trade = min(sign * trade_quantity_remaining, -sign * past_trade.remaining_quantity)
+                    closed_amount_current_balance = min(sign * trade_quantity_remaining,
+                                                        -sign * current_balance[asset_code])
+                    closed_amount = min(closed_amount_past_trade, closed_amount_current_balance)
+                    current_balance[asset_code] += sign * closed_amount
+                    past_trade.remaining_quantity += sign * closed_amount
+                    trade_quantity_remaining -= sign * closed_amount
+                    matched_inventory.append(MatchedInventory(past_trade.trade,
+                                                              new_trade.trade,
+                                                              closed_amount))
+
+                # If balance back to zero then just add rest to inventory.
+                if abs(current_balance[asset_code]) < _ROUNDING_TOLERANCE < abs(trade_quantity_remaining):
+                    current_balance[asset_code] += trade_quantity_remaining
+                    new_trade.remaining_quantity = trade_quantity_remaining
+
+                if abs(trade_quantity_remaining) < _ROUNDING_TOLERANCE:
+                    break
+                i += 1
+
+            # Drop lots that are now fully consumed.
+            while opposite_lots and sign * opposite_lots[0].remaining_quantity >= -_ROUNDING_TOLERANCE:
+                opposite_lots.popleft()
+        else:  # Not closing anything, so just add to inventory.
+            current_balance[asset_code] += trade_quantity_remaining
+
+        # If trade not fully matched, then remainder gets added to inventory.
+        if abs(trade_quantity_remaining) > _ROUNDING_TOLERANCE:
+            open_lots.add(new_trade)
+
         return matched_inventory
+
+    # Same tie-break and state handling as FirstInFirstOutInventory.iter_match_trades.
+    def iter_match_trades(self,
+                          sorted_trades: Iterable[T],
+                          state: Optional[InventoryState[T]] = None) -> Iterator[MatchedInventory[T]]:
+        current_balance: CurrentBalance = CurrentBalance()  # str : float
+        inventory: Dict[str, OpenLots[T]] = dict()
+        if state is not None:
+            for asset_code, lots in state.open_lots.items():
+                inventory[asset_code] = OpenLots[T]()
+                for lot in lots:
+                    inventory[asset_code].add(lot)
+                current_balance[asset_code] = state.current_balance[asset_code]
+
+        last_date: Optional[datetime] = None
+        for trade in sorted_trades:
+            last_date = check_date_order(last_date, trade)
+            if trade.asset_code not in inventory:  # Simple case. No other trades, just add it to inventory.
+                inventory[trade.asset_code] = OpenLots[T]()
+                inventory[trade.asset_code].add(TradePartialMatch(trade))
+                current_balance[trade.asset_code] = trade.quantity
+            else:
+                yield from self._match_lots(current_balance, inventory[trade.asset_code], TradePartialMatch(trade))
+
+        for code in inventory:
+            lots = list(inventory[code].long) + list(inventory[code].short)
+            _count_open_lots(lots)
+            if state is not None:
+                state._set_lots(code, lots, current_balance[code])
+
+
+# FIFO matching on exact integers (see fixed_point.py). Each trade's quantity is rounded to micros once, as it is taken
+# in, and from then on lots are opened and closed with int arithmetic: there is no tolerance, and a lot is closed when
+# its remainder is exactly zero, so remainders cannot drift over a long history. Matches and the lots left in state
+# carry micro-aligned float quantities.
+class FixedPointFirstInFirstOutInventory(FirstInFirstOutInventory[T]):
+    def iter_match_trades(self,
+                          sorted_trades: Iterable[T],
+                          state: Optional[InventoryState[T]] = None) -> Iterator[MatchedInventory[T]]:
+        # Lots and balances in micros. State is only changed at the end.
+        balances: Dict[str, int] = dict()
+        inventory: Dict[str, _MicroLots[T]] = dict()
+        if state is not None:
+            for asset_code, lots in state.open_lots.items():
+                inventory[asset_code] = _MicroLots[T]()
+                for lot in lots:
+                    inventory[asset_code].add(_MicroLot(lot.trade, to_micros(lot.remaining_quantity)))
+                balances[asset_code] = to_micros(state.current_balance[asset_code])
+
+        last_date: Optional[datetime] = None
+        for trade in sorted_trades:
+            last_date = check_date_order(last_date, trade)
+            open_lots = inventory.get(trade.asset_code)
+            if open_lots is None:
+                open_lots = _MicroLots[T]()
+                inventory[trade.asset_code] = open_lots
+            quantity = to_micros(trade.quantity)
+            balances[trade.asset_code] = balances.get(trade.asset_code, 0) + quantity
+            sign = 1 if quantity > 0 else -1
+            opposite_lots = open_lots.short if quantity > 0 else open_lots.long
+            while quantity != 0 and opposite_lots:
+                past_lot = opposite_lots[0]
+                closed_amount = min(sign * quantity, -sign * past_lot.remaining_micros)
+                past_lot.remaining_micros += sign * closed_amount
+                quantity -= sign * closed_amount
+                # Rounding a trade to micros can take it up to half a micro past its float quantity.
+                yield MatchedInventory(past_lot.trade, trade, min(from_micros(closed_amount),
+                                                                  abs(past_lot.trade.quantity),
+                                                                  abs(trade.quantity)))
+                if past_lot.remaining_micros == 0:
+                    opposite_lots.popleft()
+            if quantity != 0:
+                open_lots.add(_MicroLot(trade, quantity))
+
+        for code in inventory:
+            open_lots = inventory[code]
+            end_lots: List[TradePartialMatch[T]] = []
+            for micro_lot in list(open_lots.long) + list(open_lots.short):
+                lot = TradePartialMatch(micro_lot.trade)
+                lot.remaining_quantity = from_micros(micro_lot.remaining_micros)
+                end_lots.append(lot)
+            instrumentation.count('unmatched_lots', len(end_lots))
+            # Not _set_lots, whose tolerance would drop a lot of a single micro.
+            if state is not None:
+                if len(end_lots) > 0:
+                    state.open_lots[code] = end_lots
+                else:
+                    state.open_lots.pop(code, None)
+                state.current_balance[code] = from_micros(balances[code])
+
+
+# An open lot of FixedPointFirstInFirstOutInventory, with its remainder in micros.
+class _MicroLot(Generic[T]):
+    __slots__ = ('trade', 'remaining_micros')
+
+    def __init__(self, trade: T, remaining_micros: int):
+        self.trade: Final[T] = trade
+        self.remaining_micros: int = remaining_micros
+
+
+# Open lots for a single asset in micros, one queue per side (see OpenLots).
+class _MicroLots(Generic[T]):
+    def __init__(self) -> None:
+        self.long: Final[Deque[_MicroLot[T]]] = deque()
+        self.short: Final[Deque[_MicroLot[T]]] = deque()
+
+    def add(self, lot: _MicroLot[T]) -> None:
+        if lot.remaining_micros > 0:
+            self.long.append(lot)
+        elif lot.remaining_micros < 0:
+            self.short.append(lot)
+
+
+# Open lots on one side (long or short) of one asset, held in the order a lot selection engine closes them. Lots are
+# added with their sequence number in the trade stream, which gives the opening order.
+class LotBook(ABC, Generic[T]):
+    @abstractmethod
+    def add(self, sequence_number: int, lot: TradePartialMatch[T]) -> None:
+        ...
+
+    # The lot closing_trade should be matched against next, or None if the book is empty.
+    @abstractmethod
+    def next_lot(self, closing_trade: T) -> Optional[TradePartialMatch[T]]:
+        ...
+
+    # Removes the lot last returned by next_lot, once it is fully closed.
+    @abstractmethod
+    def pop_lot(self) -> None:
+        ...
+
+    # Open lots with their sequence numbers, in any order.
+    @abstractmethod
+    def open_lots(self) -> List[Tuple[int, TradePartialMatch[T]]]:
+        ...
+
+
+class FirstInFirstOutLotBook(LotBook[T]):
+    def __init__(self) -> None:
+        self._lots: Final[Deque[Tuple[int, TradePartialMatch[T]]]] = deque()
+
+    def add(self, sequence_number: int, lot: TradePartialMatch[T]) -> None:
+        self._lots.append((sequence_number, lot))
+
+    def next_lot(self, closing_trade: T) -> Optional[TradePartialMatch[T]]:
+        return self._lots[0][1] if self._lots else None
+
+    def pop_lot(self) -> None:
+        self._lots.popleft()
+
+    def open_lots(self) -> List[Tuple[int, TradePartialMatch[T]]]:
+        return list(self._lots)
+
+
+class LastInFirstOutLotBook(LotBook[T]):
+    def __init__(self) -> None:
+        self._lots: Final[List[Tuple[int, TradePartialMatch[T]]]] = []
+
+    def add(self, sequence_number: int, lot: TradePartialMatch[T]) -> None:
+        self._lots.append((sequence_number, lot))
+
+    def next_lot(self, closing_trade: T) -> Optional[TradePartialMatch[T]]:
+        return self._lots[-1][1] if self._lots else None
+
+    def pop_lot(self) -> None:
+        self._lots.pop()
+
+    def open_lots(self) -> List[Tuple[int, TradePartialMatch[T]]]:
+        return list(self._lots)
+
+
+# Heap on translated price (price for untranslated trades), highest first; equal prices close oldest first. Gains are
+# closing minus opening price on both sides, so closing the highest priced lot first gives the smallest gain whether
+# the position is long or short.
+class HighestInFirstOutLotBook(LotBook[T]):
+    def __init__(self) -> None:
+        self._lots: Final[List[Tuple[float, int, TradePartialMatch[T]]]] = []
+
+    def add(self, sequence_number: int, lot: TradePartialMatch[T]) -> None:
+        cost: float = lot.trade.translated_price if isinstance(lot.trade, TranslatedTrade) else lot.trade.price
+        heapq.heappush(self._lots, (-cost, sequence_number, lot))
+
+    def next_lot(self, closing_trade: T) -> Optional[TradePartialMatch[T]]:
+        return self._lots[0][2] if self._lots else None
+
+    def pop_lot(self) -> None:
+        heapq.heappop(self._lots)
+
+    def open_lots(self) -> List[Tuple[int, TradePartialMatch[T]]]:
+        return [(sequence_number, lot) for _, sequence_number, lot in self._lots]
+
+
+# Closes the lots nominated for each closing trade first, in the order given, then falls back to FIFO for any
+# quantity left over. selections maps a closing trade date to the dates of the opening trades to close.
+class SpecificIdentificationLotBook(LotBook[T]):
+    def __init__(self, selections: Dict[datetime, List[datetime]]):
+        self._selections: Final = selections
+        self._lots: Final[OrderedDict[int, TradePartialMatch[T]]] = OrderedDict()
+        self._by_date: Final[Dict[datetime, List[int]]] = dict()
+        self._next_sequence_number: int = 0
+
+    def add(self, sequence_number: int, lot: TradePartialMatch[T]) -> None:
+        self._lots[sequence_number] = lot
+        self._by_date.setdefault(lot.trade.date, []).append(sequence_number)
+
+    def next_lot(self, closing_trade: T) -> Optional[TradePartialMatch[T]]:
+        for opening_date in self._selections.get(closing_trade.date, []):
+            sequence_numbers = self._by_date.get(opening_date)
+            if sequence_numbers:
+                self._next_sequence_number = sequence_numbers[0]
+                return self._lots[self._next_sequence_number]
+        if not self._lots:
+            return None
+        self._next_sequence_number = next(iter(self._lots))
+        return self._lots[self._next_sequence_number]
+
+    def pop_lot(self) -> None:
+        lot = self._lots.pop(self._next_sequence_number)
+        self._by_date[lot.trade.date].remove(self._next_sequence_number)
+
+    def open_lots(self) -> List[Tuple[int, TradePartialMatch[T]]]:
+        return list(self._lots.items())
+
+
+# Long and short lot books for one asset.
+class Positions(Generic[T]):
+    def __init__(self, long: LotBook[T], short: LotBook[T]):
+        self.long: Final[LotBook[T]] = long
+        self.short: Final[LotBook[T]] = short
+
+    def add(self, sequence_number: int, lot: TradePartialMatch[T]) -> None:
+        if lot.remaining_quantity > 0:
+            self.long.add(sequence_number, lot)
+        elif lot.remaining_quantity < 0:
+            self.short.add(sequence_number, lot)
+
+    # Open lots of both sides in opening order.
+    def open_lots(self) -> List[TradePartialMatch[T]]:
+        def get_sequence_number(entry: Tuple[int, TradePartialMatch[T]]) -> int:
+            return entry[0]
+
+        return [lot for _, lot in sorted(self.long.open_lots() + self.short.open_lots(), key=get_sequence_number)]
+
+
+# Shared matching core for the lot selection engines: a closing trade is matched against lots from the opposite side's
+# book, in the order the book gives them, until it is fully matched or the book is empty; any remainder opens a lot.
+# Subclasses only choose the book. FOREX assets always get a FIFO book (see the s775.145 note above), whichever engine
+# is used.
+class LotSelectionInventory(InventoryAccountant[T]):
+    @abstractmethod
+    def _new_book(self, asset_code: str) -> LotBook[T]:
+        ...
+
+    def _new_positions(self, trade: T) -> Positions[T]:
+        if trade.asset_category == 'FOREX':
+            return Positions[T](FirstInFirstOutLotBook[T](), FirstInFirstOutLotBook[T]())
+        return Positions[T](self._new_book(trade.asset_code), self._new_book(trade.asset_code))
+
+    def iter_match_trades(self,
+                          sorted_trades: Iterable[T],
+                          state: Optional[InventoryState[T]] = None) -> Iterator[MatchedInventory[T]]:
+        current_balance: CurrentBalance = CurrentBalance()
+        inventory: Dict[str, Positions[T]] = dict()
+        if state is not None:
+            # Carried lots take the sequence numbers before the first new trade.
+            sequence_number = -sum(len(lots) for lots in state.open_lots.values())
+            for asset_code, lots in state.open_lots.items():
+                for lot in lots:
+                    if asset_code not in inventory:
+                        inventory[asset_code] = self._new_positions(lot.trade)
+                    inventory[asset_code].add(sequence_number, lot)
+                    sequence_number += 1
+                current_balance[asset_code] = state.current_balance[asset_code]
+
+        last_date: Optional[datetime] = None
+        for sequence_number, trade in enumerate(sorted_trades):
+            last_date = check_date_order(last_date, trade)
+            positions = inventory.get(trade.asset_code)
+            if positions is None:
+                positions = self._new_positions(trade)
+                inventory[trade.asset_code] = positions
+            current_balance[trade.asset_code] = current_balance.get(trade.asset_code, 0) + trade.quantity
+
+            trade_quantity_remaining = trade.quantity
+            sign = 1 if trade_quantity_remaining > 0 else -1
+            opposite_lots = positions.short if sign > 0 else positions.long
+            while sign * trade_quantity_remaining > _ROUNDING_TOLERANCE:
+                past_trade = opposite_lots.next_lot(trade)
+                if past_trade is None:
+                    break
+                closed_amount = min(sign * trade_quantity_remaining, -sign * past_trade.remaining_quantity)
+                past_trade.remaining_quantity += sign * closed_amount
+                trade_quantity_remaining -= sign * closed_amount
+                yield MatchedInventory(past_trade.trade, trade, closed_amount)
+                if abs(past_trade.remaining_quantity) < _ROUNDING_TOLERANCE:
+                    opposite_lots.pop_lot()
+
+            if abs(trade_quantity_remaining) > _ROUNDING_TOLERANCE:
+                new_lot = TradePartialMatch(trade)
+                new_lot.remaining_quantity = trade_quantity_remaining
+                positions.add(sequence_number, new_lot)
+
+        for code in inventory:
+            open_lots = inventory[code].open_lots()
+            _count_open_lots(open_lots)
+            if state is not None:
+                state._set_lots(code, open_lots, current_balance[code])
+
+
+class LastInFirstOutInventory(LotSelectionInventory[T]):
+    def _new_book(self, asset_code: str) -> LotBook[T]:
+        return LastInFirstOutLotBook[T]()
+
+
+class HighestInFirstOutInventory(LotSelectionInventory[T]):
+    def _new_book(self, asset_code: str) -> LotBook[T]:
+        return HighestInFirstOutLotBook[T]()
+
+
+# selections maps (asset code, closing trade date) to the dates of the opening trades to close, in order.
+class SpecificIdentificationInventory(LotSelectionInventory[T]):
+    def __init__(self, selections: Dict[Tuple[str, datetime], List[datetime]]):
+        self._selections: Final[Dict[str, Dict[datetime, List[datetime]]]] = dict()
+        for (asset_code, closing_date), opening_dates in selections.items():
+            self._selections.setdefault(asset_code, dict())[closing_date] = opening_dates
+
+    def _new_book(self, asset_code: str) -> LotBook[T]:
+        return SpecificIdentificationLotBook[T](self._selections.get(asset_code, dict()))
+
+
+# Names of the engines that new_inventory_accountant builds.
+ENGINES: Final[List[str]] = ['fifo', 'lifo', 'hifo', 'specific']
+
+
+# selections are only used by, and required for, the 'specific' engine (see SpecificIdentificationInventory).
+def new_inventory_accountant(engine: str,
+                             selections: Optional[Dict[Tuple[str, datetime], List[datetime]]] = None) \
+        -> InventoryAccountant[TranslatedTrade]:
+    if engine == 'fifo':
+        return QueuedFirstInFirstOutInventory[TranslatedTrade]()
+    if engine == 'lifo':
+        return LastInFirstOutInventory[TranslatedTrade]()
+    if engine == 'hifo':
+        return HighestInFirstOutInventory[TranslatedTrade]()
+    if engine == 'specific':
+        if selections is None:
+            raise ValueError("Specific identification requires lot selections.")
+        return SpecificIdentificationInventory[TranslatedTrade](selections)
+    raise ValueError("Unknown inventory engine: " + engine)
@@ -1,36 +1,79 @@
-# from typing import List
-# from collections import OrderedDict
-# from datetime import datetime
-#
-# from model import *
-#
-#
-# # class Inventory(TypedDict):
-# #     asset_code : str
-# #     trades : OrderedDict[datetime, Trade] = OrderedDict()
-#
-# # Keeps track of inventory balances by asset and date.
-# class MutableInventoryManager:
-#     def __init__(self, initial_inventory: List[Trade]):
-#         inventory: Inventory
-#         for trade in initial_inventory:
-#             if trade.asset_code not in inventory:
-#                 inventory[trade.asset_code] = OrderedDict()
-#             if trade.date in inventory[trade.asset_code]:  # Not sure how to handle this yet.
-#                 raise ValueError("Trades cannot occur at exactly the same time. Duplicate time used.")
-#             inventory[trade.asset_code][trade.date] = trade
-#         self._inventory_flows: Inventory = inventory
-#         # self._inventory_to_match = Inventory(inventory)
-#
-#     # Removes a closed trade from matched inventory.
-#     # def match_trade(self, trade : Trade):
-#
-#     # Gets balance at date (inclusive).
-#     def get_balance(self, asset_code: str, date: datetime) -> float:
-#         flows: OrderedDict[datetime, Trade] = self._inventory_flows[asset_code]
-#         total_balance: float = 0
-#         for trade in flows.values():
-#             if trade.date > date:
-#                 break
-#             total_balance += trade.quantity
-#         return total_balance
+import math
+from datetime import datetime
+from typing import Dict, Final, Iterable, List, Optional, Sequence, TextIO
+
+import numpy as np
+import numpy.typing as npt
+
+from inventory_accounting import InventoryState, T
+from model import Trade
+
+
+# Balance of each asset at any date, e.g. to reconcile positions against broker statements. Built once from the trade
+# stream: per asset, trade dates in order and the running balance after each trade, so a balance at a date is a binary
+# search. Balances are summed in trade order, starting from the opening balance, so they are exactly what summing the
+# quantities one by one up to the date gives.
+class BalanceIndex:
+    def __init__(self, trades: Iterable[Trade], opening_balances: Optional[Dict[str, float]] = None):
+        self.opening_balances: Final[Dict[str, float]] = dict(opening_balances) if opening_balances is not None \
+            else dict()
+        dates: Dict[str, List[datetime]] = dict()
+        quantities: Dict[str, List[float]] = dict()
+        for trade in trades:
+            dates.setdefault(trade.asset_code, []).append(trade.date)
+            quantities.setdefault(trade.asset_code, []).append(trade.quantity)
+
+        self._dates: Final[Dict[str, npt.NDArray[np.datetime64]]] = dict()
+        # Balance before the first trade, then after each trade, so searchsorted's index is the position to read.
+        self._balances: Final[Dict[str, npt.NDArray[np.float64]]] = dict()
+        for asset_code in list(self.opening_balances) + [code for code in dates if code not in self.opening_balances]:
+            asset_dates = np.array(dates.get(asset_code, []), dtype='datetime64[us]')
+            order = np.argsort(asset_dates, kind='stable')
+            self._dates[asset_code] = asset_dates[order]
+            asset_quantities = np.array(quantities.get(asset_code, []), dtype=np.float64)[order]
+            opening = np.array([self.opening_balances.get(asset_code, 0.0)], dtype=np.float64)
+            self._balances[asset_code] = np.cumsum(np.concatenate((opening, asset_quantities)))
+
+    @property
+    def asset_codes(self) -> List[str]:
+        return list(self._balances)
+
+    # Balance after every trade up to and including date.
+    def get_balance(self, asset_code: str, date: datetime) -> float:
+        balances = self._balances.get(asset_code)
+        if balances is None:
+            return 0.0
+        return float(balances[np.searchsorted(self._dates[asset_code], np.datetime64(date, 'us'), side='right')])
+
+    # get_balance for each of dates, in one search.
+    def get_balances(self, asset_code: str, dates: Sequence[datetime]) -> npt.NDArray[np.float64]:
+        balances = self._balances.get(asset_code)
+        if balances is None:
+            return np.zeros(len(dates))
+        queries: npt.NDArray[np.datetime64] = np.array(dates, dtype='datetime64[us]')
+        return balances[np.searchsorted(self._dates[asset_code], queries, side='right')]
+
+    # Balance after the last trade.
+    def get_final_balance(self, asset_code: str) -> float:
+        balances = self._balances.get(asset_code)
+        return float(balances[-1]) if balances is not None else 0.0
+
+
+# End of run report of the lots left open in state, one line per lot. With a balance index over the run's trades
+# (including the FX proceeds trades, and opening from the balances state started with), each asset's open lots are
+# also checked against its final balance, and any asset whose lots do not add up to it is reported.
+def write_open_lots_report(file: TextIO,
+                           state: InventoryState[T],
+                           balance_index: Optional[BalanceIndex] = None) -> None:
+    for asset_code, lots in state.open_lots.items():
+        for lot in lots:
+            print('unmatched inventory: ' + asset_code + ' ' + str(lot.trade.date) + ' ' + str(lot.remaining_quantity),
+                  file=file)
+    if balance_index is None:
+        return
+    for asset_code in balance_index.asset_codes:
+        open_quantity = sum(lot.remaining_quantity for lot in state.open_lots.get(asset_code, []))
+        balance = balance_index.get_final_balance(asset_code)
+        if not math.isclose(open_quantity, balance, rel_tol=1e-9, abs_tol=1e-6):
+            print('balance mismatch: ' + asset_code + ' open lots ' + str(open_quantity) + ', trades ' + str(balance),
+                  file=file)
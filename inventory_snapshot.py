@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os
+from datetime import datetime
+from typing import Dict, Final, List, Optional, Union, cast
+
+from inventory_accounting import InventoryState, TradePartialMatch
+from model import Amount, Trade, TranslatedTrade
+from proceeds_calculator import RematchPoint
+
+# Bump when the on-disk layout changes. Snapshots written with another version are rejected rather than guessed at.
+SNAPSHOT_VERSION = 2
+
+JsonValue = Union[str, int, float, bool, None, Dict[str, 'JsonValue'], List['JsonValue']]
+
+
+# A statement that has already been processed into a snapshot. Statements are recognised by content hash, so a
+# renamed or moved statement is not processed twice.
+class ProcessedStatement:
+    def __init__(self, file_path: str, sha256: str):
+        self.file_path: Final = file_path
+        self.sha256: Final = sha256
+
+    @staticmethod
+    def from_file(file_path: str) -> 'ProcessedStatement':
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+        return ProcessedStatement(file_path, digest.hexdigest())
+
+
+# End-of-run state needed to resume matching in a later run without replaying the full history: the open lots and
+# balances per asset, the capital losses still to be carried forward, the statements already processed and the date of
+# the last trade processed. New trades must be dated after as_of. opening_capital_losses are the losses the history
+# started with, kept so the history can be replayed from scratch.
+# A later run resumes from rematch, with the losses carried before its date (see
+# ForeignCurrencyProceedsCalculator.calculate_from). Without one, it resumes from the open lots and carried losses.
+class InventorySnapshot:
+    def __init__(self,
+                 as_of: Optional[datetime],
+                 processed_statements: List[ProcessedStatement],
+                 inventory: InventoryState[TranslatedTrade],
+                 carried_capital_losses: float,
+                 opening_capital_losses: float,
+                 rematch: Optional[RematchPoint] = None,
+                 rematch_capital_losses: Optional[float] = None):
+        self.as_of: Final = as_of
+        self.processed_statements: Final = processed_statements
+        self.inventory: Final = inventory
+        self.carried_capital_losses: Final = carried_capital_losses
+        self.opening_capital_losses: Final = opening_capital_losses
+        self.rematch: Final = rematch if rematch is not None else RematchPoint(None, inventory.copy())
+        self.rematch_capital_losses: Final = rematch_capital_losses if rematch_capital_losses is not None \
+            else carried_capital_losses
+
+    def is_processed(self, statement: ProcessedStatement) -> bool:
+        return any(processed.sha256 == statement.sha256 for processed in self.processed_statements)
+
+
+def _trade_to_json(trade: TranslatedTrade) -> Dict[str, JsonValue]:
+    return {'asset_code': trade.asset_code,
+            'asset_category': trade.asset_category,
+            'date': trade.date.isoformat(),
+            'price': trade.price,
+            'currency': trade.currency,
+            'quantity': trade.quantity,
+            'commission': trade.commission.value,
+            'commission_currency': trade.commission.currency,
+            'source': trade.source,
+            'translated_price': trade.translated_price,
+            'exchange_rate': trade.exchange_rate,
+            'translated_commission': trade.translated_commission,
+            'translated_currency': trade.translated_currency}
+
+
+def _trade_from_json(values: Dict[str, JsonValue]) -> TranslatedTrade:
+    trade = Trade(str(values['asset_code']),
+                  str(values['asset_category']),
+                  datetime.fromisoformat(str(values['date'])),
+                  _number(values['price']),
+                  str(values['currency']),
+                  _number(values['quantity']),
+                  Amount(_number(values['commission']), str(values['commission_currency'])),
+                  str(values['source']))
+    return TranslatedTrade(trade,
+                           _number(values['translated_price']),
+                           _number(values['exchange_rate']),
+                           _number(values['translated_commission']),
+                           str(values['translated_currency']))
+
+
+def _state_to_json(state: InventoryState[TranslatedTrade]) -> Dict[str, JsonValue]:
+    open_lots: Dict[str, JsonValue] = dict()
+    for asset_code, lots in state.open_lots.items():
+        open_lots[asset_code] = [{'trade': _trade_to_json(lot.trade), 'remaining_quantity': lot.remaining_quantity}
+                                 for lot in lots]
+    return {'current_balance': dict(state.current_balance), 'open_lots': open_lots}
+
+
+def _state_from_json(values: Dict[str, JsonValue]) -> InventoryState[TranslatedTrade]:
+    state = InventoryState[TranslatedTrade]()
+    for asset_code, balance in _object(values['current_balance']).items():
+        state.current_balance[asset_code] = _number(balance)
+    for asset_code, lots in _object(values['open_lots']).items():
+        state.open_lots[asset_code] = []
+        for lot in _array(lots):
+            partial_match = TradePartialMatch(_trade_from_json(_object(_object(lot)['trade'])))
+            partial_match.remaining_quantity = _number(_object(lot)['remaining_quantity'])
+            state.open_lots[asset_code].append(partial_match)
+    return state
+
+
+def _date_from_json(value: JsonValue) -> Optional[datetime]:
+    return datetime.fromisoformat(str(value)) if value is not None else None
+
+
+def _number(value: JsonValue) -> float:
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError("Expected a number in snapshot, found: " + repr(value))
+    return value
+
+
+def _object(value: JsonValue) -> Dict[str, JsonValue]:
+    if not isinstance(value, dict):
+        raise ValueError("Expected an object in snapshot, found: " + repr(value))
+    return value
+
+
+def _array(value: JsonValue) -> List[JsonValue]:
+    if not isinstance(value, list):
+        raise ValueError("Expected an array in snapshot, found: " + repr(value))
+    return value
+
+
+# Floats are written with repr precision, so a snapshot reloads to exactly the values that were saved.
+def write_snapshot(file_path: str, snapshot: InventorySnapshot) -> None:
+    rematch = _state_to_json(snapshot.rematch.state)
+    rematch['date'] = snapshot.rematch.date.isoformat() if snapshot.rematch.date is not None else None
+    rematch['trades'] = [_trade_to_json(trade) for trade in snapshot.rematch.trades]
+    rematch['carried_capital_losses'] = snapshot.rematch_capital_losses
+    document: Dict[str, JsonValue] = {
+        'version': SNAPSHOT_VERSION,
+        'as_of': snapshot.as_of.isoformat() if snapshot.as_of is not None else None,
+        'processed_statements': [{'file_path': statement.file_path, 'sha256': statement.sha256}
+                                 for statement in snapshot.processed_statements],
+        'carried_capital_losses': snapshot.carried_capital_losses,
+        'opening_capital_losses': snapshot.opening_capital_losses,
+        'rematch': rematch}
+    document.update(_state_to_json(snapshot.inventory))
+    temporary_path = file_path + '.tmp'
+    with open(temporary_path, 'w') as file:
+        json.dump(document, file, indent=1)
+    os.replace(temporary_path, file_path)
+
+
+def read_snapshot(file_path: str) -> InventorySnapshot:
+    with open(file_path) as file:
+        document = _object(cast(JsonValue, json.load(file)))
+    if document.get('version') != SNAPSHOT_VERSION:
+        raise ValueError("Unsupported inventory snapshot version: " + str(document.get('version')))
+
+    rematch = _object(document['rematch'])
+    return InventorySnapshot(_date_from_json(document['as_of']),
+                             [ProcessedStatement(str(_object(statement)['file_path']),
+                                                 str(_object(statement)['sha256']))
+                              for statement in _array(document['processed_statements'])],
+                             _state_from_json(document),
+                             _number(document['carried_capital_losses']),
+                             _number(document['opening_capital_losses']),
+                             RematchPoint(_date_from_json(rematch['date']),
+                                          _state_from_json(rematch),
+                                          [_trade_from_json(_object(trade)) for trade in _array(rematch['trades'])]),
+                             _number(rematch['carried_capital_losses']))
@@ -1,42 +1,362 @@
-import sys
+import argparse
+import csv
 import fnmatch
+import json
 import os
-from typing import List
+import sys
+from datetime import datetime
+from typing import Final, List, Dict, Set, Optional, Tuple, Iterator
 
-from capital_gains_tax import DiscountCapitalGainsTaxMethod, CapitalGainsTax, CapitalGainsTaxAggregator
-from foreign_asset_translator import ForeignAssetTranslator
-from read_writer import InteractiveBrokersReadWriter
-from inventory_accounting import FirstInFirstOutInventory, MatchedInventory
-from proceeds_calculator import ForeignCurrencyProceedsCalculator
+from capital_gains_tax import DiscountCapitalGainsTaxMethod, CapitalGainsTax, CapitalGainsTaxAggregator, \
+    CapitalGainsTaxMethod, FixedPointDiscountCapitalGainsTaxMethod
+from foreign_asset_translator import ForeignAssetTranslator, required_rate_codes
+from read_writer import InteractiveBrokersReadWriter, OutputWriter, read_trade_files
+from columnar_writer import ColumnarWriter
+from inventory_accounting import MatchedInventory, InventoryState, ENGINES, new_inventory_accountant, \
+    FixedPointFirstInFirstOutInventory, FirstInFirstOutInventory, InventoryAccountant
+from inventory_manager import BalanceIndex, write_open_lots_report
+from inventory_snapshot import InventorySnapshot, ProcessedStatement, read_snapshot, write_snapshot
+from proceeds_calculator import ForeignCurrencyProceedsCalculator, RematchPoint
+from rate_cache import RbaRateCache
+import instrumentation
+from scenarios import Scenario, format_scenario_table, run_scenarios
+from sharded_matching import ShardedInventoryAccountant
 from model import Trade, TranslatedTrade
 
 
+# Parsed command line. The options are declared here so that they are typed where they are read.
+class _Arguments(argparse.Namespace):
+    trade_file: Optional[str]
+    existing_capital_losses: float
+    jobs: int
+    rate_cache: bool
+    snapshot: Optional[str]
+    output_format: str
+    verify_snapshot: bool
+    engine: str
+    lot_selections: Optional[str]
+    scenario: Optional[List[str]]
+    fixed_point: bool
+    net_commissions: bool
+    instrument: bool
+    instrument_memory: bool
+    instrument_json: Optional[str]
+
+
+def _parse_arguments() -> _Arguments:
+    parser = argparse.ArgumentParser(description='Calculates capital gains for a series of trades.')
+    parser.add_argument('trade_file', nargs='?',
+                        help='Statement to process. Defaults to ./test_data/test_trades_*.csv.')
+    parser.add_argument('existing_capital_losses', nargs='?', type=float, default=0,
+                        help='Capital losses carried into the run, as a negative number.')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Number of processes used to parse statements and to match trades, split by asset.')
+    parser.add_argument('--rate-cache', action='store_true',
+                        help='Load RBA rates from a compiled sidecar next to the rates csv, rebuilding it when the '
+                             'csv changes.')
+    parser.add_argument('--snapshot', metavar='PATH',
+                        help='Resume from the inventory snapshot at PATH, skipping statements it already covers, and '
+                             'write the updated snapshot back to PATH.')
+    parser.add_argument('--output-format', choices=('csv', 'columnar'), default='csv',
+                        help='columnar writes typed Parquet files if pyarrow is installed, .npz archives otherwise.')
+    parser.add_argument('--verify-snapshot', action='store_true',
+                        help='Also replay every statement from scratch and report any difference from the resumed '
+                             'run. Exits with status 1 on a mismatch.')
+    parser.add_argument('--engine', choices=ENGINES, default='fifo',
+                        help='Lot selection for closing trades: first in first out, last in first out, highest cost '
+                             'first or specific identification. FX is always first in first out.')
+    parser.add_argument('--lot-selections', metavar='PATH',
+                        help='For --engine specific: csv of asset_code, close date, open date rows nominating the lots '
+                             'each closing trade closes, in order. Unnominated quantity is closed first in first out.')
+    parser.add_argument('--scenario', action='append', metavar='ENGINE[:LOSSES]',
+                        help='Instead of writing gains, compare scenarios: each is an engine and, optionally, the '
+                             'capital losses to start from. Repeat for each scenario; they run in --jobs processes '
+                             'over trades translated once.')
+    parser.add_argument('--fixed-point', action='store_true',
+                        help='Read statement numbers as exact decimals and match and tax in integer micro-units, so '
+                             'lots close exactly. First in first out only.')
+    parser.add_argument('--net-commissions', action='store_true',
+                        help='Net the foreign currency commissions of each currency on each day into a single FX lot. '
+                             'Fewer lots to match, at the cost of slightly different FX gains.')
+    parser.add_argument('--instrument', action='store_true',
+                        help='Report wall time and CPU time per stage, row, lookup, match and unmatched lot counts, '
+                             'and peak RSS, on stderr. Also enabled by setting '
+                             + instrumentation.ENVIRONMENT_VARIABLE + '=1.')
+    parser.add_argument('--instrument-memory', action='store_true',
+                        help='Instrument, also tracing peak memory per stage. Tracing slows allocation heavy stages, '
+                             'so their timings are not comparable with --instrument ones. Also enabled by setting '
+                             + instrumentation.ENVIRONMENT_VARIABLE + '=memory.')
+    parser.add_argument('--instrument-json', metavar='PATH',
+                        help='Write the instrumentation report to PATH as JSON instead of to stderr.')
+    return parser.parse_args(namespace=_Arguments())
+
+
+def _read_lot_selections(file_path: str) -> Dict[Tuple[str, datetime], List[datetime]]:
+    selections: Dict[Tuple[str, datetime], List[datetime]] = dict()
+    with open(file_path, newline='') as file:
+        reader = csv.reader(file, delimiter=',', quotechar='"')
+        header: List[str] = next(reader, [])
+        for values in reader:
+            row: Dict[str, str] = dict(zip(header, values))
+            selections.setdefault((row['asset_code'], datetime.fromisoformat(row['close_date'])), []) \
+                .append(datetime.fromisoformat(row['open_date']))
+    return selections
+
+
+def _lot_selections(arguments: _Arguments) -> Optional[Dict[Tuple[str, datetime], List[datetime]]]:
+    return _read_lot_selections(arguments.lot_selections) if arguments.lot_selections is not None else None
+
+
+def _proceeds_calculator(arguments: _Arguments) -> ForeignCurrencyProceedsCalculator:
+    if arguments.fixed_point:
+        if arguments.engine != 'fifo':
+            raise ValueError("--fixed-point only supports --engine fifo.")
+        inventory_accountant: InventoryAccountant[TranslatedTrade] = \
+            FixedPointFirstInFirstOutInventory[TranslatedTrade]()
+        fx_inventory_accountant: Optional[FirstInFirstOutInventory[TranslatedTrade]] = \
+            FixedPointFirstInFirstOutInventory[TranslatedTrade]()
+    else:
+        inventory_accountant = new_inventory_accountant(arguments.engine, _lot_selections(arguments))
+        fx_inventory_accountant = None
+    # FX assets are few, so only the first pass over the underlying assets is sharded.
+    return ForeignCurrencyProceedsCalculator(ShardedInventoryAccountant(inventory_accountant, arguments.jobs),
+                                             fx_inventory_accountant, arguments.net_commissions)
+
+
+def _tax_method(arguments: _Arguments) -> CapitalGainsTaxMethod:
+    return FixedPointDiscountCapitalGainsTaxMethod() if arguments.fixed_point else DiscountCapitalGainsTaxMethod()
+
+
+# Translates, matches and taxes the given trades, continuing from start (see
+# ForeignCurrencyProceedsCalculator.calculate_from) and the losses carried before it. state is left holding the open
+# lots. Gains, including those re-matched from start's trades, are calculated lazily as they are consumed; the
+# aggregator holds the losses carried after the last one. Also returns the rematch point for the next run.
+def _calculate_gains(trades: List[Trade],
+                     rba_rates: Dict[str, Dict[datetime, float]],
+                     start: RematchPoint,
+                     state: InventoryState[TranslatedTrade],
+                     capital_gains_aggregator: CapitalGainsTaxAggregator,
+                     existing_capital_losses: float,
+                     foreign_currency_proceeds_calculator: ForeignCurrencyProceedsCalculator) \
+        -> Tuple[List[TranslatedTrade], Iterator[CapitalGainsTax], RematchPoint]:
+    translator = ForeignAssetTranslator(rba_rates)
+    with instrumentation.stage('convert_trades'):
+        taxable_trades = translator.convert_trades(trades)
+    trades_with_fx_proceeds : List[TranslatedTrade]
+    matched_trades: List[MatchedInventory[TranslatedTrade]]
+    with instrumentation.stage('match_trades'):
+        trades_with_fx_proceeds, matched_trades, rematch = \
+            foreign_currency_proceeds_calculator.calculate_from(start, taxable_trades, state)
+    return trades_with_fx_proceeds, capital_gains_aggregator.iter_calculate(existing_capital_losses, matched_trades), \
+        rematch
+
+
+# Passes on the gains realised after as_of (every gain without it), as a resumed run writes them. Keeps the losses
+# carried before the first gain realised on or after rematch_date, which the next run re-taxes from.
+class _ResumedGains:
+    def __init__(self, as_of: Optional[datetime], rematch_date: Optional[datetime], capital_losses: float):
+        self.as_of: Final = as_of
+        self.rematch_date: Final = rematch_date
+        self.rematch_capital_losses: float = capital_losses
+
+    def iter_gains(self, gains: Iterator[CapitalGainsTax]) -> Iterator[CapitalGainsTax]:
+        for gain in gains:
+            sell_date = gain.matched_inventory.sell_trade.date
+            if self.rematch_date is not None and sell_date < self.rematch_date:
+                self.rematch_capital_losses = gain.carried_capital_losses
+            if self.as_of is None or sell_date > self.as_of:
+                yield gain
+
+
+def _read_rates(file_reader: InteractiveBrokersReadWriter,
+                fx_rate_file_path: str,
+                rate_codes: Set[str],
+                use_cache: bool) -> Dict[str, Dict[datetime, float]]:
+    if use_cache:
+        return RbaRateCache().read_rba_rates(fx_rate_file_path, rate_codes)
+    return file_reader.read_rba_rates(fx_rate_file_path, rate_codes)
+
+
+def _gain_values(gain: CapitalGainsTax) -> Tuple[str, datetime, datetime, float, float, float]:
+    return (gain.matched_inventory.buy_trade.asset_code, gain.matched_inventory.buy_trade.date,
+            gain.matched_inventory.sell_trade.date, gain.matched_inventory.quantity, gain.taxable_gain,
+            gain.carried_capital_losses)
+
+
+def _lot_values(state: InventoryState[TranslatedTrade]) -> Dict[str, List[Tuple[datetime, float, float]]]:
+    return {asset_code: [(lot.trade.date, lot.trade.translated_price, lot.remaining_quantity) for lot in lots]
+            for asset_code, lots in state.open_lots.items()}
+
+
+# Replays every statement from the opening losses and compares the gains realised after the snapshot, and the open
+# lots left at the end, with the resumed run. Returns the differences found.
+def _verify_snapshot(snapshot: InventorySnapshot,
+                     all_trades: List[Trade],
+                     rba_rates: Dict[str, Dict[datetime, float]],
+                     resumed_gains: List[CapitalGainsTax],
+                     resumed_state: InventoryState[TranslatedTrade],
+                     foreign_currency_proceeds_calculator: ForeignCurrencyProceedsCalculator,
+                     capital_gains_tax_method: CapitalGainsTaxMethod) -> List[str]:
+    replayed_state = InventoryState[TranslatedTrade]()
+    _, replayed_gain_stream, _ = _calculate_gains(all_trades, rba_rates, RematchPoint(), replayed_state,
+                                                  CapitalGainsTaxAggregator(capital_gains_tax_method),
+                                                  snapshot.opening_capital_losses, foreign_currency_proceeds_calculator)
+    replayed_gains: List[CapitalGainsTax] = list(replayed_gain_stream)
+    if snapshot.as_of is not None:
+        as_of: datetime = snapshot.as_of
+        replayed_gains = [gain for gain in replayed_gains if gain.matched_inventory.sell_trade.date > as_of]
+
+    differences: List[str] = []
+    replayed_values = [_gain_values(gain) for gain in replayed_gains]
+    resumed_values = [_gain_values(gain) for gain in resumed_gains]
+    for i, (replayed, resumed) in enumerate(zip(replayed_values, resumed_values)):
+        if replayed != resumed:
+            differences.append("Gain " + str(i) + ": replayed " + str(replayed) + ", resumed " + str(resumed))
+    if len(replayed_values) != len(resumed_values):
+        differences.append("Replayed " + str(len(replayed_values)) + " gains, resumed " + str(len(resumed_values)))
+    replayed_lots = _lot_values(replayed_state)
+    resumed_lots = _lot_values(resumed_state)
+    for asset_code in sorted(set(replayed_lots) | set(resumed_lots)):
+        if replayed_lots.get(asset_code) != resumed_lots.get(asset_code):
+            differences.append("Open lots for " + asset_code + ": replayed " + str(replayed_lots.get(asset_code))
+                               + ", resumed " + str(resumed_lots.get(asset_code)))
+    return differences
+
+
 def main() -> None:
+    arguments = _parse_arguments()
+    trace_memory = arguments.instrument_memory or instrumentation.memory_tracing_by_environment()
+    if arguments.instrument or arguments.instrument_json is not None or trace_memory \
+            or instrumentation.enabled_by_environment():
+        instrumentation.enable(trace_memory)
+    try:
+        _run(arguments)
+    finally:
+        recorder = instrumentation.recorder()
+        if recorder is not None and arguments.instrument_json is not None:
+            with open(arguments.instrument_json, 'w') as file:
+                json.dump(recorder.report(), file, indent=2)
+        elif recorder is not None:
+            recorder.write_table(sys.stderr)
+
+
+def _run(arguments: _Arguments) -> None:
     trade_file_path: List[str] = []
     fx_rate_file_path = "./test_data/f11.1-data.csv"
-    if len(sys.argv) > 1:
-        trade_file_path = [sys.argv[1]]
-        existing_capital_losses = float(sys.argv[2])
+    if arguments.trade_file is not None:
+        trade_file_path = [arguments.trade_file]
     else:
-        for file in os.listdir('./test_data/'):
+        for file in sorted(os.listdir('./test_data/')):
             if fnmatch.fnmatch(file, 'test_trades_*.csv'):
                 trade_file_path.append('./test_data/' + file)
-        existing_capital_losses = 0
-    file_reader: InteractiveBrokersReadWriter = InteractiveBrokersReadWriter()
-    trades: List[Trade] = []
-    for trade_file in trade_file_path:
-        trades.extend(file_reader.read_trades(trade_file))
+    existing_capital_losses: float = arguments.existing_capital_losses
+    file_reader: InteractiveBrokersReadWriter = InteractiveBrokersReadWriter(arguments.fixed_point)
+    if arguments.scenario is not None and arguments.snapshot is not None:
+        raise ValueError("Scenarios always start from the full history, so cannot be combined with --snapshot.")
+    if arguments.scenario is not None and arguments.fixed_point:
+        raise ValueError("Scenarios are matched in floating point, so cannot be combined with --fixed-point.")
 
-    rba_rates = file_reader.read_rba_rates(fx_rate_file_path)
-    translator = ForeignAssetTranslator(rba_rates)
-    foreign_currency_proceeds_calculator = ForeignCurrencyProceedsCalculator(FirstInFirstOutInventory[TranslatedTrade]())
-    taxable_trades = translator.convert_trades(trades)
-    trades_with_fx_proceeds : List[TranslatedTrade] = foreign_currency_proceeds_calculator.calculate_proceeds(taxable_trades)
-    matched_trades: List[MatchedInventory[TranslatedTrade]] = FirstInFirstOutInventory[TranslatedTrade]().match_trades(trades_with_fx_proceeds)
-    capital_gains_aggregator : CapitalGainsTaxAggregator = CapitalGainsTaxAggregator(DiscountCapitalGainsTaxMethod())
-    gains: List[CapitalGainsTax] = capital_gains_aggregator.calculate(existing_capital_losses, matched_trades)
-    file_reader.write_capital_gains("./test_data/gains.csv", gains)
-    file_reader.write_trades("./test_data/processed_trades.csv", trades_with_fx_proceeds)
+    # With a snapshot, only statements it has not seen are read, and matching continues from its rematch point.
+    snapshot: Optional[InventorySnapshot] = None
+    if arguments.snapshot is not None and os.path.exists(arguments.snapshot):
+        with instrumentation.stage('read_snapshot'):
+            snapshot = read_snapshot(arguments.snapshot)
+    statements: List[ProcessedStatement] = [ProcessedStatement.from_file(path) for path in trade_file_path]
+    new_statements = [statement for statement in statements if snapshot is None or not snapshot.is_processed(statement)]
+    start = RematchPoint()
+    start_capital_losses = existing_capital_losses
+    opening_capital_losses = existing_capital_losses
+    if snapshot is not None:
+        start = snapshot.rematch
+        start_capital_losses = snapshot.rematch_capital_losses
+        opening_capital_losses = snapshot.opening_capital_losses
+
+    # Row counts are only collected from statements parsed in this process, i.e. with --jobs 1.
+    with instrumentation.stage('read_trades'):
+        trades: List[Trade] = list(read_trade_files(file_reader,
+                                                    [statement.file_path for statement in new_statements],
+                                                    arguments.jobs))
+    if snapshot is not None and snapshot.as_of is not None and len(trades) > 0 and trades[0].date <= snapshot.as_of:
+        raise ValueError("Statement trades on " + str(trades[0].date) + " are not after the snapshot date "
+                         + str(snapshot.as_of) + ". Rebuild the snapshot from scratch.")
+
+    previous_trades: List[Trade] = []
+    if arguments.verify_snapshot and snapshot is not None:
+        with instrumentation.stage('read_trades'):
+            previous_trades = list(read_trade_files(file_reader,
+                                                    [statement.file_path for statement in snapshot.processed_statements],
+                                                    arguments.jobs))
+    # Only the currencies actually traded are read from the RBA file.
+    rate_codes: Set[str] = required_rate_codes(trades + previous_trades)
+    with instrumentation.stage('read_rba_rates'):
+        rba_rates = _read_rates(file_reader, fx_rate_file_path, rate_codes, arguments.rate_cache)
+    if arguments.scenario is not None:
+        scenarios = [Scenario.parse(text, existing_capital_losses) for text in arguments.scenario]
+        with instrumentation.stage('convert_trades'):
+            translated_trades = ForeignAssetTranslator(rba_rates).convert_trades(trades)
+        with instrumentation.stage('scenarios'):
+            results = run_scenarios(translated_trades, scenarios, arguments.jobs, _lot_selections(arguments))
+        print(format_scenario_table(results))
+        return
+
+    proceeds_calculator = _proceeds_calculator(arguments)
+    capital_gains_tax_method = _tax_method(arguments)
+    capital_gains_aggregator : CapitalGainsTaxAggregator = CapitalGainsTaxAggregator(capital_gains_tax_method)
+    state = InventoryState[TranslatedTrade]()
+    opening_balances = dict(start.state.current_balance)
+    trades_with_fx_proceeds, all_gains, rematch = _calculate_gains(trades, rba_rates, start, state,
+                                                                   capital_gains_aggregator, start_capital_losses,
+                                                                   proceeds_calculator)
+    report_trades = trades_with_fx_proceeds
+    # Trades from the snapshot's rematch point on are matched and taxed again, so losses are carried as in the full
+    # history, but only what comes after the snapshot is written.
+    snapshot_as_of = snapshot.as_of if snapshot is not None else None
+    resumed_gains = _ResumedGains(snapshot_as_of, rematch.date, start_capital_losses)
+    gains = resumed_gains.iter_gains(all_gains)
+    if snapshot_as_of is not None:
+        resumed_as_of: datetime = snapshot_as_of
+        trades_with_fx_proceeds = [trade for trade in trades_with_fx_proceeds if trade.date > resumed_as_of]
+    # Gains go straight from the aggregator to the file, unless they are needed again for verification.
+    written_gains: List[CapitalGainsTax] = []
+    if arguments.verify_snapshot and snapshot is not None:
+        with instrumentation.stage('calculate_gains'):
+            written_gains = list(gains)
+        gains = iter(written_gains)
+    output_writer: OutputWriter = file_reader
+    extension = '.csv'
+    if arguments.output_format == 'columnar':
+        columnar_writer = ColumnarWriter()
+        output_writer = columnar_writer
+        extension = columnar_writer.extension
+    # Gains are taxed as they are written, so this stage includes the tax calculation unless it was done above.
+    with instrumentation.stage('write_capital_gains'):
+        output_writer.write_capital_gains("./test_data/gains" + extension, gains)
+    with instrumentation.stage('write_trades'):
+        output_writer.write_trades("./test_data/processed_trades" + extension, trades_with_fx_proceeds)
+    # Lots still open, checked against the balance the trades leave each asset with.
+    with instrumentation.stage('open_lots_report'):
+        write_open_lots_report(sys.stdout, state, BalanceIndex(report_trades, opening_balances))
+
+    # The snapshot is only replaced once the resumed run is known to match a full replay.
+    if arguments.verify_snapshot and snapshot is not None:
+        with instrumentation.stage('verify_snapshot'):
+            differences = _verify_snapshot(snapshot, previous_trades + trades, rba_rates, written_gains, state,
+                                           proceeds_calculator, capital_gains_tax_method)
+        for difference in differences:
+            print(difference, file=sys.stderr)
+        if len(differences) > 0:
+            sys.exit(1)
+
+    if arguments.snapshot is not None:
+        carried_capital_losses = capital_gains_aggregator.carried_capital_losses
+        as_of = trades[-1].date if len(trades) > 0 else (snapshot.as_of if snapshot is not None else None)
+        processed = (snapshot.processed_statements if snapshot is not None else []) + new_statements
+        rematch_capital_losses = resumed_gains.rematch_capital_losses if rematch.date is not None \
+            else carried_capital_losses
+        with instrumentation.stage('write_snapshot'):
+            write_snapshot(arguments.snapshot,
+                           InventorySnapshot(as_of, processed, state, carried_capital_losses, opening_capital_losses,
+                                             rematch, rematch_capital_losses))
 
 if __name__ == "__main__":
     main()
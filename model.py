@@ -1,15 +1,29 @@
-from collections import OrderedDict
 from datetime import datetime
-from typing import Final, Dict
+from typing import Final
 
 
 class Amount:
+    __slots__ = ('value', 'currency')
+
     def __init__(self, value: float, currency: str):
         self.value: Final = value
         self.currency: Final = currency
 
 # Represents a buy or sell trade. Sell trades are represented by a negative quantity.
+# Uses __slots__ rather than a per-instance dict as there can be millions of these.
 class Trade:
+    __slots__ = ('asset_code', 'asset_category', 'price', 'date', 'quantity', 'commission', 'currency', 'source')
+    # Set once, by _init_fields, which subclasses share rather than re-running Trade.__init__'s checks, so these are
+    # not Final. Nothing assigns them after construction.
+    asset_code: str
+    asset_category: str
+    price: float
+    date: datetime
+    quantity: float
+    commission: Amount
+    currency: str
+    source: str
+
     def __init__(self,
                  asset_code: str,
                  asset_category: str,
@@ -19,14 +33,7 @@ class Trade:
                  quantity: float,
                  commission: Amount,
                  source: str):
-        self.asset_code: Final = asset_code
-        self.asset_category: Final = asset_category
-        self.price: Final = price
-        self.date: Final = date
-        self.quantity: Final = quantity
-        self.commission: Final = commission
-        self.currency: Final = currency
-        self.source: Final = source
+        self._init_fields(asset_code, asset_category, date, price, currency, quantity, commission, source)
 
         if commission.value > 0:
             raise ValueError("Commission cannot be positive.")
@@ -39,19 +46,52 @@ class Trade:
                 raise ValueError("FX trades must have its currency property set as the domestic currency in the "
                                  "asset_code currency pair.")
 
+    def _init_fields(self,
+                     asset_code: str,
+                     asset_category: str,
+                     date: datetime,
+                     price: float,
+                     currency: str,
+                     quantity: float,
+                     commission: Amount,
+                     source: str) -> None:
+        self.asset_code = asset_code
+        self.asset_category = asset_category
+        self.price = price
+        self.date = date
+        self.quantity = quantity
+        self.commission = commission
+        self.currency = currency
+        self.source = source
+
 
 class TranslatedTrade(Trade):
+    __slots__ = ('translated_price', 'translated_commission', 'exchange_rate', 'translated_currency')
+    # Set once, by _init_translation (see Trade).
+    translated_price: float
+    translated_commission: float
+    exchange_rate: float
+    translated_currency: str
+
     def __init__(self,
                  trade: Trade,
                  translated_price: float,
                  exchange_rate: float,
                  translated_commission: float,
                  translated_currency: str):
-        super().__init__(trade.asset_code, trade.asset_category, trade.date, trade.price, trade.currency, trade.quantity, trade.commission, trade.source)
-        self.translated_price: Final = translated_price
-        self.translated_commission: Final = translated_commission
-        self.exchange_rate: Final = exchange_rate
-        self.translated_currency: Final = translated_currency
+        # trade has already been validated, so its fields are copied across rather than re-running Trade.__init__.
+        self._init_fields(trade.asset_code, trade.asset_category, trade.date, trade.price, trade.currency,
+                          trade.quantity, trade.commission, trade.source)
+        self._init_translation(translated_price, exchange_rate, translated_commission, translated_currency)
         if translated_price < 0:
             raise ValueError("Price cannot be negative.")
 
+    def _init_translation(self,
+                          translated_price: float,
+                          exchange_rate: float,
+                          translated_commission: float,
+                          translated_currency: str) -> None:
+        self.translated_price = translated_price
+        self.translated_commission = translated_commission
+        self.exchange_rate = exchange_rate
+        self.translated_currency = translated_currency
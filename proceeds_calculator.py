@@ -1,83 +1,306 @@
-from datetime import datetime
+from datetime import date, datetime, time
 
-from inventory_accounting import FirstInFirstOutInventory, MatchedInventory
+from inventory_accounting import FirstInFirstOutInventory, MatchedInventory, QueuedFirstInFirstOutInventory, \
+    InventoryState, InventoryAccountant
 from model import TranslatedTrade, Trade, Amount
-from typing import List, Final, Dict
+from typing import List, Final, Dict, Iterable, Optional, Sequence, Set, Tuple
 from foreign_asset_translator import ForeignAssetTranslator
+import instrumentation
+
+
+# FX trade derived from a match (see ForeignCurrencyProceedsCalculator._proxy_trades), built straight from its fields.
+# Proxy trades are AUD priced, with no commission and non-negative rates, so they are valid by construction and the
+# intermediate Trade and its checks are skipped.
+class ProxyTrade(TranslatedTrade):
+    __slots__ = ()
+
+    def __init__(self,
+                 asset_code: str,
+                 date: datetime,
+                 price: float,
+                 quantity: float,
+                 source: str,
+                 translated_price: float):
+        self._init_fields(asset_code, 'FOREX', date, price, 'AUD', quantity, _NO_COMMISSION, source)
+        self._init_translation(translated_price, 1, 0, 'AUD')
+
+
+# Amounts are immutable, so every proxy trade shares the one.
+_NO_COMMISSION: Final = Amount(0, 'AUD')
+
+
+# Where a later run can pick up so that it gives the same matches as replaying the full history (see
+# ForeignCurrencyProceedsCalculator.calculate_from): the state before date, and the trades (without proxy trades) from
+# date on, in date order. Proxy trades dated before date are already matched into state. Without a date nothing needs
+# re-matching: state is the state after the last trade, and there are no trades.
+class RematchPoint:
+    def __init__(self,
+                 date: Optional[datetime] = None,
+                 state: Optional[InventoryState[TranslatedTrade]] = None,
+                 trades: Sequence[TranslatedTrade] = ()):
+        self.date: Final = date
+        self.state: Final[InventoryState[TranslatedTrade]] = state if state is not None \
+            else InventoryState[TranslatedTrade]()
+        self.trades: Final[List[TranslatedTrade]] = list(trades)
 
 
 # Adds fx sale proceeds as a separate trade with an fx cost base set at the one used at sale date.
+# Underlying assets may be matched by any engine, but FX must be FIFO (see s775.145), so the accountant used to
+# re-match the FX assets must be a FIFO one.
+# With net_commissions, the commission trades of each currency on each day are netted into a single trade, dated at
+# the first of them and priced at their quantity-weighted average, so the FX pass has fewer lots to match. Gains then
+# differ slightly from the trade by trade default.
 class ForeignCurrencyProceedsCalculator:
     def __init__(self,
-                 inventory_acountant: FirstInFirstOutInventory[TranslatedTrade]):
+                 inventory_acountant: InventoryAccountant[TranslatedTrade],
+                 fx_inventory_accountant: Optional[FirstInFirstOutInventory[TranslatedTrade]] = None,
+                 net_commissions: bool = False):
+        if fx_inventory_accountant is not None and not isinstance(fx_inventory_accountant, FirstInFirstOutInventory):
+            raise ValueError("FX must be matched first in first out.")
         self.inventory_accountant = inventory_acountant
+        self.fx_inventory_accountant: FirstInFirstOutInventory[TranslatedTrade] = \
+            fx_inventory_accountant if fx_inventory_accountant is not None \
+            else QueuedFirstInFirstOutInventory[TranslatedTrade]()
+        self.net_commissions: Final = net_commissions
 
     def calculate_proceeds(self, trades: List[TranslatedTrade]) -> List[TranslatedTrade]:
-        matched_trades: List[MatchedInventory[TranslatedTrade]] = self.inventory_accountant.match_trades(trades)
-        proceed_trades: List[TranslatedTrade] = list(trades)
-        for matched_trade in matched_trades:
-            if matched_trade.buy_trade.currency != 'AUD':
-                # Estimate gain/loss in foreign currency.
-                price_difference = matched_trade.sell_trade.price - matched_trade.buy_trade.price
-                proceeds = matched_trade.quantity * price_difference
-
-                # Create effective trade to account for FX flow from foreign asset sale.
-                # ATO translates all foreign assets to AUD for tax purposes on trade. If there is a foreign
-                # currency gain/loss then the fx cost base is the ATO fx rate at sale.
-                proxy_trade = Trade(matched_trade.sell_trade.currency + '.AUD',
-                                    'FOREX',
-                                    matched_trade.sell_trade.date,
-                                    matched_trade.sell_trade.exchange_rate,
-                                    'AUD',
-                                    proceeds,
-                                    Amount(0, 'AUD'),
-                                    'SALE_PROCEEDS')
-
-                # Set the FX rate/price to the ATO-based FX rate used on selling the underlying asset.
-                taxable_proxy_trade = TranslatedTrade(proxy_trade,
-                                                      matched_trade.sell_trade.exchange_rate,
-                                                      1,
-                                                      0, 'AUD')
-                proceed_trades.append(taxable_proxy_trade)
-
-            #And again for the buy commission
-            if matched_trade.buy_trade.commission.currency != 'AUD':
-                proportion_matched = matched_trade.quantity / abs(matched_trade.buy_trade.quantity)
-                proxy_trade = Trade(matched_trade.buy_trade.currency + '.AUD',
-                                    'FOREX',
-                                    matched_trade.buy_trade.date,
-                                    matched_trade.buy_trade.exchange_rate,
-                                    'AUD',
-                                    proportion_matched * matched_trade.buy_trade.commission.value,
-                                    Amount(0, 'AUD'),
-                                    'COMMISSION')
-                taxable_proxy_trade = TranslatedTrade(proxy_trade,
-                                                      proportion_matched * matched_trade.buy_trade.exchange_rate,
-                                                      1,
-                                                      0, 'AUD')
-                proceed_trades.append(taxable_proxy_trade)
-
-            # And one mroe for the sell commission
-            if matched_trade.sell_trade.commission.currency != 'AUD':
-                proportion_matched = matched_trade.quantity / abs(matched_trade.sell_trade.quantity)
-                proxy_trade = Trade(matched_trade.sell_trade.currency + '.AUD',
-                                    'FOREX',
-                                    matched_trade.sell_trade.date,
-                                    matched_trade.sell_trade.exchange_rate,
-                                    'AUD',
-                                    proportion_matched * matched_trade.sell_trade.commission.value,
-                                    Amount(0, 'AUD'),
-                                    'COMMISSION')
-                taxable_proxy_trade = TranslatedTrade(proxy_trade,
-                                                      proportion_matched * matched_trade.sell_trade.exchange_rate,
-                                                      1,
-                                                      0, 'AUD')
-                proceed_trades.append(taxable_proxy_trade)
+        # Static method to help with sorting
+        def get_date(t: Trade) -> datetime:
+            return t.date
+
+        sorted_trades = sorted(trades, key=get_date)
+        matched_trades = self.inventory_accountant.iter_match_trades(sorted_trades)
+        return _merge_proxy_trades(sorted_trades, self._all_proxy_trades(matched_trades))
+
+    # Single-pass alternative to matching the output of calculate_proceeds a second time. Returns the same trades as
+    # calculate_proceeds, and the same matches (in the same order) as a second match_trades over them would.
+    # Matches of underlying assets are kept from the first pass. Only the FX assets that receive proxy trades are
+    # re-matched, through their own FIFO inventory, since the proxy trades are the only new trades.
+    # If state is given (see InventoryState), matching continues from its open lots and it is left holding the lots
+    # open at the end of the run.
+    def calculate_proceeds_and_matches(self,
+                                       trades: Iterable[TranslatedTrade],
+                                       state: Optional[InventoryState[TranslatedTrade]] = None) \
+            -> Tuple[List[TranslatedTrade], List[MatchedInventory[TranslatedTrade]]]:
+        # Static method to help with sorting
+        def get_date(t: Trade) -> datetime:
+            return t.date
+
+        proceed_trades, matched_trades, _ = self._calculate(sorted(trades, key=get_date), state, None)
+        return proceed_trades, matched_trades
 
+    # calculate_proceeds_and_matches for a run that continues from start, the rematch point an earlier run left, over
+    # start's trades and then trades, which must all come after them. A carried lot with a foreign currency commission
+    # adds a commission trade dated at its opening when it closes, so continuing from the open lots alone would match
+    # it after the FX trades that a full replay matches it before. Continuing from a rematch point no later than the
+    # opening of any such lot gives the full replay's matches from there on.
+    # Returns the trades with FX proceeds and the matches, both including those of start's trades, and the rematch
+    # point for the next run. state is left holding the lots open at the end.
+    def calculate_from(self,
+                       start: RematchPoint,
+                       trades: Iterable[TranslatedTrade],
+                       state: InventoryState[TranslatedTrade]) \
+            -> Tuple[List[TranslatedTrade], List[MatchedInventory[TranslatedTrade]], RematchPoint]:
         # Static method to help with sorting
         def get_date(t: Trade) -> datetime:
             return t.date
 
-        sorted_trades = sorted(proceed_trades, key=get_date)
+        sorted_trades = start.trades + sorted(trades, key=get_date)
+        state.open_lots.clear()
+        state.current_balance.clear()
+        state.update(start.state.copy())
+        proceed_trades, matched_trades, fx_asset_codes = self._calculate(sorted_trades, state, start.date)
+        if len(sorted_trades) == 0:
+            return proceed_trades, matched_trades, RematchPoint(start.date, start.state.copy())
+        rematch_date = self._rematch_date(state, sorted_trades[-1].date)
+        if rematch_date is None:
+            return proceed_trades, matched_trades, RematchPoint(None, state.copy())
+
+        # The state at the rematch date, from both passes again over the trades before it. The FX pass takes every
+        # proxy trade dated before it, including those of matches that close after it. Counted once, above.
+        rematch_state = InventoryState[TranslatedTrade]()
+        with instrumentation.suspended():
+            first_pass_state = start.state.copy()
+            for _ in self.inventory_accountant.iter_match_trades(
+                    (trade for trade in sorted_trades if trade.date < rematch_date), first_pass_state):
+                pass
+            fx_state = start.state.copy(fx_asset_codes)
+            for _ in self.fx_inventory_accountant.iter_match_trades(
+                    (trade for trade in proceed_trades
+                     if trade.asset_code in fx_asset_codes and trade.date < rematch_date), fx_state):
+                pass
+        _set_state(rematch_state, first_pass_state, fx_state, fx_asset_codes)
+        return proceed_trades, matched_trades, RematchPoint(rematch_date,
+                                                            rematch_state,
+                                                            [trade for trade in sorted_trades
+                                                             if trade.date >= rematch_date])
+
+    # Matches sorted_trades from state (if given), dropping proxy trades dated before rematch_from as already matched
+    # into it. Returns the trades with FX proceeds, the matches and the FX assets that received proxy trades.
+    def _calculate(self,
+                   sorted_trades: List[TranslatedTrade],
+                   state: Optional[InventoryState[TranslatedTrade]],
+                   rematch_from: Optional[datetime]) \
+            -> Tuple[List[TranslatedTrade], List[MatchedInventory[TranslatedTrade]], Set[str]]:
+        first_pass_state: Optional[InventoryState[TranslatedTrade]] = state.copy() if state is not None else None
+        matched_trades: List[MatchedInventory[TranslatedTrade]] = \
+            list(self.inventory_accountant.iter_match_trades(sorted_trades, first_pass_state))
+        proxy_trades: List[TranslatedTrade] = self._all_proxy_trades(matched_trades, rematch_from)
+        proceed_trades: List[TranslatedTrade] = _merge_proxy_trades(sorted_trades, proxy_trades)
+
+        fx_asset_codes: Set[str] = {proxy_trade.asset_code for proxy_trade in proxy_trades}
+        fx_state: Optional[InventoryState[TranslatedTrade]] = state.copy(fx_asset_codes) if state is not None else None
+        fx_matched_trades: List[MatchedInventory[TranslatedTrade]] = list(self.fx_inventory_accountant.iter_match_trades(
+            (trade for trade in proceed_trades if trade.asset_code in fx_asset_codes), fx_state))
+        if state is not None and first_pass_state is not None and fx_state is not None:
+            _set_state(state, first_pass_state, fx_state, fx_asset_codes)
+
+        # A match is emitted when its closing (sell_trade) trade is processed, so ordering matches by the position of
+        # their closing trade reproduces the order of a full second pass.
+        matches_by_closing_trade: Dict[int, List[MatchedInventory[TranslatedTrade]]] = dict()
+        for matched_trade in matched_trades:
+            if matched_trade.sell_trade.asset_code not in fx_asset_codes:
+                matches_by_closing_trade.setdefault(id(matched_trade.sell_trade), []).append(matched_trade)
+        for matched_trade in fx_matched_trades:
+            matches_by_closing_trade.setdefault(id(matched_trade.sell_trade), []).append(matched_trade)
+
+        all_matched_trades: List[MatchedInventory[TranslatedTrade]] = []
+        for trade in proceed_trades:
+            all_matched_trades.extend(matches_by_closing_trade.get(id(trade), []))
+        instrumentation.count('matches', len(all_matched_trades))
+        return proceed_trades, all_matched_trades, fx_asset_codes
+
+    # Start of the day a later run must re-match from (see calculate_from): the opening of the earliest lot left open in
+    # state with a foreign currency commission. Netted commissions span a whole day, so then no later than as_of's day
+    # either. None if nothing needs re-matching.
+    def _rematch_date(self, state: InventoryState[TranslatedTrade], as_of: datetime) -> Optional[datetime]:
+        dates: List[datetime] = [lot.trade.date for lots in state.open_lots.values() for lot in lots
+                                 if lot.trade.commission.currency != 'AUD']
+        if self.net_commissions:
+            dates.append(as_of)
+        if len(dates) == 0:
+            return None
+        return datetime.combine(min(dates).date(), time())
+
+    # Proxy trades of every match, in the order they are generated, from rematch_from on if given.
+    def _all_proxy_trades(self,
+                          matched_trades: Iterable[MatchedInventory[TranslatedTrade]],
+                          rematch_from: Optional[datetime] = None) -> List[TranslatedTrade]:
+        proxy_trades: List[TranslatedTrade] = []
+        for matched_trade in matched_trades:
+            proxy_trades.extend(self._proxy_trades(matched_trade))
+        if rematch_from is not None:
+            proxy_trades = [proxy_trade for proxy_trade in proxy_trades if proxy_trade.date >= rematch_from]
+        if self.net_commissions:
+            proxy_trades = _net_commissions(proxy_trades)
+        _count_proxy_trades(proxy_trades)
+        return proxy_trades
+
+    # FX trades implied by a match: sale proceeds and the buy/sell commissions in foreign currency.
+    def _proxy_trades(self, matched_trade: MatchedInventory[TranslatedTrade]) -> List[TranslatedTrade]:
+        proxy_trades: List[TranslatedTrade] = []
+        if matched_trade.buy_trade.currency != 'AUD':
+            # Estimate gain/loss in foreign currency.
+            price_difference = matched_trade.sell_trade.price - matched_trade.buy_trade.price
+            proceeds = matched_trade.quantity * price_difference
+
+            # Create effective trade to account for FX flow from foreign asset sale.
+            # ATO translates all foreign assets to AUD for tax purposes on trade. If there is a foreign
+            # currency gain/loss then the fx cost base is the ATO fx rate at sale.
+            # The FX rate/price is set to the ATO-based FX rate used on selling the underlying asset.
+            proxy_trades.append(ProxyTrade(matched_trade.sell_trade.currency + '.AUD',
+                                           matched_trade.sell_trade.date,
+                                           matched_trade.sell_trade.exchange_rate,
+                                           proceeds,
+                                           'SALE_PROCEEDS',
+                                           matched_trade.sell_trade.exchange_rate))
+
+        #And again for the buy commission
+        if matched_trade.buy_trade.commission.currency != 'AUD':
+            proportion_matched = matched_trade.quantity / abs(matched_trade.buy_trade.quantity)
+            proxy_trades.append(ProxyTrade(matched_trade.buy_trade.currency + '.AUD',
+                                           matched_trade.buy_trade.date,
+                                           matched_trade.buy_trade.exchange_rate,
+                                           proportion_matched * matched_trade.buy_trade.commission.value,
+                                           'COMMISSION',
+                                           proportion_matched * matched_trade.buy_trade.exchange_rate))
+
+        # And one mroe for the sell commission
+        if matched_trade.sell_trade.commission.currency != 'AUD':
+            proportion_matched = matched_trade.quantity / abs(matched_trade.sell_trade.quantity)
+            proxy_trades.append(ProxyTrade(matched_trade.sell_trade.currency + '.AUD',
+                                           matched_trade.sell_trade.date,
+                                           matched_trade.sell_trade.exchange_rate,
+                                           proportion_matched * matched_trade.sell_trade.commission.value,
+                                           'COMMISSION',
+                                           proportion_matched * matched_trade.sell_trade.exchange_rate))
+        return proxy_trades
+
+
+# FX assets that received proxy trades take their state from the FX pass, everything else from the first pass.
+def _set_state(state: InventoryState[TranslatedTrade],
+               first_pass_state: InventoryState[TranslatedTrade],
+               fx_state: InventoryState[TranslatedTrade],
+               fx_asset_codes: Set[str]) -> None:
+    for asset_code in fx_asset_codes:
+        first_pass_state.open_lots.pop(asset_code, None)
+        first_pass_state.current_balance.pop(asset_code, None)
+    state.open_lots.clear()
+    state.current_balance.clear()
+    state.update(first_pass_state)
+    state.update(fx_state)
+
+
+# Date order, with the original trades first on equal dates and proxy trades in the order they were generated. The sort
+# is stable and Timsort merges runs: the sorted trades are one, and as matches come in closing trade order, so are the
+# proxy trades dated at the closing trade, leaving mostly the buy commissions out of order. This measured faster than
+# merging the runs with heapq.merge, which steps through every trade in Python.
+def _merge_proxy_trades(sorted_trades: List[TranslatedTrade], proxy_trades: List[TranslatedTrade]) \
+        -> List[TranslatedTrade]:
+    # Static method to help with sorting
+    def get_date(t: Trade) -> datetime:
+        return t.date
+
+    return sorted(sorted_trades + proxy_trades, key=get_date)
+
+
+# Nets the commission trades of each currency on each calendar day into one, in place of the first of them. Prices
+# are weighted by quantity, so the netted trade has the same AUD value as the trades it replaces. Commissions that net
+# to zero are dropped.
+def _net_commissions(proxy_trades: List[TranslatedTrade]) -> List[TranslatedTrade]:
+    commissions: Dict[Tuple[str, date], List[TranslatedTrade]] = dict()
+    for proxy_trade in proxy_trades:
+        if proxy_trade.source == 'COMMISSION':
+            commissions.setdefault((proxy_trade.asset_code, proxy_trade.date.date()), []).append(proxy_trade)
+
+    netted_trades: List[TranslatedTrade] = []
+    for proxy_trade in proxy_trades:
+        if proxy_trade.source != 'COMMISSION':
+            netted_trades.append(proxy_trade)
+            continue
+        same_day = commissions.get((proxy_trade.asset_code, proxy_trade.date.date()))
+        if same_day is None:  # Already netted into an earlier trade.
+            continue
+        del commissions[(proxy_trade.asset_code, proxy_trade.date.date())]
+        if len(same_day) == 1:
+            netted_trades.append(proxy_trade)
+            continue
+        quantity = sum(commission.quantity for commission in same_day)
+        if quantity == 0:  # Nets to nothing, so there is no lot to open.
+            continue
+        price = sum(commission.quantity * commission.price for commission in same_day) / quantity
+        translated_price = sum(commission.quantity * commission.translated_price for commission in same_day) / quantity
+        netted_trades.append(ProxyTrade(proxy_trade.asset_code,
+                                        min(commission.date for commission in same_day),
+                                        price,
+                                        quantity,
+                                        'COMMISSION',
+                                        translated_price))
+    return netted_trades
+
 
-        return sorted_trades
+# Synthetic trades created, by kind (e.g. proxy_trades_sale_proceeds, proxy_trades_commission), for instrumentation.
+def _count_proxy_trades(proxy_trades: List[TranslatedTrade]) -> None:
+    if instrumentation.is_enabled():
+        for proxy_trade in proxy_trades:
+            instrumentation.count('proxy_trades_' + proxy_trade.source.lower())
@@ -1,7 +1,9 @@
-from typing import Dict, Final, TypeVar, Generic
+from typing import Dict, Final, TypeVar, Generic, List, Sequence
 from datetime import datetime
-from collections import OrderedDict
+from bisect import bisect_right
 from abc import ABC, abstractmethod
+import numpy as np
+import numpy.typing as npt
 
 T = TypeVar('T')
 
@@ -11,24 +13,66 @@ class DatedProfile(ABC, Generic[T]):
     def __getitem__(self, key: datetime) -> T:
         ...
 
+    # Resolves a batch of dates. Results are returned in the order the dates were given.
+    def lookup_many(self, keys: Sequence[datetime]) -> List[T]:
+        return [self[key] for key in keys]
 
+    # Resolves a datetime64 array of dates into an array of values.
+    def lookup_array(self, keys: npt.NDArray[np.datetime64]) -> npt.NDArray[np.float64]:
+        return np.asarray(self.lookup_many(keys.astype(datetime).tolist()), dtype=np.float64)
+
+
+# Value at a profile date holds until (but excluding) the next profile date.
+# Dates are held in a sorted list so that lookups are a binary search rather than a scan.
 class LeftPiecewiseConstantProfile(DatedProfile[float]):
     def __init__(self, asset_code: str, prices: Dict[datetime, float]):
         self.asset_code: Final = asset_code
-        prices = OrderedDict(prices)
-        self.keys: Final = list(prices.keys())
-        self.values: Final = list(prices.values())
-        self.number_of_keys: Final = len(prices)
+        sorted_prices = sorted(prices.items())
+        self.keys: Final = [date for date, _ in sorted_prices]
+        self.values: Final = [value for _, value in sorted_prices]
+        self.number_of_keys: Final = len(sorted_prices)
+        self.date_index: Final[npt.NDArray[np.datetime64]] = np.array(self.keys, dtype='datetime64[us]')
+        self.value_index: Final[npt.NDArray[np.float64]] = np.array(self.values, dtype=np.float64)
 
     def __getitem__(self, key: datetime) -> float:
-        if self.keys[0] > key:
+        return self.values[self._index(key)]
+
+    def _index(self, key: datetime) -> int:
+        if self.number_of_keys == 0 or self.keys[0] > key:
             raise KeyError('Date requested is before the profile start date.')
 
         if self.keys[self.number_of_keys - 1] < key:
             raise KeyError('Date requested is after the profile end date.')
 
-        for i in range(1, self.number_of_keys):
-            if self.keys[i - 1] < key < self.keys[i]:
-                return self.values[i - 1]
+        return bisect_right(self.keys, key) - 1
+
+    # Sorts the requested dates once and walks them alongside the profile dates in a single merge pass.
+    def lookup_many(self, keys: Sequence[datetime]) -> List[float]:
+        results: List[float] = [0.0] * len(keys)
+        if len(keys) == 0:
+            return results
 
-        raise KeyError("Key not found.")
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        # Bounds are checked against the extreme dates so the merge itself never runs off either end.
+        self._index(keys[order[0]])
+        self._index(keys[order[-1]])
+
+        i = 0
+        last_index = self.number_of_keys - 1
+        for position in order:
+            key = keys[position]
+            while i < last_index and self.keys[i + 1] <= key:
+                i += 1
+            results[position] = self.values[i]
+        return results
+
+    def lookup_array(self, keys: npt.NDArray[np.datetime64]) -> npt.NDArray[np.float64]:
+        if len(keys) == 0:
+            return np.empty(0, dtype=np.float64)
+        keys = keys.astype('datetime64[us]')
+        positions = np.searchsorted(self.date_index, keys, side='right') - 1
+        if self.number_of_keys == 0 or positions.min() < 0:
+            raise KeyError('Date requested is before the profile start date.')
+        if keys.max() > self.date_index[-1]:
+            raise KeyError('Date requested is after the profile end date.')
+        return self.value_index[positions]
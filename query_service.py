@@ -0,0 +1,302 @@
+import argparse
+import asyncio
+import fnmatch
+import heapq
+import json
+import os
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, Final, List, Optional, Sequence, Set, cast
+
+from capital_gains_tax import CapitalGainsTax, CapitalGainsTaxAggregator, DiscountCapitalGainsTaxMethod
+from foreign_asset_translator import ForeignAssetTranslator, required_rate_codes
+from inventory_accounting import InventoryState, TradePartialMatch, new_inventory_accountant
+from model import Trade, TranslatedTrade
+from proceeds_calculator import ForeignCurrencyProceedsCalculator, RematchPoint
+from read_writer import InteractiveBrokersReadWriter
+from tax_calendar import financial_year
+
+# Answers questions about matched trades and gains over JSON lines on a local socket, from a pipeline that is loaded
+# once and kept in memory. Each request is one JSON object on a line, and gets one JSON object back on a line:
+#   {"query": "gains", "financial_year": 2020}         taxable gains of the year ending 30 June 2020, by asset
+#   {"query": "open_lots", "asset_code": "ES"}         lots open now, for one asset or, without asset_code, for all
+#   {"query": "carried_losses", "date": "2020-06-30"}  capital losses carried after every gain up to the end of a date
+#   {"query": "add_statement", "path": "trades.csv"}   reads a new or changed statement into the pipeline
+# Responses are {"ok": true, "result": ...} or {"ok": false, "error": "..."}.
+# Run from the repository root: python query_service.py [statement ...] [--port 8765 | --socket PATH]
+
+
+def _date_text(date: datetime) -> str:
+    return date.isoformat(sep=' ')
+
+
+# Indexes over one run of the pipeline, built once so that each query is a lookup. An index is never changed after it
+# is built; a reload builds a new one, so queries can be answered from the old index while the reload runs.
+class PipelineIndex:
+    def __init__(self,
+                 gains: Sequence[CapitalGainsTax],
+                 state: InventoryState[TranslatedTrade],
+                 opening_capital_losses: float):
+        self.opening_capital_losses: Final = opening_capital_losses
+        self.number_of_gains: Final = len(gains)
+        self._open_lots: Final[Dict[str, List[TradePartialMatch[TranslatedTrade]]]] = state.copy().open_lots
+        # Gains are in closing trade order, so sale dates are sorted and losses can be looked up by bisection.
+        self._sale_dates: Final[List[datetime]] = [gain.matched_inventory.sell_trade.date for gain in gains]
+        self._carried_capital_losses: Final[List[float]] = [gain.carried_capital_losses for gain in gains]
+        self._gains_by_year: Final[Dict[int, Dict[str, object]]] = dict()
+        taxable_gains_by_year: Dict[int, Dict[str, float]] = dict()
+        matches_by_year: Dict[int, int] = dict()
+        for gain in gains:
+            year = financial_year(gain.matched_inventory.sell_trade.date)
+            by_asset = taxable_gains_by_year.setdefault(year, dict())
+            asset_code = gain.matched_inventory.sell_trade.asset_code
+            by_asset[asset_code] = by_asset.get(asset_code, 0) + gain.taxable_gain
+            matches_by_year[year] = matches_by_year.get(year, 0) + 1
+        for year, by_asset in taxable_gains_by_year.items():
+            self._gains_by_year[year] = {'financial_year': year,
+                                         'matches': matches_by_year[year],
+                                         'taxable_gains': sum(by_asset.values()),
+                                         'taxable_gains_by_asset': by_asset,
+                                         'carried_capital_losses': self.carried_capital_losses(
+                                             datetime(year, 7, 1) - timedelta(microseconds=1))}
+
+    def gains(self, year: int) -> Dict[str, object]:
+        return self._gains_by_year.get(year, {'financial_year': year,
+                                              'matches': 0,
+                                              'taxable_gains': 0,
+                                              'taxable_gains_by_asset': dict(),
+                                              'carried_capital_losses': self.carried_capital_losses(
+                                                  datetime(year, 7, 1) - timedelta(microseconds=1))})
+
+    # Lots by asset code, in matching order.
+    def open_lots(self, asset_code: Optional[str] = None) -> Dict[str, List[Dict[str, object]]]:
+        asset_codes = [asset_code] if asset_code is not None else list(self._open_lots)
+        return {code: [{'date': _date_text(lot.trade.date),
+                        'remaining_quantity': lot.remaining_quantity,
+                        'translated_price': lot.trade.translated_price}
+                       for lot in self._open_lots.get(code, [])]
+                for code in asset_codes}
+
+    # Losses carried after every gain realised at or before date.
+    def carried_capital_losses(self, date: datetime) -> float:
+        i = bisect_right(self._sale_dates, date)
+        return self._carried_capital_losses[i - 1] if i > 0 else self.opening_capital_losses
+
+
+# Statements read and translated once, and the trades matched and taxed, as main.py does. Statements are kept per path,
+# translated, so adding one only reads that file. A statement whose trades all come after everything matched so far is
+# matched on from the last rematch point, replacing the gains realised from its date on (as a snapshot resumes; see
+# ForeignCurrencyProceedsCalculator.calculate_from); anything else, such as a changed statement, re-matches the
+# translated trades of every statement. The RBA file is only read again for currencies not yet loaded.
+class WarmPipeline:
+    def __init__(self, fx_rate_file_path: str, existing_capital_losses: float = 0, engine: str = 'fifo'):
+        self.fx_rate_file_path: Final = fx_rate_file_path
+        self.existing_capital_losses: Final = existing_capital_losses
+        self.engine: Final = engine
+        self._reader: Final = InteractiveBrokersReadWriter()
+        self._statements: Final[Dict[str, List[TranslatedTrade]]] = dict()
+        self._rate_codes: Set[str] = set()
+        self._rba_rates: Dict[str, Dict[datetime, float]] = dict()
+        self._state = InventoryState[TranslatedTrade]()
+        self._gains: List[CapitalGainsTax] = []
+        self._rematch_point = RematchPoint()
+        self._last_date: Optional[datetime] = None
+        self.index: PipelineIndex = PipelineIndex([], self._state, existing_capital_losses)
+
+    def load(self, file_paths: Sequence[str]) -> None:
+        statements: Dict[str, List[Trade]] = {file_path: self._read(file_path) for file_path in file_paths}
+        rate_codes: Set[str] = set()
+        for trades in statements.values():
+            rate_codes |= required_rate_codes(trades)
+        self._load_rates(rate_codes)
+        for file_path, trades in statements.items():
+            self._statements[file_path] = ForeignAssetTranslator(self._rba_rates).convert_trades(trades)
+        self._rematch()
+
+    # Returns True if the statement's trades were matched on from the current state, False if everything was re-matched.
+    def add_statement(self, file_path: str) -> bool:
+        trades = self._read(file_path)
+        self._load_rates(required_rate_codes(trades))
+        translated_trades = ForeignAssetTranslator(self._rba_rates).convert_trades(trades)
+        resume = file_path not in self._statements \
+            and (self._last_date is None or len(trades) == 0 or trades[0].date > self._last_date)
+        self._statements[file_path] = translated_trades
+        if resume:
+            self._match(translated_trades)
+        else:
+            self._rematch()
+        return resume
+
+    def _read(self, file_path: str) -> List[Trade]:
+        def get_date(t: Trade) -> datetime:
+            return t.date
+
+        return sorted(self._reader.iter_trades(file_path), key=get_date)
+
+    def _load_rates(self, rate_codes: Set[str]) -> None:
+        if not rate_codes <= self._rate_codes:
+            self._rate_codes = self._rate_codes | rate_codes
+            self._rba_rates = self._reader.read_rba_rates(self.fx_rate_file_path, self._rate_codes)
+
+    # Statements are merged as read_trade_files merges them: by date, then in statement order.
+    def _rematch(self) -> None:
+        self._state = InventoryState[TranslatedTrade]()
+        self._gains = []
+        self._rematch_point = RematchPoint()
+        self._last_date = None
+        def get_date(t: TranslatedTrade) -> datetime:
+            return t.date
+
+        self._match(list(heapq.merge(*self._statements.values(), key=get_date)))
+
+    def _proceeds_calculator(self) -> ForeignCurrencyProceedsCalculator:
+        return ForeignCurrencyProceedsCalculator(new_inventory_accountant(self.engine))
+
+    # Gains realised from the rematch point on are matched and taxed again, from the losses carried before it.
+    def _match(self, trades: List[TranslatedTrade]) -> None:
+        start = self._rematch_point
+        gains = self._gains if start.date is None \
+            else [gain for gain in self._gains if gain.matched_inventory.sell_trade.date < start.date]
+        capital_losses = gains[-1].carried_capital_losses if len(gains) > 0 else self.existing_capital_losses
+        _, matched_trades, self._rematch_point = self._proceeds_calculator().calculate_from(start, trades, self._state)
+        aggregator = CapitalGainsTaxAggregator(DiscountCapitalGainsTaxMethod())
+        self._gains = gains + list(aggregator.iter_calculate(capital_losses, matched_trades))
+        if len(trades) > 0:
+            self._last_date = trades[-1].date
+        self.index = PipelineIndex(self._gains, self._state, self.existing_capital_losses)
+
+
+# 'YYYY-MM-DD' means the end of that day.
+def _parse_date(text: str) -> datetime:
+    date = datetime.fromisoformat(text)
+    if len(text) == 10:
+        date += timedelta(days=1, microseconds=-1)
+    return date
+
+
+# Serves queries against a WarmPipeline. Queries are answered on the event loop from the current index. Statements are
+# added on a single background thread, one at a time, and the new index replaces the old one once it is complete.
+class QueryService:
+    def __init__(self, pipeline: WarmPipeline):
+        self.pipeline: Final = pipeline
+        self._reload_executor: Final = ThreadPoolExecutor(max_workers=1)
+
+    async def answer(self, request: Dict[str, object]) -> Dict[str, object]:
+        try:
+            return {'ok': True, 'result': await self._answer(request)}
+        except (KeyError, TypeError, ValueError, OSError) as error:
+            return {'ok': False, 'error': type(error).__name__ + ': ' + str(error)}
+
+    async def _answer(self, request: Dict[str, object]) -> object:
+        query = request.get('query')
+        index = self.pipeline.index
+        if query == 'gains':
+            return index.gains(int(str(request['financial_year'])))
+        if query == 'open_lots':
+            asset_code = request.get('asset_code')
+            return index.open_lots(str(asset_code) if asset_code is not None else None)
+        if query == 'carried_losses':
+            return index.carried_capital_losses(_parse_date(str(request['date'])))
+        if query == 'add_statement':
+            resumed = await asyncio.get_running_loop().run_in_executor(
+                self._reload_executor, self.pipeline.add_statement, str(request['path']))
+            return {'resumed': resumed, 'gains': self.pipeline.index.number_of_gains}
+        raise ValueError("Unknown query: " + str(query))
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            async for line in reader:
+                if line.strip() == b'':
+                    continue
+                try:
+                    request: object = json.loads(line)
+                except ValueError as error:
+                    response: Dict[str, object] = {'ok': False, 'error': 'Invalid JSON: ' + str(error)}
+                else:
+                    response = await self.answer(cast(Dict[str, object], request)) if isinstance(request, dict) \
+                        else {'ok': False, 'error': 'Requests must be JSON objects.'}
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+            await writer.wait_closed()
+
+    # Binds to localhost only; port 0 picks a free port (see the returned server's sockets).
+    async def start(self, port: int = 0) -> asyncio.Server:
+        return await asyncio.start_server(self._serve, '127.0.0.1', port)
+
+    async def start_unix(self, socket_path: str) -> asyncio.Server:
+        return await asyncio.start_unix_server(self._serve, socket_path)
+
+    def close(self) -> None:
+        self._reload_executor.shutdown()
+
+
+# Minimal client: one connection, one request and response at a time.
+class QueryClient:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._reader: Final = reader
+        self._writer: Final = writer
+
+    @staticmethod
+    async def connect(port: Optional[int] = None, socket_path: Optional[str] = None) -> 'QueryClient':
+        if socket_path is not None:
+            reader, writer = await asyncio.open_unix_connection(socket_path)
+        else:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        return QueryClient(reader, writer)
+
+    async def query(self, request: Dict[str, object]) -> Dict[str, object]:
+        self._writer.write(json.dumps(request).encode() + b'\n')
+        await self._writer.drain()
+        response: Dict[str, object] = json.loads(await self._reader.readline())
+        return response
+
+    async def close(self) -> None:
+        self._writer.close()
+        await self._writer.wait_closed()
+
+
+async def _serve_forever(service: QueryService, port: int, socket_path: Optional[str]) -> None:
+    server = await (service.start_unix(socket_path) if socket_path is not None else service.start(port))
+    async with server:
+        await server.serve_forever()
+
+
+# Parsed command line, with the options declared so that they are typed where they are read.
+class _Arguments(argparse.Namespace):
+    statements: List[str]
+    rates: str
+    existing_capital_losses: float
+    engine: str
+    port: int
+    socket: Optional[str]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Serves gains, open lot and carried loss queries over JSON lines.')
+    parser.add_argument('statements', nargs='*', help='Statements to load. Defaults to ./test_data/test_trades_*.csv.')
+    parser.add_argument('--rates', default='./test_data/f11.1-data.csv', help='RBA F11.1 exchange rate file.')
+    parser.add_argument('--existing-capital-losses', type=float, default=0,
+                        help='Capital losses carried into the first statement, as a negative number.')
+    parser.add_argument('--engine', choices=('fifo', 'lifo', 'hifo'), default='fifo')
+    parser.add_argument('--port', type=int, default=8765, help='Port on 127.0.0.1 to listen on.')
+    parser.add_argument('--socket', metavar='PATH', help='Listen on a Unix socket at PATH instead of a port.')
+    arguments = parser.parse_args(namespace=_Arguments())
+
+    statements: List[str] = arguments.statements
+    if len(statements) == 0:
+        statements = ['./test_data/' + file for file in sorted(os.listdir('./test_data/'))
+                      if fnmatch.fnmatch(file, 'test_trades_*.csv')]
+    pipeline = WarmPipeline(arguments.rates, arguments.existing_capital_losses, arguments.engine)
+    pipeline.load(statements)
+    service = QueryService(pipeline)
+    try:
+        asyncio.run(_serve_forever(service, arguments.port, arguments.socket))
+    finally:
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+import csv
+import hashlib
+import io
+import os
+from datetime import datetime
+from typing import Collection, Dict, Final, List, Optional, TextIO, Tuple
+
+import numpy as np
+import numpy.typing as npt
+
+_CACHE_VERSION = 1
+_CACHE_SUFFIX = '.cache.npz'
+_DATE_FORMAT = '%d-%b-%Y'
+
+
+# Rates parsed out of an RBA F11.1 csv, held as a date x currency matrix. Missing rates are NaN.
+class RbaRateTable:
+    def __init__(self, rate_codes: List[str], dates: npt.NDArray[np.int64], rates: npt.NDArray[np.float64]):
+        self.rate_codes: Final = rate_codes
+        self.dates: Final = dates  # int64 proleptic Gregorian ordinals, ascending.
+        self.rates: Final = rates  # float64, one row per date and one column per rate code.
+
+    def append(self, other: 'RbaRateTable') -> 'RbaRateTable':
+        if other.rate_codes != self.rate_codes:
+            raise ValueError("Cannot append rates with different currency columns.")
+        if len(self.dates) > 0 and len(other.dates) > 0 and other.dates[0] <= self.dates[-1]:
+            raise ValueError("Appended rates must start after the last cached date.")
+        return RbaRateTable(self.rate_codes,
+                            np.concatenate([self.dates, other.dates]),
+                            np.concatenate([self.rates, other.rates]))
+
+    # Keeps only the given rate codes, in file column order.
+    def select(self, rate_codes: Collection[str]) -> 'RbaRateTable':
+        columns: List[int] = [i for i, rate_code in enumerate(self.rate_codes) if rate_code in rate_codes]
+        return RbaRateTable([self.rate_codes[i] for i in columns], self.dates, self.rates[:, columns])
+
+    # Same shape as ReadWriter.read_rba_rates: {'USD.AUD': {date: rate}}.
+    def to_rates(self) -> Dict[str, Dict[datetime, float]]:
+        dates: List[datetime] = [datetime.fromordinal(ordinal) for ordinal in self.dates.tolist()]
+        results: Dict[str, Dict[datetime, float]] = dict()
+        for column, rate_code in enumerate(self.rate_codes):
+            present = ~np.isnan(self.rates[:, column])
+            results[rate_code] = dict(zip([date for date, keep in zip(dates, present.tolist()) if keep],
+                                          self.rates[present, column].tolist()))
+        return results
+
+
+# Parses rows of an RBA F11.1 csv. header is the 'Units' row, which is where the currency codes live.
+def _parse_rows(header: List[str], rows: List[List[str]]) -> RbaRateTable:
+    # Strangely formatted CSV does not have date header. Ends up being 'Units'.
+    columns: List[Tuple[int, str]] = [(i, column) for i, column in enumerate(header)
+                                      if column != 'Index' and column != 'Units' and column != '']
+    # Repeated column names resolve to the last occurrence, as they would in a csv.DictReader.
+    last_occurrence: Dict[str, int] = {column: i for i, column in columns}
+    columns = [(i, column) for i, column in columns if last_occurrence[column] == i]
+    date_column = header.index('Units')
+
+    dates: List[int] = []
+    values: List[List[float]] = []
+    for row in rows:
+        try:
+            date = datetime.strptime(row[date_column], _DATE_FORMAT)
+        except (ValueError, IndexError):
+            continue
+        dates.append(date.toordinal())
+        # Convention in file is AUD.ccy - need to swap.
+        values.append([1 / float(row[i]) if i < len(row) and row[i] != '' else np.nan for i, _ in columns])
+
+    return RbaRateTable([column + '.AUD' for _, column in columns],
+                        np.array(dates, dtype=np.int64),
+                        np.array(values, dtype=np.float64).reshape(len(dates), len(columns)))
+
+
+def _file_hash(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Reads the file once, returning the bytes after its first prefix_size bytes and the sha256 of the whole file. The bytes
+# are None unless the prefix hashes to prefix_hash and ends a line, i.e. the file was only appended to.
+def _read_after_prefix(file_path: str, prefix_size: int, prefix_hash: str) -> Tuple[Optional[bytes], str]:
+    digest = hashlib.sha256()
+    last_block = b''
+    with open(file_path, 'rb') as file:
+        remaining = prefix_size
+        while remaining > 0:
+            block = file.read(min(1 << 20, remaining))
+            if block == b'':
+                break
+            digest.update(block)
+            remaining -= len(block)
+            last_block = block
+        prefix_matches = remaining == 0 and last_block.endswith(b'\n') and digest.hexdigest() == prefix_hash
+        appended = file.read()
+    digest.update(appended)
+    return (appended if prefix_matches else None), digest.hexdigest()
+
+
+# Keeps a compiled copy of the RBA F11.1 csv in a binary sidecar next to it (f11.1-data.csv.cache.npz) so later runs
+# load the rates without re-parsing the csv. The sidecar records the csv's mtime, size and sha256, i.e. the length and
+# hash of the prefix of the csv it was compiled from:
+#  * unchanged mtime and size: the sidecar is used as is.
+#  * same hash (e.g. the file was touched or copied): the sidecar is used and its mtime refreshed.
+#  * the first size bytes still hash the same, so rows were only appended: only the bytes after them are parsed, and
+#    their rows appended if they all come after the last cached date. The csv is read once, hashing it as it goes.
+#  * anything else (e.g. the RBA revised a published rate): the csv is fully re-parsed.
+class RbaRateCache:
+    def __init__(self) -> None:
+        # How the last read was satisfied: 'cache', 'incremental' or 'full'.
+        self.last_load: str = ''
+
+    @staticmethod
+    def cache_path(file_path: str) -> str:
+        return file_path + _CACHE_SUFFIX
+
+    # Returns rates in the form ccy.AUD, exactly as ReadWriter.read_rba_rates does.
+    def read_rba_rates(self,
+                       file_path: str,
+                       rate_codes: Optional[Collection[str]] = None) -> Dict[str, Dict[datetime, float]]:
+        table = self.read_rate_table(file_path)
+        if rate_codes is not None:
+            table = table.select(rate_codes)
+        return table.to_rates()
+
+    def read_rate_table(self, file_path: str) -> RbaRateTable:
+        status = os.stat(file_path)
+        cached = self._read_cache(self.cache_path(file_path))
+        if cached is not None:
+            table, mtime_ns, size, file_hash = cached
+            if mtime_ns == status.st_mtime_ns and size == status.st_size:
+                self.last_load = 'cache'
+                return table
+            appended, current_hash = _read_after_prefix(file_path, size, file_hash)
+            updated = self._append_new_rows(file_path, table, appended) if appended else None
+            if appended == b'':
+                self.last_load = 'cache'
+            elif updated is None:
+                self.last_load = 'full'
+                table = self._parse_file(file_path)
+            else:
+                self.last_load = 'incremental'
+                table = updated
+            self._write_cache(file_path, table, status.st_mtime_ns, status.st_size, current_hash)
+            return table
+
+        self.last_load = 'full'
+        table = self._parse_file(file_path)
+        self._write_cache(file_path, table, status.st_mtime_ns, status.st_size, _file_hash(file_path))
+        return table
+
+    @staticmethod
+    def _read_header(csv_file: TextIO) -> List[str]:
+        # Skip multiple header rows.
+        for i in range(5):
+            csv_file.readline()
+        return next(csv.reader(csv_file, delimiter=',', quotechar='"'), [])
+
+    def _parse_file(self, file_path: str) -> RbaRateTable:
+        with open(file_path, newline='') as csv_file:
+            header = self._read_header(csv_file)
+            return _parse_rows(header, list(csv.reader(csv_file, delimiter=',', quotechar='"')))
+
+    # Parses only the appended bytes of the csv, which follow the cached prefix. Returns None if the cached rates cannot
+    # simply be extended with their rows.
+    def _append_new_rows(self, file_path: str, table: RbaRateTable, appended: bytes) -> Optional[RbaRateTable]:
+        with open(file_path, newline='') as csv_file:
+            header = self._read_header(csv_file)
+        if len(table.dates) == 0 or 'Units' not in header:
+            return None
+        # Decoded as open() would, so rows read the same as in a full parse.
+        with io.TextIOWrapper(io.BytesIO(appended), newline='') as appended_file:
+            new_rows = _parse_rows(header, list(csv.reader(appended_file, delimiter=',', quotechar='"')))
+        if new_rows.rate_codes != table.rate_codes:
+            return None
+        if len(new_rows.dates) > 0 and new_rows.dates[0] <= table.dates[-1]:
+            return None
+        return table.append(new_rows)
+
+    @staticmethod
+    def _read_cache(cache_path: str) -> Optional[Tuple[RbaRateTable, int, int, str]]:
+        if not os.path.exists(cache_path):
+            return None
+        try:
+            with np.load(cache_path, allow_pickle=False) as cache:
+                if int(cache['version']) != _CACHE_VERSION:
+                    return None
+                table = RbaRateTable([str(code) for code in cache['rate_codes'].tolist()],
+                                     cache['dates'],
+                                     cache['rates'])
+                return table, int(cache['source_mtime_ns']), int(cache['source_size']), str(cache['source_sha256'])
+        except (OSError, KeyError, ValueError):
+            return None  # Unreadable or partially written sidecar. Fall back to parsing the csv.
+
+    def _write_cache(self, file_path: str, table: RbaRateTable, mtime_ns: int, size: int, file_hash: str) -> None:
+        cache_path = self.cache_path(file_path)
+        temporary_path = cache_path + '.tmp'
+        with open(temporary_path, 'wb') as cache_file:
+            np.savez(cache_file,
+                     version=np.array(_CACHE_VERSION),
+                     source_mtime_ns=np.array(mtime_ns, dtype=np.int64),
+                     source_size=np.array(size, dtype=np.int64),
+                     source_sha256=np.array(file_hash),
+                     rate_codes=np.array(table.rate_codes, dtype=str),
+                     dates=table.dates,
+                     rates=table.rates)
+        os.replace(temporary_path, cache_path)
@@ -1,120 +1,264 @@
 import csv
-from typing import List, Dict
+import heapq
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import List, Dict, Final, Iterator, Sequence, Optional, Collection, Iterable, TextIO
 from model import Trade, Amount, TranslatedTrade
 from capital_gains_tax import CapitalGainsTax
 from abc import ABC, abstractmethod
 from datetime import datetime
+import instrumentation
+from fixed_point import SCALE, div_round, from_micros, parse_micros, to_micros
 
 
-class ReadWriter(ABC):
+# Writes the results of a run. Gains and trades are taken as iterables so that writers can be fed from streaming stages.
+class OutputWriter(ABC):
     @abstractmethod
-    def read_trades(self, file_path: str) -> List[Trade]:
+    def write_capital_gains(self, file_path: str, gains: Iterable[CapitalGainsTax]) -> None:
+        ...
+
+    @abstractmethod
+    def write_trades(self, file_path : str, trades: Iterable[TranslatedTrade]) -> None:
+        ...
+
+
+class ReadWriter(OutputWriter):
+    # Yields trades one at a time, in file order, without holding the whole statement in memory.
+    @abstractmethod
+    def iter_trades(self, file_path: str) -> Iterator[Trade]:
         ...
+
+    def read_trades(self, file_path: str) -> List[Trade]:
+        return list(self.iter_trades(file_path))
+
     # Source from page: https://rba.gov.au/statistics/historical-data.html#exchange-rates
     # Or directly here: https://rba.gov.au/statistics/tables/csv/f11.1-data.csv
-    # Returns rates in the form ccy.AUD.
-    def read_rba_rates(self, file_path: str) -> Dict[str,Dict[datetime, float]]:
+    # Returns rates in the form ccy.AUD. If rate_codes is given (e.g. {'USD.AUD'}) only those columns are parsed.
+    def read_rba_rates(self,
+                       file_path: str,
+                       rate_codes: Optional[Collection[str]] = None) -> Dict[str,Dict[datetime, float]]:
         results : Dict[str,Dict[datetime, float]] = dict()
         with open(file_path, newline='') as csvfile:
             # Skip multiple header rows.
             for i in range(5):
                 csvfile.readline()
-            reader = csv.DictReader(csvfile, delimiter=',', quotechar='"')
+            reader = csv.reader(csvfile, delimiter=',', quotechar='"')
+            header: List[str] = next(reader, [])
+            # Strangely formatted CSV does not have date header. Ends up being 'Units'.
+            date_column = header.index('Units')
+            columns: Dict[str, int] = dict()
+            for i, column in enumerate(header):
+                if column != 'Index' and column != 'Units' and column != '':
+                    rate_code = column + '.AUD'
+                    if rate_codes is None or rate_code in rate_codes:
+                        columns[rate_code] = i
+                        results[rate_code] = dict()
             for row in reader:
                 date : datetime
                 try:
-                    # Strangely formatted CSV does not have date header. Ends up being 'Units'.
-                    date = datetime.strptime(row["Units"], '%d-%b-%Y')
-                except ValueError:
+                    date = datetime.strptime(row[date_column], '%d-%b-%Y')
+                except (ValueError, IndexError):
                     continue
-                for column in row:
-                    if column != 'Index' and column != 'Units' and column != '':
-                        rate_code = column + '.AUD'
-                        if rate_code not in results.keys():
-                            results[rate_code] = dict()
-                        if row[column] != '':
-                            results[rate_code][date] = 1/float(row[column]) # Convention in file is AUD.ccy - need to swap.
+                for rate_code, i in columns.items():
+                    if i < len(row) and row[i] != '':
+                        results[rate_code][date] = 1/float(row[i]) # Convention in file is AUD.ccy - need to swap.
         return results
 
-    def write_capital_gains(self, file_path: str, gains: List[CapitalGainsTax]) -> None:
-        with open(file_path, mode='w') as file:
-            writer = csv.writer(file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-            header: List[str] = ['asset_code', 'buy_price', 'translated_buy_price', 'buy_date', 'sell_price',
-                                 'translated_sell_price','sell_date', 'quantity', 'taxable_gain',
+    def write_capital_gains(self, file_path: str, gains: Iterable[CapitalGainsTax]) -> None:
+        with open(file_path, mode='w', newline='', buffering=_WRITE_BUFFER_SIZE) as file:
+            _write_lines(file, _CAPITAL_GAINS_HEADER, _capital_gains_lines(gains))
+
+    def write_trades(self, file_path : str, trades: Iterable[TranslatedTrade]) -> None:
+        with open(file_path, mode='w', newline='', buffering=_WRITE_BUFFER_SIZE) as file:
+            _write_lines(file, _TRADES_HEADER, _trade_lines(trades))
+
+
+# Output files are written as the csv module would with QUOTE_MINIMAL and its default '\r\n' line terminator, but
+# each row is formatted with a single % operation and rows are handed to the file in batches. Numbers are formatted
+# with str(), as before. Dates and strings repeat across rows, so each distinct one is only formatted once per file.
+_WRITE_BUFFER_SIZE = 1 << 20
+_LINES_PER_BATCH = 4096
+_MAX_MEMO_ENTRIES = 1 << 16
+_LINE_TERMINATOR = '\r\n'
+
+_CAPITAL_GAINS_HEADER: Final = ['asset_code', 'buy_price', 'translated_buy_price', 'buy_date', 'sell_price',
+                                'translated_sell_price','sell_date', 'quantity', 'taxable_gain',
                                 'carried_capital_losses', 'buy_commission', 'sell_commission']
-            writer.writerow(header)
-            for gain in gains:
-                row: List[str] = [gain.matched_inventory.buy_trade.asset_code,
-                                  str(gain.matched_inventory.buy_trade.price),
-                                  str(gain.matched_inventory.buy_trade.translated_price),
-                                  str(gain.matched_inventory.buy_trade.date),
-                                  str(gain.matched_inventory.sell_trade.price),
-                                  str(gain.matched_inventory.sell_trade.translated_price),
-                                  str(gain.matched_inventory.sell_trade.date),
-                                  str(gain.matched_inventory.quantity),
-                                  str(gain.taxable_gain),
-                                  str(gain.carried_capital_losses),
-                                  str(gain.buy_commission),
-                                  str(gain.sell_commission)]
-                writer.writerow(row)
-
-    def write_trades(self, file_path : str, trades: List[TranslatedTrade]) -> None:
-        with open(file_path, mode='w') as file:
-            writer = csv.writer(file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-            with open(file_path, mode='w') as file:
-                header: List[str] = ['asset_code', 'date', 'price', 'currency', 'quantity', 'commission.value',
-                                     'commission.currency', 'aud_price', 'exchange_rate', 'aud_commission',
-                                     'trade_source']
-                writer.writerow(header)
-                for trade in trades:
-                    row: List[str] = [trade.asset_code,
-                                      str(trade.date),
-                                      str(trade.price),
-                                      str(trade.currency),
-                                      str(trade.quantity),
-                                      str(trade.commission.value),
-                                      str(trade.commission.currency),
-                                      str(trade.translated_price),
-                                      str(trade.exchange_rate),
-                                      str(trade.translated_commission),
-                                      str(trade.source)]
-                    writer.writerow(row)
+_CAPITAL_GAINS_LINE: Final = ','.join(['%s'] * len(_CAPITAL_GAINS_HEADER)) + _LINE_TERMINATOR
+_TRADES_HEADER: Final = ['asset_code', 'date', 'price', 'currency', 'quantity', 'commission.value',
+                         'commission.currency', 'aud_price', 'exchange_rate', 'aud_commission', 'trade_source']
+_TRADES_LINE: Final = ','.join(['%s'] * len(_TRADES_HEADER)) + _LINE_TERMINATOR
+
+
+# Memoised field formatting for one output file. Memos are dropped once large so a long stream cannot grow them
+# without bound.
+class _FieldFormatter:
+    def __init__(self) -> None:
+        self.dates: Dict[datetime, str] = dict()
+        self.texts: Dict[str, str] = dict()
+
+    # Same as str(date), e.g. '2019-07-01 14:48:19'.
+    def date(self, date: datetime) -> str:
+        if len(self.dates) >= _MAX_MEMO_ENTRIES:
+            self.dates.clear()
+        formatted = date.isoformat(' ')
+        self.dates[date] = formatted
+        return formatted
+
+    # Quotes the way csv.QUOTE_MINIMAL does.
+    def text(self, text: str) -> str:
+        if len(self.texts) >= _MAX_MEMO_ENTRIES:
+            self.texts.clear()
+        formatted = text
+        if ',' in text or '"' in text or '\r' in text or '\n' in text:
+            formatted = '"' + text.replace('"', '""') + '"'
+        self.texts[text] = formatted
+        return formatted
+
+
+def _capital_gains_lines(gains: Iterable[CapitalGainsTax]) -> Iterator[str]:
+    formatter = _FieldFormatter()
+    dates = formatter.dates
+    texts = formatter.texts
+    for gain in gains:
+        matched_inventory = gain.matched_inventory
+        buy_trade = matched_inventory.buy_trade
+        sell_trade = matched_inventory.sell_trade
+        yield _CAPITAL_GAINS_LINE % (texts.get(buy_trade.asset_code) or formatter.text(buy_trade.asset_code),
+                                     buy_trade.price,
+                                     buy_trade.translated_price,
+                                     dates.get(buy_trade.date) or formatter.date(buy_trade.date),
+                                     sell_trade.price,
+                                     sell_trade.translated_price,
+                                     dates.get(sell_trade.date) or formatter.date(sell_trade.date),
+                                     matched_inventory.quantity,
+                                     gain.taxable_gain,
+                                     gain.carried_capital_losses,
+                                     gain.buy_commission,
+                                     gain.sell_commission)
+
+
+def _trade_lines(trades: Iterable[TranslatedTrade]) -> Iterator[str]:
+    formatter = _FieldFormatter()
+    dates = formatter.dates
+    texts = formatter.texts
+    for trade in trades:
+        commission = trade.commission
+        yield _TRADES_LINE % (texts.get(trade.asset_code) or formatter.text(trade.asset_code),
+                              dates.get(trade.date) or formatter.date(trade.date),
+                              trade.price,
+                              texts.get(trade.currency) or formatter.text(trade.currency),
+                              trade.quantity,
+                              commission.value,
+                              texts.get(commission.currency) or formatter.text(commission.currency),
+                              trade.translated_price,
+                              trade.exchange_rate,
+                              trade.translated_commission,
+                              texts.get(trade.source) or formatter.text(trade.source))
+
+
+def _write_lines(file: TextIO, header: List[str], lines: Iterable[str]) -> None:
+    csv.writer(file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL).writerow(header)
+    iterator = iter(lines)
+    while True:
+        batch = list(islice(iterator, _LINES_PER_BATCH))
+        if len(batch) == 0:
+            return
+        file.writelines(batch)
+
+
+# Column positions within an IB 'Trades' table, resolved once per 'Trades,Header' row rather than per data row.
+# Columns that are not present in the table are set to -1.
+class _TradesColumns:
+    def __init__(self, header: List[str]):
+        def index(name: str) -> int:
+            return header.index(name) if name in header else -1
+
+        self.asset_category: Final = index('Asset Category')
+        self.currency: Final = index('Currency')
+        self.symbol: Final = index('Symbol')
+        self.date_time: Final = index('Date/Time')
+        self.quantity: Final = index('Quantity')
+        self.price: Final = index('T. Price')
+        self.proceeds: Final = index('Proceeds')
+        self.notional_value: Final = index('Notional Value')
+        self.commission: Final = index('Comm/Fee')
+        self.commission_in_aud: Final = index('Comm in AUD')
+
+    @staticmethod
+    def cell(cells: List[str], column: int, name: str) -> str:
+        if column < 0:
+            raise KeyError(name)
+        return cells[column]
+
+
+# Parses IB's fixed '%Y-%m-%d, %H:%M:%S' timestamps (e.g. 2019-07-01, 14:48:19) by slicing, falling back to strptime
+# for anything that does not have the expected shape.
+def _parse_date_time(text: str) -> datetime:
+    if len(text) == 20 and text[4] == '-' and text[7] == '-' and text[10] == ',' and text[11] == ' ' \
+            and text[14] == ':' and text[17] == ':':
+        return datetime(int(text[0:4]), int(text[5:7]), int(text[8:10]),
+                        int(text[12:14]), int(text[15:17]), int(text[18:20]))
+    return datetime.strptime(text, '%Y-%m-%d, %H:%M:%S')
+
 
 class InteractiveBrokersReadWriter(ReadWriter):
-    def read_trades(self, file_path: str) -> List[Trade]:  # ToDo: Created SortedList class.
-        trades = []
+    # With fixed_point, statement numbers are read as decimals rounded to micros (see fixed_point.py), and prices derived
+    # from them are rounded to micros from the exact quotient, so every quantity is exact for the fixed point engines.
+    def __init__(self, fixed_point: bool = False):
+        self.fixed_point: Final = fixed_point
+
+    def _number(self, text: str) -> float:
+        if self.fixed_point:
+            return from_micros(parse_micros(text))
+        return float(text.replace(",", ""))
+
+    # abs(numerator / denominator).
+    def _ratio(self, numerator: float, denominator: float) -> float:
+        if self.fixed_point:
+            return from_micros(div_round(abs(to_micros(numerator)) * SCALE, abs(to_micros(denominator))))
+        return abs(numerator / denominator)
+
+    def iter_trades(self, file_path: str) -> Iterator[Trade]:
         with open(file_path, newline='') as csv_file:
 
             # Cannot use built in csv due to strange formatting by IB.
             # There will be multiple tables in a given csv with different headers.
             #reader = csv.DictReader(csvfile, delimiter=',', quotechar='"')
             reader = csv.reader(csv_file, delimiter=',', quotechar='"')
-            for cells in reader:
-                if cells[0] != 'Trades':
-                    continue
-                if cells[1] == 'Header':
-                    header = list(cells)
-                    continue
-                if cells[2] != 'Order':
-                    continue
-                row: Dict[str, str] = dict(zip(header, cells))
-                if row['Asset Category'] == 'Forex':
-                    trades.append(self._process_forex(row))
-                else:
-                    trades.append(self._process_trade(row))
-        return trades
-
-    def _process_trade(self, row : Dict[str, str]) -> Trade:
-        date_time = datetime.strptime(row["Date/Time"],
-                                      '%Y-%m-%d, %H:%M:%S')  # 2019-07-01, 14:48:19
+            columns: _TradesColumns
+            # Rows read and trades parsed, counted once at the end for instrumentation.
+            rows = 0
+            parsed = 0
+            try:
+                for cells in reader:
+                    rows += 1
+                    if len(cells) == 0 or cells[0] != 'Trades':
+                        continue
+                    if cells[1] == 'Header':
+                        columns = _TradesColumns(cells)
+                        continue
+                    if cells[2] != 'Order':
+                        continue
+                    parsed += 1
+                    if _TradesColumns.cell(cells, columns.asset_category, 'Asset Category') == 'Forex':
+                        yield self._process_forex(cells, columns)
+                    else:
+                        yield self._process_trade(cells, columns)
+            finally:
+                instrumentation.count('rows_parsed', parsed)
+                instrumentation.count('rows_skipped', rows - parsed)
+
+    def _process_trade(self, cells: List[str], columns: _TradesColumns) -> Trade:
+        date_time = _parse_date_time(_TradesColumns.cell(cells, columns.date_time, "Date/Time"))  # 2019-07-01, 14:48:19
         #price: float = float(row["T. Price"].replace(",", "")) # Cannot use as contracts might have multipliers.
-        quantity: float = float(row["Quantity"].replace(",", ""))
-        proceeds: float = float(row["Notional Value"].replace(",", ""))
-        commission: float = float(row["Comm/Fee"].replace(",", ""))
-        symbol: str = str(row["Symbol"])
-        currency: str = str(row["Currency"])
-        asset_category: str = str(row["Asset Category"]).upper()
-        effective_price = abs(proceeds / quantity)
+        quantity: float = self._number(_TradesColumns.cell(cells, columns.quantity, "Quantity"))
+        proceeds: float = self._number(_TradesColumns.cell(cells, columns.notional_value, "Notional Value"))
+        commission: float = self._number(_TradesColumns.cell(cells, columns.commission, "Comm/Fee"))
+        symbol: str = str(_TradesColumns.cell(cells, columns.symbol, "Symbol"))
+        currency: str = str(_TradesColumns.cell(cells, columns.currency, "Currency"))
+        asset_category: str = str(_TradesColumns.cell(cells, columns.asset_category, "Asset Category")).upper()
+        effective_price = self._ratio(proceeds, quantity)
         return Trade(symbol,
                      asset_category,
                      date_time,
@@ -124,16 +268,15 @@ class InteractiveBrokersReadWriter(ReadWriter):
                      Amount(commission, currency),
                      'BROKER_REPORT')
 
-    def _process_forex(self, row : Dict[str, str]) ->Trade:
-        date_time = datetime.strptime(row["Date/Time"],
-                                      '%Y-%m-%d, %H:%M:%S')  # 2019-07-01, 14:48:19
-        price: float = float(row["T. Price"].replace(",", ""))
-        quantity: float = float(row["Quantity"].replace(",", ""))
-        proceeds: float = float(row["Proceeds"].replace(",", ""))
-        commission: float = float(row["Comm in AUD"].replace(",", ""))
-        symbol: str = str(row["Symbol"])
-        currency: str = str(row["Currency"])
-        asset_category: str = str(row["Asset Category"].upper())
+    def _process_forex(self, cells: List[str], columns: _TradesColumns) -> Trade:
+        date_time = _parse_date_time(_TradesColumns.cell(cells, columns.date_time, "Date/Time"))  # 2019-07-01, 14:48:19
+        price: float = self._number(_TradesColumns.cell(cells, columns.price, "T. Price"))
+        quantity: float = self._number(_TradesColumns.cell(cells, columns.quantity, "Quantity"))
+        proceeds: float = self._number(_TradesColumns.cell(cells, columns.proceeds, "Proceeds"))
+        commission: float = self._number(_TradesColumns.cell(cells, columns.commission_in_aud, "Comm in AUD"))
+        symbol: str = str(_TradesColumns.cell(cells, columns.symbol, "Symbol"))
+        currency: str = str(_TradesColumns.cell(cells, columns.currency, "Currency"))
+        asset_category: str = str(_TradesColumns.cell(cells, columns.asset_category, "Asset Category").upper())
 
         # Fix strange Interactive Brokers convention of setting AUD as quanity and USD amount as proceeds.
         # Possibly a result of indirect quoting. Swapping quantity/proceeds and AUD.USD to USD.AUD.
@@ -141,7 +284,7 @@ class InteractiveBrokersReadWriter(ReadWriter):
             return Trade("USD.AUD",
                                 asset_category,
                                 date_time,
-                                1 / price,  # NB: converted to USD.AUD.
+                                self._ratio(1, price),  # NB: converted to USD.AUD.
                                 # This is a bit of a hack as there should be a conversion class to
                                 # handle this. Keep as market convention quote, convert all floats to
                                 # Amounts which contain Currency and have a translater divide or
@@ -153,3 +296,25 @@ class InteractiveBrokersReadWriter(ReadWriter):
         else:
             raise NotImplementedError(
                 "Only AUD.USD currency trades implemented as I am unsure how IB treats other currencies.")
+
+
+def _get_date(trade: Trade) -> datetime:
+    return trade.date
+
+
+def _read_sorted_trades(reader: ReadWriter, file_path: str) -> List[Trade]:
+    return sorted(reader.iter_trades(file_path), key=_get_date)
+
+
+# Reads several statements into a single date-ordered stream. Each statement is parsed and sorted on its own (in a
+# process pool when jobs > 1) and the sorted statements are then k-way merged. Trades sharing a timestamp keep file
+# order and then statement order, so the result is the same for any number of jobs.
+def read_trade_files(reader: ReadWriter, file_paths: Sequence[str], jobs: int = 1) -> Iterator[Trade]:
+    sorted_statements: List[List[Trade]]
+    if jobs > 1 and len(file_paths) > 1:
+        readers: List[ReadWriter] = [reader] * len(file_paths)
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            sorted_statements = list(executor.map(_read_sorted_trades, readers, file_paths))
+    else:
+        sorted_statements = [_read_sorted_trades(reader, file_path) for file_path in file_paths]
+    return heapq.merge(*sorted_statements, key=_get_date)
@@ -0,0 +1,89 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Dict, Final, List, Optional, Sequence, Tuple
+
+from capital_gains_tax import CapitalGainsTaxAggregator, DiscountCapitalGainsTaxMethod
+from inventory_accounting import new_inventory_accountant
+from model import TranslatedTrade
+from proceeds_calculator import ForeignCurrencyProceedsCalculator
+
+
+# One what-if run over the same translated trades: the lot selection engine (see new_inventory_accountant) and the
+# capital losses carried into the run, as a negative number.
+class Scenario:
+    def __init__(self, name: str, engine: str, existing_capital_losses: float):
+        self.name: Final = name
+        self.engine: Final = engine
+        self.existing_capital_losses: Final = existing_capital_losses
+
+    # Parses ENGINE[:LOSSES], e.g. 'hifo:-5000'. Losses default to default_capital_losses.
+    @staticmethod
+    def parse(text: str, default_capital_losses: float) -> 'Scenario':
+        engine, _, losses = text.partition(':')
+        return Scenario(text, engine, float(losses) if losses != '' else default_capital_losses)
+
+
+# Totals of one scenario. taxable_gains is the sum of the taxable gains, after losses and discounts, over the run.
+class ScenarioResult:
+    def __init__(self,
+                 scenario: Scenario,
+                 number_of_matches: int,
+                 taxable_gains: float,
+                 carried_capital_losses: float):
+        self.scenario: Final = scenario
+        self.number_of_matches: Final = number_of_matches
+        self.taxable_gains: Final = taxable_gains
+        self.carried_capital_losses: Final = carried_capital_losses
+
+
+# Translated trades shared by every scenario in a worker. Set once per worker by the pool initializer: with fork the
+# parent's list is inherited copy-on-write, otherwise it is pickled once per worker rather than once per scenario.
+_shared_trades: List[TranslatedTrade] = []
+_shared_selections: Optional[Dict[Tuple[str, datetime], List[datetime]]] = None
+
+
+def _share(trades: List[TranslatedTrade], selections: Optional[Dict[Tuple[str, datetime], List[datetime]]]) -> None:
+    global _shared_trades, _shared_selections
+    _shared_trades = trades
+    _shared_selections = selections
+
+
+def _run_shared_scenario(scenario: Scenario) -> ScenarioResult:
+    return run_scenario(_shared_trades, scenario, _shared_selections)
+
+
+def run_scenario(trades: List[TranslatedTrade],
+                 scenario: Scenario,
+                 selections: Optional[Dict[Tuple[str, datetime], List[datetime]]] = None) -> ScenarioResult:
+    calculator = ForeignCurrencyProceedsCalculator(new_inventory_accountant(scenario.engine, selections))
+    _, matched_trades = calculator.calculate_proceeds_and_matches(trades)
+    aggregator = CapitalGainsTaxAggregator(DiscountCapitalGainsTaxMethod())
+    taxable_gains: float = 0
+    for gain in aggregator.iter_calculate(scenario.existing_capital_losses, matched_trades):
+        taxable_gains += gain.taxable_gain
+    return ScenarioResult(scenario, len(matched_trades), taxable_gains, aggregator.carried_capital_losses)
+
+
+# Runs every scenario over the same translated trades, in a process pool when jobs > 1. Results are in scenario order
+# and are the same for any number of jobs.
+def run_scenarios(trades: List[TranslatedTrade],
+                  scenarios: Sequence[Scenario],
+                  jobs: int = 1,
+                  selections: Optional[Dict[Tuple[str, datetime], List[datetime]]] = None) -> List[ScenarioResult]:
+    if jobs <= 1 or len(scenarios) <= 1:
+        return [run_scenario(trades, scenario, selections) for scenario in scenarios]
+    context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+    with ProcessPoolExecutor(max_workers=min(jobs, len(scenarios)), mp_context=context, initializer=_share,
+                             initargs=(trades, selections)) as executor:
+        return list(executor.map(_run_shared_scenario, scenarios))
+
+
+def format_scenario_table(results: Sequence[ScenarioResult]) -> str:
+    lines: List[str] = ['{:<20} {:<8} {:>16} {:>8} {:>16} {:>16}'.format(
+        'scenario', 'engine', 'opening_losses', 'matches', 'taxable_gains', 'carried_losses')]
+    for result in results:
+        lines.append('{:<20} {:<8} {:>16,.2f} {:>8} {:>16,.2f} {:>16,.2f}'.format(
+            result.scenario.name, result.scenario.engine, result.scenario.existing_capital_losses,
+            result.number_of_matches, result.taxable_gains, result.carried_capital_losses))
+    return '\n'.join(lines)
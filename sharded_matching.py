@@ -0,0 +1,177 @@
+import gc
+import heapq
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Dict, Final, Iterable, Iterator, List, Optional, Tuple
+
+from inventory_accounting import InventoryAccountant, InventoryState, MatchedInventory, TradePartialMatch, \
+    check_date_order
+from model import TranslatedTrade
+import instrumentation
+
+# A match as indices into the shared trade references (see _share): opening trade, closing trade, quantity.
+_IndexedMatch = Tuple[int, int, float]
+
+
+# What a worker sends back for one shard. Trades are sent as indices rather than pickled, so the matches and lots
+# rebuilt by the parent refer to the parent's own trade objects.
+class _ShardResult:
+    def __init__(self,
+                 matches: List[_IndexedMatch],
+                 open_lots: Dict[str, List[Tuple[int, float]]],
+                 current_balance: Dict[str, float],
+                 counters: Dict[str, int]):
+        self.matches: Final = matches
+        self.open_lots: Final = open_lots
+        self.current_balance: Final = current_balance
+        # The instrumentation the engine counted.
+        self.counters: Final = counters
+
+
+# Trade references and state shared by every shard in a worker, set once per worker by the pool initializer (see
+# scenarios._share). References are the sorted trades followed by the trades of the carried lots.
+_shared_accountant: InventoryAccountant[TranslatedTrade]
+_shared_references: List[TranslatedTrade] = []
+_shared_state: Optional[InventoryState[TranslatedTrade]] = None
+
+
+def _share(accountant: InventoryAccountant[TranslatedTrade],
+           references: List[TranslatedTrade],
+           state: Optional[InventoryState[TranslatedTrade]]) -> None:
+    global _shared_accountant, _shared_references, _shared_state
+    _shared_accountant = accountant
+    _shared_references = references
+    _shared_state = state
+
+
+def _match_shared_shard(shard: Tuple[List[str], List[int]]) -> _ShardResult:
+    asset_codes, trade_indices = shard
+    references = _shared_references
+    state: Optional[InventoryState[TranslatedTrade]] = None
+    reference_index: Dict[int, int] = {id(references[i]): i for i in trade_indices}
+    if _shared_state is not None:
+        state = _shared_state.copy(set(asset_codes))
+        # Lots carried in from state open with trades that come after the sorted trades in the references.
+        for i in range(len(references) - sum(len(lots) for lots in _shared_state.open_lots.values()), len(references)):
+            reference_index[id(references[i])] = i
+
+    # The forked recorder still holds the parent's counts, so only what this shard adds is sent back.
+    recorder = instrumentation.recorder()
+    counters_before: Dict[str, int] = dict(recorder.counters) if recorder is not None else dict()
+    matches: List[_IndexedMatch] = [
+        (reference_index[id(match.buy_trade)], reference_index[id(match.sell_trade)], match.quantity)
+        for match in _shared_accountant.iter_match_trades((references[i] for i in trade_indices), state)]
+    counters: Dict[str, int] = dict()
+    if recorder is not None:
+        counters = {name: count - counters_before.get(name, 0) for name, count in recorder.counters.items()
+                    if count != counters_before.get(name, 0)}
+
+    open_lots: Dict[str, List[Tuple[int, float]]] = dict()
+    current_balance: Dict[str, float] = dict()
+    if state is not None:
+        for asset_code, lots in state.open_lots.items():
+            open_lots[asset_code] = [(reference_index[id(lot.trade)], lot.remaining_quantity) for lot in lots]
+        current_balance = dict(state.current_balance)
+    return _ShardResult(matches, open_lots, current_balance, counters)
+
+
+# Matches with any InventoryAccountant, split by asset code over a process pool. Assets never interact while lots are
+# matched, so each shard (a group of asset codes) is matched on its own and the matches are merged back in the order
+# of their closing trade, which is the order the accountant yields them in over all the trades at once. Matches,
+# their quantities and the state left behind are the same, bit for bit, as running the accountant in one process.
+# Matching only starts once every trade has been read, so unlike the engines' own iter_match_trades this does not
+# stream.
+class ShardedInventoryAccountant(InventoryAccountant[TranslatedTrade]):
+    def __init__(self, inventory_accountant: InventoryAccountant[TranslatedTrade], jobs: int):
+        self.inventory_accountant: Final = inventory_accountant
+        self.jobs: Final = jobs
+
+    def iter_match_trades(self,
+                          sorted_trades: Iterable[TranslatedTrade],
+                          state: Optional[InventoryState[TranslatedTrade]] = None) \
+            -> Iterator[MatchedInventory[TranslatedTrade]]:
+        if self.jobs <= 1:
+            yield from self.inventory_accountant.iter_match_trades(sorted_trades, state)
+            return
+
+        # Date order is checked over all the trades here, as a shard only sees its own.
+        references: List[TranslatedTrade] = []
+        trade_indices: Dict[str, List[int]] = dict()
+        last_date: Optional[datetime] = None
+        for trade in sorted_trades:
+            last_date = check_date_order(last_date, trade)
+            trade_indices.setdefault(trade.asset_code, []).append(len(references))
+            references.append(trade)
+        number_of_trades = len(references)
+        if state is not None:
+            for lots in state.open_lots.values():
+                references.extend(lot.trade for lot in lots)
+            for asset_code in state.open_lots:
+                trade_indices.setdefault(asset_code, [])
+
+        shards = _shards(trade_indices, self.jobs)
+        if len(shards) <= 1:
+            yield from self.inventory_accountant.iter_match_trades(references[:number_of_trades], state)
+            return
+
+        # Objects that exist before the fork are frozen out of garbage collection while the pool runs, so collections
+        # in the workers do not walk, and so copy, every inherited trade.
+        context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+        gc.freeze()
+        try:
+            with ProcessPoolExecutor(max_workers=len(shards), mp_context=context, initializer=_share,
+                                     initargs=(self.inventory_accountant, references, state)) as executor:
+                results: List[_ShardResult] = list(executor.map(_match_shared_shard, shards))
+        finally:
+            gc.unfreeze()
+
+        for result in results:
+            for name, count in result.counters.items():
+                instrumentation.count(name, count)
+
+        def get_sell_index(match: _IndexedMatch) -> int:
+            return match[1]
+
+        # Every match of a closing trade comes from the one shard that holds its asset, in the order it was made.
+        for buy_index, sell_index, quantity in heapq.merge(*(result.matches for result in results),
+                                                          key=get_sell_index):
+            yield MatchedInventory(references[buy_index], references[sell_index], quantity)
+
+        # State is updated asset by asset in the order the engines update it: carried assets, then new assets in the
+        # order they first trade. Balances of assets that are flat and not traded are left as they were.
+        if state is not None:
+            results_by_asset: Dict[str, _ShardResult] = {asset_code: result
+                                                         for (asset_codes, _), result in zip(shards, results)
+                                                         for asset_code in asset_codes}
+            for asset_code in list(state.open_lots) + [code for code in trade_indices if code not in state.open_lots]:
+                result = results_by_asset[asset_code]
+                if asset_code in result.open_lots:
+                    state.open_lots[asset_code] = [_lot(references[index], remaining_quantity)
+                                                   for index, remaining_quantity in result.open_lots[asset_code]]
+                else:
+                    state.open_lots.pop(asset_code, None)
+                state.current_balance[asset_code] = result.current_balance[asset_code]
+
+
+def _lot(trade: TranslatedTrade, remaining_quantity: float) -> TradePartialMatch[TranslatedTrade]:
+    lot = TradePartialMatch(trade)
+    lot.remaining_quantity = remaining_quantity
+    return lot
+
+
+# Groups asset codes into at most jobs shards of about the same number of trades: largest assets first, each to the
+# shard with the fewest trades so far. Returns each shard's asset codes and its trade indices in trade order.
+def _shards(trade_indices: Dict[str, List[int]], jobs: int) -> List[Tuple[List[str], List[int]]]:
+    number_of_shards = max(1, min(jobs, len(trade_indices)))
+    loads: List[Tuple[int, int]] = [(0, shard) for shard in range(number_of_shards)]
+    asset_codes: List[List[str]] = [[] for _ in range(number_of_shards)]
+    def get_number_of_trades(asset_code: str) -> int:
+        return len(trade_indices[asset_code])
+
+    for asset_code in sorted(trade_indices, key=get_number_of_trades, reverse=True):
+        load, shard = heapq.heappop(loads)
+        asset_codes[shard].append(asset_code)
+        heapq.heappush(loads, (load + len(trade_indices[asset_code]), shard))
+    return [(codes, sorted(index for code in codes for index in trade_indices[code]))
+            for codes in asset_codes if len(codes) > 0]
@@ -0,0 +1,36 @@
+import calendar
+from datetime import date, datetime, timedelta
+from typing import Dict, Final
+
+
+# First day on which a sale of an asset bought on buy_date is eligible for the CGT discount, at midnight. Per the
+# ATO's example: Sally bought a CGT asset on 2 February. Her 12-month ownership period started on 3 February (the day
+# after she bought the asset) and ends at the end of 2 February the following year, so a sale from 3 February the
+# following year gets the discount.
+# The anniversary of a 29 February purchase is taken as 28 February, so the asset must be held until 1 March.
+# Month ends (e.g. 31 January -> 1 February, 31 December -> 1 January) simply roll over to the next day.
+def discount_eligibility_date(buy_date: datetime) -> datetime:
+    buy_day = buy_date.toordinal()
+    eligible = _eligibility_dates.get(buy_day)
+    if eligible is None:
+        eligible = _eligibility_dates[buy_day] = _eligibility_date(buy_day)
+    return eligible
+
+
+# Memoised per calendar day (as a proleptic Gregorian ordinal), since every partial match of a lot and every lot bought
+# that day share the answer. There is one entry per distinct buy day, so the memo stays small.
+_eligibility_dates: Final[Dict[int, datetime]] = dict()
+
+
+def _eligibility_date(buy_day: int) -> datetime:
+    bought = date.fromordinal(buy_day)
+    anniversary = date(bought.year + 1, bought.month,
+                       min(bought.day, calendar.monthrange(bought.year + 1, bought.month)[1]))
+    eligible = anniversary + timedelta(days=1)
+    return datetime(eligible.year, eligible.month, eligible.day)
+
+
+# Australian financial year a date falls in, named for the calendar year it ends in: 1 July 2019 to 30 June 2020 is
+# 2020.
+def financial_year(day: datetime) -> int:
+    return day.year + 1 if day.month >= 7 else day.year
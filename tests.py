@@ -1,11 +1,37 @@
+import calendar
+import csv
+import io
+import json
+import os
 import random
+import shutil
+import tempfile
+import tracemalloc
+import unittest
 from unittest import TestCase
-from read_writer import InteractiveBrokersReadWriter
+import numpy as np
+from read_writer import InteractiveBrokersReadWriter, read_trade_files
+from rate_cache import RbaRateCache
+from columnar_writer import ColumnarWriter, read_columnar
+import columnar_writer
+from trade_table import TradeTable
+from proceeds_calculator import ForeignCurrencyProceedsCalculator, ProxyTrade, RematchPoint, _net_commissions
 from inventory_accounting import *
 from capital_gains_tax import *
-from typing import List
+from typing import List, Dict, Optional, Sequence, Tuple, cast
 from model import *
-from datetime import datetime
+from profile import LeftPiecewiseConstantProfile
+from tax_calendar import discount_eligibility_date, financial_year
+from foreign_asset_translator import ForeignAssetTranslator, required_rate_codes
+from inventory_manager import BalanceIndex, write_open_lots_report
+from inventory_snapshot import InventorySnapshot, ProcessedStatement, read_snapshot, write_snapshot
+from scenarios import Scenario, run_scenarios, format_scenario_table
+import instrumentation
+from fixed_point import div_round, from_micros, parse_micros, to_micros
+from sharded_matching import ShardedInventoryAccountant
+from query_service import QueryClient, QueryService, WarmPipeline
+import asyncio
+from datetime import datetime, timedelta
 
 
 #--no-incremental
@@ -16,11 +42,302 @@ class TestFileReader(TestCase):
         file_reader = InteractiveBrokersReadWriter()
         file_reader.read_trades("./test_data/trades.csv")
 
+    def test_iter_trades(self) -> None:
+        file_reader = InteractiveBrokersReadWriter()
+        trades: List[Trade] = list(file_reader.iter_trades("./test_data/trades.csv"))
+        self.assertEqual(len(trades), 3)
+        self.assertEqual(trades[0].asset_code, 'USD.AUD')
+        self.assertEqual(trades[0].date, datetime(2019, 7, 1, 14, 48, 19))
+        self.assertEqual(trades[0].quantity, -22371.9804)
+        self.assertEqual(trades[0].commission.value, -2.8484)
+        self.assertEqual([trade.date for trade in trades], [trade.date for trade in file_reader.read_trades("./test_data/trades.csv")])
+
+    def test_read_selected_rba_rates(self) -> None:
+        file_reader = InteractiveBrokersReadWriter()
+        all_rates: Dict[str, Dict[datetime, float]] = file_reader.read_rba_rates("./test_data/f11.1-data.csv")
+        usd_rates: Dict[str, Dict[datetime, float]] = file_reader.read_rba_rates("./test_data/f11.1-data.csv",
+                                                                                  {'USD.AUD'})
+        self.assertEqual(usd_rates, {'USD.AUD': all_rates['USD.AUD']})
+        self.assertNotIn('TWI.AUD', all_rates)
+
+    def test_read_trade_files_parallel(self) -> None:
+        header = 'Trades,Header,DataDiscriminator,Asset Category,Currency,Account,Symbol,Date/Time,Exchange,Quantity,' \
+                 'T. Price,Proceeds,Comm in AUD,Code\n'
+        statements: List[List[str]] = [['2019-07-20, 08:27:20', '2019-07-01, 14:48:19', '2019-08-07, 08:00:49'],
+                                       ['2019-07-20, 08:27:20', '2019-06-01, 10:00:00']]
+        with tempfile.TemporaryDirectory() as directory:
+            file_paths: List[str] = []
+            for i, dates in enumerate(statements):
+                file_path = os.path.join(directory, 'statement_' + str(i) + '.csv')
+                with open(file_path, 'w') as file:
+                    file.write(header)
+                    for j, date in enumerate(dates):
+                        file.write('Trades,Data,Order,Forex,USD,U111111,AUD.USD,"' + date + '",-,' + str(i * 10 + j + 1)
+                                   + ',0.7,-' + str(i * 10 + j + 1) + ',0,\n')
+                file_paths.append(file_path)
+            file_reader = InteractiveBrokersReadWriter()
+            serial: List[Trade] = list(read_trade_files(file_reader, file_paths, 1))
+            parallel: List[Trade] = list(read_trade_files(file_reader, file_paths, 2))
+        self.assertEqual([trade.quantity for trade in serial], [-12, -2, -1, -11, -3])
+        self.assertEqual([(trade.date, trade.quantity) for trade in parallel],
+                         [(trade.date, trade.quantity) for trade in serial])
+
+    # Written files must be byte-identical to a plain csv.writer over str() formatted fields.
+    def test_write_matches_csv_module(self) -> None:
+        trades: List[TranslatedTrade] = [
+            TranslatedTrade(Trade('ES', 'FUTURES', datetime(2019, 7, 1, 14, 48, 19), 2950.25, 'USD', 2,
+                                  Amount(-2.5, 'USD'), 'BROKER'), 4200.35, 1.4237, -3.559, 'AUD'),
+            TranslatedTrade(Trade('A,"B"', 'FUTURES', datetime(2019, 7, 2, 9, 0, 0, 1500), 1e-7, 'AUD', -2,
+                                  Amount(0, 'AUD'), 'line\nbreak'), 1e-7, 1.0, 0, 'AUD')]
+        gains: List[CapitalGainsTax] = [CapitalGainsTax(MatchedInventory(trades[0], trades[1], 2), 0, -12.75, -3.559, 0)]
+        file_reader = InteractiveBrokersReadWriter()
+        with tempfile.TemporaryDirectory() as directory:
+            gains_path = os.path.join(directory, 'gains.csv')
+            trades_path = os.path.join(directory, 'trades.csv')
+            file_reader.write_capital_gains(gains_path, iter(gains))
+            file_reader.write_trades(trades_path, iter(trades))
+            with open(gains_path, newline='') as file:
+                written_gains = file.read()
+            with open(trades_path, newline='') as file:
+                written_trades = file.read()
+
+        def csv_text(rows: Sequence[Sequence[object]]) -> str:
+            output = io.StringIO()
+            csv.writer(output, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL).writerows(
+                [[str(value) for value in row] for row in rows])
+            return output.getvalue()
+
+        gain = gains[0]
+        buy, sell = gain.matched_inventory.buy_trade, gain.matched_inventory.sell_trade
+        self.assertEqual(written_gains, csv_text([
+            ['asset_code', 'buy_price', 'translated_buy_price', 'buy_date', 'sell_price', 'translated_sell_price',
+             'sell_date', 'quantity', 'taxable_gain', 'carried_capital_losses', 'buy_commission', 'sell_commission'],
+            [buy.asset_code, buy.price, buy.translated_price, buy.date, sell.price, sell.translated_price, sell.date,
+             gain.matched_inventory.quantity, gain.taxable_gain, gain.carried_capital_losses, gain.buy_commission,
+             gain.sell_commission]]))
+        self.assertEqual(written_trades, csv_text(
+            [['asset_code', 'date', 'price', 'currency', 'quantity', 'commission.value', 'commission.currency',
+              'aud_price', 'exchange_rate', 'aud_commission', 'trade_source']]
+            + [[t.asset_code, t.date, t.price, t.currency, t.quantity, t.commission.value, t.commission.currency,
+                t.translated_price, t.exchange_rate, t.translated_commission, t.source] for t in trades]))
+
     def test_read_rba_file(self) -> None:
         file_reader = InteractiveBrokersReadWriter()
         file_reader.read_rba_rates("./test_data/f11.1-data.csv")
 
 
+class ColumnarWriterTests(TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        self.trades: List[TranslatedTrade] = sorted(_random_translated_trades(5, 7), key=_get_date)
+        matches = QueuedFirstInFirstOutInventory[TranslatedTrade]().match_trades(self.trades)
+        self.gains: List[CapitalGainsTax] = CapitalGainsTaxAggregator(DiscountCapitalGainsTaxMethod()).calculate(-5, matches)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.directory)
+
+    def _assert_round_trip(self, writer: ColumnarWriter) -> None:
+        trades_path = os.path.join(self.directory, 'trades' + writer.extension)
+        gains_path = os.path.join(self.directory, 'gains' + writer.extension)
+        writer.write_trades(trades_path, iter(self.trades))
+        writer.write_capital_gains(gains_path, iter(self.gains))
+
+        trades = read_columnar(trades_path)
+        self.assertEqual(trades['asset_code'].tolist(), [trade.asset_code for trade in self.trades])
+        self.assertEqual(trades['date'].astype(datetime).tolist(), [trade.date for trade in self.trades])
+        self.assertEqual(trades['aud_price'].tolist(), [trade.translated_price for trade in self.trades])
+        self.assertEqual(trades['commission.currency'].tolist(), [trade.commission.currency for trade in self.trades])
+        self.assertEqual(trades['trade_source'].tolist(), [trade.source for trade in self.trades])
+
+        gains = read_columnar(gains_path)
+        self.assertGreater(len(self.gains), 0)
+        self.assertEqual(gains['sell_date'].astype(datetime).tolist(),
+                         [gain.matched_inventory.sell_trade.date for gain in self.gains])
+        self.assertEqual(gains['taxable_gain'].tolist(), [gain.taxable_gain for gain in self.gains])
+        self.assertEqual(gains['carried_capital_losses'].tolist(), [gain.carried_capital_losses for gain in self.gains])
+
+    def test_npz_round_trip(self) -> None:
+        # Small row groups so values span several groups, each with its own categories.
+        self._assert_round_trip(ColumnarWriter(row_group_size=2, use_parquet=False))
+
+    @unittest.skipIf(not columnar_writer._HAS_PYARROW, 'pyarrow is not installed')
+    def test_parquet_round_trip(self) -> None:
+        self._assert_round_trip(ColumnarWriter(row_group_size=2, use_parquet=True))
+
+    def test_empty_output(self) -> None:
+        path = os.path.join(self.directory, 'gains.npz')
+        ColumnarWriter(use_parquet=False).write_capital_gains(path, iter([]))
+        gains = read_columnar(path)
+        self.assertEqual(len(gains['taxable_gain']), 0)
+        self.assertEqual(gains['sell_date'].dtype, np.dtype('datetime64[us]'))
+
+
+class RbaRateCacheTests(TestCase):
+    def test_cache_round_trip(self) -> None:
+        file_reader = InteractiveBrokersReadWriter()
+        expected: Dict[str, Dict[datetime, float]] = file_reader.read_rba_rates("./test_data/f11.1-data.csv")
+        with tempfile.TemporaryDirectory() as directory:
+            file_path = os.path.join(directory, 'f11.1-data.csv')
+            shutil.copyfile("./test_data/f11.1-data.csv", file_path)
+            rate_cache = RbaRateCache()
+            self.assertEqual(rate_cache.read_rba_rates(file_path), expected)
+            self.assertEqual(rate_cache.last_load, 'full')
+            self.assertTrue(os.path.exists(RbaRateCache.cache_path(file_path)))
+            self.assertEqual(rate_cache.read_rba_rates(file_path), expected)
+            self.assertEqual(rate_cache.last_load, 'cache')
+
+            os.utime(file_path, ns=(0, 0))
+            self.assertEqual(rate_cache.read_rba_rates(file_path), expected)
+            self.assertEqual(rate_cache.last_load, 'cache')
+
+    def test_incremental_append(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            file_path = os.path.join(directory, 'f11.1-data.csv')
+            shutil.copyfile("./test_data/f11.1-data.csv", file_path)
+            rate_cache = RbaRateCache()
+            rate_cache.read_rba_rates(file_path)
+            with open(file_path, 'a') as file:
+                file.write('04-Jan-2021,0.7500,,,,,,,,,,,,,,,,,,,,,,\n')
+            rates: Dict[str, Dict[datetime, float]] = rate_cache.read_rba_rates(file_path)
+            self.assertEqual(rate_cache.last_load, 'incremental')
+            self.assertEqual(rates, InteractiveBrokersReadWriter().read_rba_rates(file_path))
+            self.assertEqual(rates['USD.AUD'][datetime(2021, 1, 4)], 1 / 0.75)
+
+    def test_revised_rate(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            file_path = os.path.join(directory, 'f11.1-data.csv')
+            shutil.copyfile("./test_data/f11.1-data.csv", file_path)
+            rate_cache = RbaRateCache()
+            rate_cache.read_rba_rates(file_path)
+            with open(file_path, newline='') as file:
+                content = file.read()
+            with open(file_path, 'w', newline='') as file:
+                file.write(content.replace('02-Jan-2020,0.7003,', '02-Jan-2020,0.7004,')
+                           + '04-Jan-2021,0.7500,,,,,,,,,,,,,,,,,,,,,,\r\n')
+            rates: Dict[str, Dict[datetime, float]] = rate_cache.read_rba_rates(file_path)
+            self.assertEqual(rate_cache.last_load, 'full')
+            self.assertEqual(rates, InteractiveBrokersReadWriter().read_rba_rates(file_path))
+            self.assertEqual(rates['USD.AUD'][datetime(2020, 1, 2)], 1 / 0.7004)
+
+
+class LeftPiecewiseConstantProfileTests(TestCase):
+    def _profile(self) -> LeftPiecewiseConstantProfile:
+        return LeftPiecewiseConstantProfile('USD.AUD', {datetime(2020, 1, 3): 3.0,
+                                                        datetime(2020, 1, 1): 1.0,
+                                                        datetime(2020, 1, 2): 2.0})
+
+    def test_lookup(self) -> None:
+        profile = self._profile()
+        self.assertEqual(profile[datetime(2020, 1, 1)], 1.0)
+        self.assertEqual(profile[datetime(2020, 1, 1, 14, 30)], 1.0)
+        self.assertEqual(profile[datetime(2020, 1, 2)], 2.0)
+        self.assertEqual(profile[datetime(2020, 1, 2, 23, 59)], 2.0)
+        self.assertEqual(profile[datetime(2020, 1, 3)], 3.0)
+
+    def test_out_of_range(self) -> None:
+        profile = self._profile()
+        with self.assertRaises(KeyError):
+            profile[datetime(2019, 12, 31)]
+        with self.assertRaises(KeyError):
+            profile[datetime(2020, 1, 3, 0, 0, 1)]
+        with self.assertRaises(KeyError):
+            profile.lookup_many([datetime(2020, 1, 2), datetime(2019, 12, 31)])
+
+    def test_lookup_many(self) -> None:
+        profile = self._profile()
+        dates: List[datetime] = [datetime(2020, 1, 2, 12), datetime(2020, 1, 1, 9), datetime(2020, 1, 3),
+                                 datetime(2020, 1, 1, 10), datetime(2020, 1, 2)]
+        self.assertEqual(profile.lookup_many(dates), [profile[date] for date in dates])
+        self.assertEqual(profile.lookup_many([]), [])
+
+
+class ForeignAssetTranslatorTests(TestCase):
+    def _translator(self) -> ForeignAssetTranslator:
+        return ForeignAssetTranslator({'USD.AUD': {datetime(2020, 1, 1): 1.5, datetime(2020, 1, 2): 1.4,
+                                                   datetime(2020, 1, 3): 1.3},
+                                       'EUR.AUD': {datetime(2020, 1, 1): 1.6, datetime(2020, 1, 2): 1.7,
+                                                   datetime(2020, 1, 3): 1.8}})
+
+    def test_convert_trades_matches_convert_trade(self) -> None:
+        trades: List[Trade] = [
+            Trade("ES", 'FUTURES', datetime(2020, 1, 1, 10), 3000, "USD", 1, Amount(-2.5, "USD"), 'Test'),
+            Trade("FESX", 'FUTURES', datetime(2020, 1, 2, 10), 3500, "EUR", -1, Amount(-1.5, "EUR"), 'Test'),
+            Trade("BHP", 'FUTURES', datetime(2020, 1, 1, 11), 40, "AUD", 10, Amount(-3, "AUD"), 'Test'),
+            Trade("USD.AUD", 'FOREX', datetime(2020, 1, 2, 11), 1.41, "AUD", 100, Amount(-2, "USD"), 'Test')]
+        translator = self._translator()
+        converted: List[TranslatedTrade] = translator.convert_trades(trades)
+        for trade, translated in zip(trades, converted):
+            expected = translator.convert_trade(trade)
+            self.assertIs(translated.date, trade.date)
+            self.assertEqual(translated.translated_price, expected.translated_price)
+            self.assertEqual(translated.exchange_rate, expected.exchange_rate)
+            # As written to processed_trades, e.g. 1 rather than 1.0 for AUD trades.
+            self.assertEqual(str(translated.exchange_rate), str(expected.exchange_rate))
+            self.assertEqual(translated.translated_commission, expected.translated_commission)
+            self.assertEqual(translated.translated_currency, 'AUD')
+
+    def test_profiles_built_on_first_use(self) -> None:
+        translator = self._translator()
+        self.assertEqual(len(translator.fx_profiles), 0)
+        trades: List[Trade] = [
+            Trade("ES", 'FUTURES', datetime(2020, 1, 1, 10), 3000, "USD", 1, Amount(-2.5, "USD"), 'Test'),
+            Trade("BHP", 'FUTURES', datetime(2020, 1, 1, 11), 40, "AUD", 10, Amount(-3, "AUD"), 'Test')]
+        self.assertEqual(required_rate_codes(trades), {'USD.AUD'})
+        translator.convert_trades(trades)
+        self.assertEqual(list(translator.fx_profiles), ['USD.AUD'])
+
+    def test_convert_trades_out_of_range(self) -> None:
+        trades: List[Trade] = [
+            Trade("ES", 'FUTURES', datetime(2020, 1, 4), 3000, "USD", 1, Amount(0, "USD"), 'Test')]
+        with self.assertRaises(KeyError):
+            self._translator().convert_trades(trades)
+
+
+class TradeTableTests(TestCase):
+    def _trades(self) -> List[Trade]:
+        return [Trade("ES", 'FUTURES', datetime(2020, 1, 1, 10, 0, 0, 250), 3000, "USD", 1, Amount(-2.5, "USD"), 'Test'),
+                Trade("ES", 'FUTURES', datetime(2020, 1, 2, 10), 3010, "USD", -1, Amount(-2.5, "USD"), 'Test'),
+                Trade("BHP", 'FUTURES', datetime(2020, 1, 1, 11), 40, "AUD", 10, Amount(-3, "AUD"), 'Test')]
+
+    def test_round_trip(self) -> None:
+        trades: List[Trade] = self._trades()
+        table = TradeTable.from_trades(trades)
+        self.assertEqual(len(table), 3)
+        self.assertFalse(table.is_translated)
+        self.assertEqual(table.asset_code.categories, ['ES', 'BHP'])
+        for expected, actual in zip(trades, table.to_trades()):
+            self.assertEqual((actual.asset_code, actual.asset_category, actual.date, actual.price, actual.currency,
+                              actual.quantity, actual.commission.value, actual.commission.currency, actual.source),
+                             (expected.asset_code, expected.asset_category, expected.date, expected.price,
+                              expected.currency, expected.quantity, expected.commission.value,
+                              expected.commission.currency, expected.source))
+        with self.assertRaises(ValueError):
+            table.to_translated_trades()
+
+    def test_convert_table(self) -> None:
+        translator = ForeignAssetTranslator({'USD.AUD': {datetime(2020, 1, 1): 1.5, datetime(2020, 1, 2): 1.4,
+                                                         datetime(2020, 1, 3): 1.3}})
+        trades: List[Trade] = self._trades()
+        expected: List[TranslatedTrade] = translator.convert_trades(trades)
+        table = translator.convert_table(TradeTable.from_trades(trades))
+        translated: List[TranslatedTrade] = table.to_translated_trades()
+        self.assertEqual([trade.translated_price for trade in translated],
+                         [trade.translated_price for trade in expected])
+        self.assertEqual([trade.translated_commission for trade in translated],
+                         [trade.translated_commission for trade in expected])
+        rebuilt_prices = TradeTable.from_trades(translated).translated_price
+        assert rebuilt_prices is not None and table.translated_price is not None
+        self.assertEqual(rebuilt_prices.tolist(), table.translated_price.tolist())
+        matched_trades = QueuedFirstInFirstOutInventory[TranslatedTrade]().match_trades(table.iter_translated_trades())
+        self.assertEqual([(m.buy_trade.price, m.sell_trade.price, m.quantity) for m in matched_trades],
+                         [(3000, 3010, 1)])
+
+    def test_slots(self) -> None:
+        trade = self._trades()[0]
+        with self.assertRaises(AttributeError):
+            trade.__dict__
+
+
 class FifoInventoryTests(TestCase):
     def test_basic(self) -> None:
         trades: List[Trade] = []
@@ -166,6 +483,712 @@ class FifoInventoryTests(TestCase):
                   + " Days: " + str((tax_event.sell_trade.date - tax_event.buy_trade.date).days))
 
 
+class QueuedFifoInventoryTests(TestCase):
+    def _assert_same_matches(self, trades: List[Trade]) -> None:
+        expected: List[MatchedInventory[Trade]] = FirstInFirstOutInventory[Trade]().match_trades(trades)
+        actual: List[MatchedInventory[Trade]] = QueuedFirstInFirstOutInventory[Trade]().match_trades(trades)
+        self.assertEqual(len(actual), len(expected))
+        for actual_match, expected_match in zip(actual, expected):
+            self.assertIs(actual_match.buy_trade, expected_match.buy_trade)
+            self.assertIs(actual_match.sell_trade, expected_match.sell_trade)
+            self.assertEqual(actual_match.quantity, expected_match.quantity)
+
+    def _random_trades(self, seed: int, number_of_trades: int, fractional: bool) -> List[Trade]:
+        rng = random.Random(seed)
+        trades: List[Trade] = []
+        for i in range(number_of_trades):
+            quantity: float = rng.choice([-1, 1]) * rng.randint(1, 20)
+            if fractional:
+                quantity = round(quantity * rng.random(), 4) or 1
+            trades.append(Trade(rng.choice(["BHP", "CBA", "ES"]), 'FUTURES', datetime(2020, 1, 1) + timedelta(hours=i // 3),
+                                rng.uniform(1, 20), "AUD", quantity, Amount(0, "AUD"), 'Test'))
+        rng.shuffle(trades)
+        return trades
+
+    def test_existing_cases(self) -> None:
+        trades: List[Trade] = []
+        trades.append(Trade("BHP", 'FUTURES', datetime(2020, 1, 1), 10, "AUD", 12, Amount(0, "AUD"), 'Test'))
+        trades.append(Trade("BHP", 'FUTURES', datetime(2020, 1, 2), 11, "AUD", 12, Amount(0, "AUD"), 'Test'))
+        trades.append(Trade("BHP", 'FUTURES', datetime(2020, 1, 3), 12, "AUD", -14, Amount(0, "AUD"), 'Test'))
+        trades.append(Trade("BHP", 'FUTURES', datetime(2020, 1, 4), 13, "AUD", -12, Amount(0, "AUD"), 'Test'))
+        trades.append(Trade("BHP", 'FUTURES', datetime(2020, 1, 5), 14, "AUD", 10, Amount(0, "AUD"), 'Test'))
+        random.shuffle(trades)
+        self._assert_same_matches(trades)
+        self._assert_same_matches(
+            [Trade("BHP", 'FUTURES', datetime(2020, 1, 1), 10, "AUD", -32, Amount(0, "AUD"), 'Test'),
+             Trade("BHP", 'FUTURES', datetime(2020, 2, 1), 20, "AUD", 16, Amount(0, "AUD"), 'Test'),
+             Trade("BHP", 'FUTURES', datetime(2020, 3, 1), 20, "AUD", 16, Amount(0, "AUD"), 'Test')])
+
+    def test_same_timestamp_fills(self) -> None:
+        fill_time = datetime(2020, 1, 1, 10, 30, 15)
+        trades: List[Trade] = [
+            Trade("BHP", 'FUTURES', fill_time, 10, "AUD", 10, Amount(0, "AUD"), 'Test'),
+            Trade("BHP", 'FUTURES', fill_time, 11, "AUD", 10, Amount(0, "AUD"), 'Test'),
+            Trade("BHP", 'FUTURES', fill_time, 12, "AUD", 10, Amount(0, "AUD"), 'Test'),
+            Trade("BHP", 'FUTURES', datetime(2020, 1, 2), 13, "AUD", -25, Amount(0, "AUD"), 'Test')]
+        for inventory in [FirstInFirstOutInventory[Trade](), QueuedFirstInFirstOutInventory[Trade]()]:
+            matched_trades: List[MatchedInventory[Trade]] = inventory.match_trades(trades)
+            # Fills sharing a timestamp are kept as separate lots and closed in input order.
+            self.assertEqual([(m.buy_trade.price, m.quantity) for m in matched_trades], [(10, 10), (11, 10), (12, 5)])
+        self._assert_same_matches(trades)
+
+    def test_random_profiles(self) -> None:
+        for seed in range(20):
+            self._assert_same_matches(self._random_trades(seed, 200, False))
+            self._assert_same_matches(self._random_trades(seed, 200, True))
+
+    def test_iter_match_trades_streams(self) -> None:
+        trades = sorted(_random_translated_trades(7, 200), key=_get_date)
+        inventory = QueuedFirstInFirstOutInventory[TranslatedTrade]()
+        matches = inventory.iter_match_trades(iter(trades))
+        first_match = next(matches)
+        self.assertEqual(_match_values([first_match] + list(matches)), _match_values(inventory.match_trades(trades)))
+
+    def test_iter_match_trades_requires_date_order(self) -> None:
+        trades = sorted(_random_translated_trades(7, 20), key=_get_date)
+        for inventory in (FirstInFirstOutInventory[TranslatedTrade](), QueuedFirstInFirstOutInventory[TranslatedTrade]()):
+            with self.assertRaises(ValueError):
+                list(inventory.iter_match_trades(list(reversed(trades))))
+
+
+# The lot selection core with FIFO books, which must match exactly as the FIFO engines do.
+class _FirstInFirstOutLotSelectionInventory(LotSelectionInventory[T]):
+    def _new_book(self, asset_code: str) -> LotBook[T]:
+        return FirstInFirstOutLotBook[T]()
+
+
+class LotSelectionInventoryTests(TestCase):
+    def _trades(self, asset_category: str = 'STK') -> List[TranslatedTrade]:
+        def trade(day: int, price: float, quantity: float) -> TranslatedTrade:
+            return TranslatedTrade(Trade("BHP", asset_category, datetime(2020, 1, day), price, "AUD", quantity,
+                                         Amount(0, "AUD"), 'Test'), price, 1, 0, 'AUD')
+        return [trade(1, 10, 5), trade(2, 30, 5), trade(3, 20, 5), trade(4, 25, -8)]
+
+    def _closed_lots(self, inventory: InventoryAccountant[TranslatedTrade],
+                     trades: List[TranslatedTrade]) -> List[Tuple[float, float]]:
+        return [(m.buy_trade.price, m.quantity) for m in inventory.match_trades(trades)]
+
+    def test_fifo_books_match_queued_fifo(self) -> None:
+        for seed in range(10):
+            trades = _random_translated_trades(seed, 300)
+            expected_state = InventoryState[TranslatedTrade]()
+            expected = QueuedFirstInFirstOutInventory[TranslatedTrade]().match_trades(trades, expected_state)
+            state = InventoryState[TranslatedTrade]()
+            actual = _FirstInFirstOutLotSelectionInventory[TranslatedTrade]().match_trades(trades, state)
+            self.assertEqual(_match_values(actual), _match_values(expected))
+            self.assertEqual(dict(state.current_balance), dict(expected_state.current_balance))
+            self.assertEqual({asset_code: [(_trade_values(lot.trade), lot.remaining_quantity) for lot in lots]
+                              for asset_code, lots in state.open_lots.items()},
+                             {asset_code: [(_trade_values(lot.trade), lot.remaining_quantity) for lot in lots]
+                              for asset_code, lots in expected_state.open_lots.items()})
+
+    def test_last_in_first_out(self) -> None:
+        self.assertEqual(self._closed_lots(LastInFirstOutInventory[TranslatedTrade](), self._trades()),
+                         [(20, 5), (30, 3)])
+
+    def test_highest_in_first_out(self) -> None:
+        self.assertEqual(self._closed_lots(HighestInFirstOutInventory[TranslatedTrade](), self._trades()),
+                         [(30, 5), (20, 3)])
+
+    def test_highest_in_first_out_short(self) -> None:
+        trades = [TranslatedTrade(Trade("BHP", 'STK', trade.date, trade.price, "AUD", -trade.quantity,
+                                        Amount(0, "AUD"), 'Test'), trade.price, 1, 0, 'AUD')
+                  for trade in self._trades()]
+        self.assertEqual(self._closed_lots(HighestInFirstOutInventory[TranslatedTrade](), trades), [(30, 5), (20, 3)])
+
+    def test_specific_identification(self) -> None:
+        selections = {("BHP", datetime(2020, 1, 4)): [datetime(2020, 1, 3)]}
+        self.assertEqual(self._closed_lots(SpecificIdentificationInventory[TranslatedTrade](selections),
+                                           self._trades()),
+                         [(20, 5), (10, 3)])
+
+    def test_forex_is_first_in_first_out(self) -> None:
+        for inventory in (LastInFirstOutInventory[TranslatedTrade](), HighestInFirstOutInventory[TranslatedTrade]()):
+            self.assertEqual(self._closed_lots(inventory, self._trades('FOREX')), [(10, 5), (30, 3)])
+
+    def test_resume_matches_full_replay(self) -> None:
+        trades = sorted(_random_translated_trades(5, 300), key=_get_date)
+        as_of = trades[150].date
+        inventory = HighestInFirstOutInventory[TranslatedTrade]()
+        expected = inventory.match_trades(trades)
+        state = InventoryState[TranslatedTrade]()
+        actual = inventory.match_trades([trade for trade in trades if trade.date <= as_of], state)
+        actual += inventory.match_trades([trade for trade in trades if trade.date > as_of], state)
+        self.assertEqual(_match_values(actual), _match_values(expected))
+
+    def test_fx_accountant_must_be_fifo(self) -> None:
+        with self.assertRaises(ValueError):
+            # Not a FirstInFirstOutInventory, which the annotation already rules out; this covers the runtime check.
+            ForeignCurrencyProceedsCalculator(LastInFirstOutInventory[TranslatedTrade](),
+                                              LastInFirstOutInventory[TranslatedTrade]())  # type: ignore[arg-type]
+
+
+def _get_date(trade: Trade) -> datetime:
+    return trade.date
+
+
+def _random_translated_trades(seed: int, number_of_trades: int) -> List[TranslatedTrade]:
+    rng = random.Random(seed)
+    trades: List[TranslatedTrade] = []
+    for i in range(number_of_trades):
+        date = datetime(2019, 1, 1) + timedelta(hours=7 * (i // 2))
+        rate = round(rng.uniform(1.3, 1.5), 4)
+        quantity: float = rng.choice([-1, 1]) * rng.randint(1, 5)
+        kind = rng.random()
+        if kind < 0.4:
+            price = round(rng.uniform(2900, 3100), 2)
+            commission = -round(rng.uniform(0, 3), 2)
+            trade = Trade("ES", 'FUTURES', date, price, "USD", quantity, Amount(commission, "USD"), 'Test')
+            trades.append(TranslatedTrade(trade, price * rate, rate, commission * rate, 'AUD'))
+        elif kind < 0.7:
+            price = round(rng.uniform(30, 40), 2)
+            trade = Trade("BHP", 'FUTURES', date, price, "AUD", quantity, Amount(-1, "AUD"), 'Test')
+            trades.append(TranslatedTrade(trade, price, 1, -1, 'AUD'))
+        else:
+            trade = Trade("USD.AUD", 'FOREX', date, rate, "AUD", quantity * 1000, Amount(-2, "AUD"), 'Test')
+            trades.append(TranslatedTrade(trade, rate, 1, -2, 'AUD'))
+    rng.shuffle(trades)
+    return trades
+
+
+def _match_values(matched_trades: List[MatchedInventory[TranslatedTrade]]) -> List[Tuple[object, ...]]:
+    return [(m.buy_trade.asset_code, m.buy_trade.date, m.buy_trade.quantity, m.buy_trade.translated_price,
+             m.buy_trade.source, m.sell_trade.date, m.sell_trade.quantity, m.sell_trade.translated_price,
+             m.sell_trade.source, m.quantity) for m in matched_trades]
+
+
+class ForeignCurrencyProceedsCalculatorTests(TestCase):
+    def test_single_pass_matches_two_passes(self) -> None:
+        for seed in range(10):
+            trades: List[TranslatedTrade] = _random_translated_trades(seed, 300)
+            calculator = ForeignCurrencyProceedsCalculator(QueuedFirstInFirstOutInventory[TranslatedTrade]())
+            expected_trades: List[TranslatedTrade] = calculator.calculate_proceeds(trades)
+            expected_matches = QueuedFirstInFirstOutInventory[TranslatedTrade]().match_trades(expected_trades)
+            actual_trades, actual_matches = calculator.calculate_proceeds_and_matches(trades)
+            self.assertEqual([(t.asset_code, t.date, t.quantity, t.price, t.source) for t in actual_trades],
+                             [(t.asset_code, t.date, t.quantity, t.price, t.source) for t in expected_trades])
+            self.assertGreater(len(expected_matches), 0)
+            self.assertEqual(_match_values(actual_matches), _match_values(expected_matches))
+
+    def test_proxy_trades_in_stable_sort_order(self) -> None:
+        for seed in range(5):
+            trades = _random_translated_trades(seed, 300)
+            calculator = ForeignCurrencyProceedsCalculator(QueuedFirstInFirstOutInventory[TranslatedTrade]())
+            proxy_trades: List[TranslatedTrade] = []
+            for matched_trade in QueuedFirstInFirstOutInventory[TranslatedTrade]().match_trades(trades):
+                proxy_trades.extend(calculator._proxy_trades(matched_trade))
+            expected = sorted(list(trades) + proxy_trades, key=_get_date)
+            actual = calculator.calculate_proceeds(trades)
+            self.assertEqual([_trade_values(trade) for trade in actual], [_trade_values(trade) for trade in expected])
+            self.assertTrue(all(a is e for a, e in zip(actual, expected) if e.source == 'Test'))
+
+    def test_net_commissions(self) -> None:
+        trades = _random_translated_trades(3, 300)
+        calculator = ForeignCurrencyProceedsCalculator(QueuedFirstInFirstOutInventory[TranslatedTrade]())
+        netting_calculator = ForeignCurrencyProceedsCalculator(QueuedFirstInFirstOutInventory[TranslatedTrade](),
+                                                               net_commissions=True)
+        commissions = [t for t in calculator.calculate_proceeds(trades) if t.source == 'COMMISSION']
+        netted_trades, matched_trades = netting_calculator.calculate_proceeds_and_matches(trades)
+        netted = [t for t in netted_trades if t.source == 'COMMISSION']
+        self.assertLess(len(netted), len(commissions))
+        self.assertEqual(len({(t.asset_code, t.date.date()) for t in netted}), len(netted))
+        self.assertAlmostEqual(sum(t.quantity for t in netted), sum(t.quantity for t in commissions))
+        self.assertAlmostEqual(sum(t.quantity * t.translated_price for t in netted),
+                               sum(t.quantity * t.translated_price for t in commissions))
+        self.assertEqual([t.date for t in netted_trades], sorted(t.date for t in netted_trades))
+        self.assertEqual(_match_values(matched_trades),
+                         _match_values(QueuedFirstInFirstOutInventory[TranslatedTrade]().match_trades(netted_trades)))
+
+    def test_net_commissions_to_zero(self) -> None:
+        date = datetime(2019, 5, 1, 10)
+        proceeds = ProxyTrade('USD.AUD', date, 1.4, 100, 'SALE_PROCEEDS', 1.4)
+        netted = _net_commissions([ProxyTrade('USD.AUD', date, 1.4, -2, 'COMMISSION', 1.4),
+                                   proceeds,
+                                   ProxyTrade('USD.AUD', date + timedelta(hours=1), 1.5, 2, 'COMMISSION', 1.5)])
+        self.assertEqual(netted, [proceeds])
+
+
+class ScenarioTests(TestCase):
+    def test_parse(self) -> None:
+        scenario = Scenario.parse('hifo:-5000', -10)
+        self.assertEqual((scenario.engine, scenario.existing_capital_losses), ('hifo', -5000))
+        self.assertEqual(Scenario.parse('lifo', -10).existing_capital_losses, -10)
+
+    def test_results_match_single_runs(self) -> None:
+        trades = _random_translated_trades(4, 300)
+        scenarios = [Scenario.parse(text, 0) for text in ['fifo', 'fifo:-500', 'lifo:-500', 'hifo']]
+        results = run_scenarios(trades, scenarios, jobs=2)
+        self.assertEqual([result.scenario.name for result in results], ['fifo', 'fifo:-500', 'lifo:-500', 'hifo'])
+        self.assertEqual([(r.number_of_matches, r.taxable_gains, r.carried_capital_losses) for r in results],
+                         [(r.number_of_matches, r.taxable_gains, r.carried_capital_losses)
+                          for r in run_scenarios(trades, scenarios, jobs=1)])
+
+        _, matched_trades = ForeignCurrencyProceedsCalculator(
+            QueuedFirstInFirstOutInventory[TranslatedTrade]()).calculate_proceeds_and_matches(trades)
+        aggregator = CapitalGainsTaxAggregator(DiscountCapitalGainsTaxMethod())
+        gains = aggregator.calculate(-500, matched_trades)
+        self.assertEqual(results[1].number_of_matches, len(gains))
+        taxable_gains: float = sum(gain.taxable_gain for gain in gains)
+        self.assertEqual(results[1].taxable_gains, taxable_gains)
+        self.assertEqual(results[1].carried_capital_losses, aggregator.carried_capital_losses)
+        self.assertEqual(len(format_scenario_table(results).splitlines()), 5)
+
+
+class InstrumentationTests(TestCase):
+    def tearDown(self) -> None:
+        instrumentation.disable()
+
+    def test_disabled_records_nothing(self) -> None:
+        with instrumentation.stage('stage'):
+            instrumentation.count('counter')
+        self.assertIsNone(instrumentation.recorder())
+
+    def test_stages_and_counters(self) -> None:
+        recorder = instrumentation.enable(trace_memory=True)
+        with instrumentation.stage('outer'):
+            with instrumentation.stage('inner'):
+                allocation = bytearray(1 << 20)
+                del allocation
+        with instrumentation.stage('outer'):
+            pass
+        self.assertEqual([(name, timing.runs) for name, timing in recorder.stages.items()], [('outer', 2), ('inner', 1)])
+        self.assertGreaterEqual(recorder.stages['inner'].peak_bytes, 1 << 20)
+        self.assertGreaterEqual(recorder.stages['outer'].peak_bytes, 1 << 20)
+
+        trades = list(InteractiveBrokersReadWriter().iter_trades('./test_data/trades.csv'))
+        self.assertEqual((recorder.counters['rows_parsed'], recorder.counters['rows_skipped']), (len(trades), 7))
+        translated = _random_translated_trades(2, 200)
+        _, matches = ForeignCurrencyProceedsCalculator(
+            QueuedFirstInFirstOutInventory[TranslatedTrade]()).calculate_proceeds_and_matches(translated)
+        self.assertEqual(recorder.counters['matches'], len(matches))
+        self.assertGreater(recorder.counters['proxy_trades_sale_proceeds'], 0)
+        self.assertGreater(recorder.counters['proxy_trades_commission'], 0)
+        self.assertGreater(recorder.counters['unmatched_lots'], 0)
+        report = recorder.report()
+        self.assertEqual(report['counters'], recorder.counters)
+        self.assertEqual(list(report['stages']), ['outer', 'inner'])
+
+    def test_untraced_by_default(self) -> None:
+        recorder = instrumentation.enable()
+        self.assertFalse(tracemalloc.is_tracing())
+        with instrumentation.stage('stage'):
+            allocation = bytearray(1 << 20)
+            del allocation
+        self.assertEqual(recorder.stages['stage'].runs, 1)
+        self.assertEqual(recorder.stages['stage'].peak_bytes, 0)
+        report = recorder.report()
+        self.assertNotIn('peak_bytes', cast(Dict[str, object], report['stages']['stage']))
+        if instrumentation._HAS_RESOURCE:
+            self.assertIsInstance(report['process']['peak_rss_bytes'], int)
+
+
+# Random trades whose quantities have up to four decimal places, as statements give them.
+def _fractional_translated_trades(seed: int, number_of_trades: int) -> List[TranslatedTrade]:
+    rng = random.Random(seed)
+    trades: List[TranslatedTrade] = []
+    for trade in _random_translated_trades(seed, number_of_trades):
+        quantity = round(trade.quantity * rng.uniform(0.01, 3), 4) or trade.quantity
+        trades.append(TranslatedTrade(Trade(trade.asset_code, trade.asset_category, trade.date, trade.price,
+                                            trade.currency, quantity, trade.commission, trade.source),
+                                      trade.translated_price, trade.exchange_rate, trade.translated_commission,
+                                      trade.translated_currency))
+    return trades
+
+
+class FixedPointTests(TestCase):
+    def test_rounding(self) -> None:
+        self.assertEqual([div_round(n, 2) for n in (5, 7, -5, -7)], [2, 4, -2, -4])
+        self.assertEqual(div_round(1, -3), 0)
+        self.assertEqual(to_micros(0.1), 100000)
+        self.assertEqual(parse_micros('31,944'), 31944000000)
+        self.assertEqual(parse_micros('-29.86525478'), -29865255)
+        self.assertEqual(parse_micros('0.0000005'), 0)
+        self.assertEqual(from_micros(100000), 0.1)
+
+    def test_reader(self) -> None:
+        float_trades = list(InteractiveBrokersReadWriter().iter_trades('./test_data/trades.csv'))
+        fixed_trades = list(InteractiveBrokersReadWriter(fixed_point=True).iter_trades('./test_data/trades.csv'))
+        self.assertEqual([trade.quantity for trade in fixed_trades], [-22371.9804, -29.865255, -0.699993])
+        for float_trade, fixed_trade in zip(float_trades, fixed_trades):
+            self.assertEqual(fixed_trade.price, from_micros(to_micros(float_trade.price)))
+
+    def test_matches_float_fifo(self) -> None:
+        for seed in range(10):
+            for trades in (_random_translated_trades(seed, 300), _fractional_translated_trades(seed, 300)):
+                expected_state = InventoryState[TranslatedTrade]()
+                expected = QueuedFirstInFirstOutInventory[TranslatedTrade]().match_trades(trades, expected_state)
+                state = InventoryState[TranslatedTrade]()
+                actual = FixedPointFirstInFirstOutInventory[TranslatedTrade]().match_trades(trades, state)
+                self.assertEqual([(m.buy_trade, m.sell_trade) for m in actual],
+                                 [(m.buy_trade, m.sell_trade) for m in expected])
+                for actual_match, expected_match in zip(actual, expected):
+                    self.assertAlmostEqual(actual_match.quantity, expected_match.quantity, places=6)
+                self.assertEqual({code: [lot.trade for lot in lots] for code, lots in state.open_lots.items()},
+                                 {code: [lot.trade for lot in lots] for code, lots in expected_state.open_lots.items()})
+
+    def test_lots_close_exactly(self) -> None:
+        rng = random.Random(1)
+        quantities = [round(rng.uniform(0, 1000), 4) for _ in range(500)]
+        trades = [TranslatedTrade(Trade('USD.AUD', 'FOREX', datetime(2020, 1, 1) + timedelta(minutes=i), 1.4, 'AUD',
+                                        quantity, Amount(0, 'AUD'), 'Test'), 1.4, 1, 0, 'AUD')
+                  for i, quantity in enumerate(quantities)]
+        total = from_micros(sum(to_micros(quantity) for quantity in quantities))
+        trades.append(TranslatedTrade(Trade('USD.AUD', 'FOREX', datetime(2020, 2, 1), 1.5, 'AUD', -total,
+                                            Amount(0, 'AUD'), 'Test'), 1.5, 1, 0, 'AUD'))
+        state = InventoryState[TranslatedTrade]()
+        matches = FixedPointFirstInFirstOutInventory[TranslatedTrade]().match_trades(trades, state)
+        self.assertEqual(len(matches), 500)
+        self.assertEqual(state.open_lots, {})
+        self.assertEqual(state.current_balance['USD.AUD'], 0)
+
+    def test_resume_matches_full_replay(self) -> None:
+        trades = sorted(_fractional_translated_trades(5, 300), key=_get_date)
+        as_of = trades[150].date
+        inventory = FixedPointFirstInFirstOutInventory[TranslatedTrade]()
+        expected = inventory.match_trades(trades)
+        state = InventoryState[TranslatedTrade]()
+        actual = inventory.match_trades([trade for trade in trades if trade.date <= as_of], state)
+        actual += inventory.match_trades([trade for trade in trades if trade.date > as_of], state)
+        self.assertEqual(_match_values(actual), _match_values(expected))
+
+    def test_tax_method_matches_float(self) -> None:
+        for seed in range(10):
+            trades = _fractional_translated_trades(seed, 300)
+            matches = FixedPointFirstInFirstOutInventory[TranslatedTrade]().match_trades(trades)
+            expected = CapitalGainsTaxAggregator(DiscountCapitalGainsTaxMethod()).calculate(-100, matches)
+            actual = CapitalGainsTaxAggregator(FixedPointDiscountCapitalGainsTaxMethod()).calculate(-100, matches)
+            for actual_gain, expected_gain in zip(actual, expected):
+                self.assertAlmostEqual(actual_gain.taxable_gain, expected_gain.taxable_gain, delta=1e-5)
+                self.assertAlmostEqual(actual_gain.carried_capital_losses, expected_gain.carried_capital_losses,
+                                       delta=1e-5)
+                self.assertAlmostEqual(actual_gain.buy_commission, expected_gain.buy_commission, delta=1e-6)
+                self.assertAlmostEqual(actual_gain.sell_commission, expected_gain.sell_commission, delta=1e-6)
+                self.assertEqual(actual_gain.taxable_gain == 0, expected_gain.taxable_gain == 0)
+
+
+class ShardedMatchingTests(TestCase):
+    def _engines(self) -> List[InventoryAccountant[TranslatedTrade]]:
+        return [QueuedFirstInFirstOutInventory[TranslatedTrade](), FirstInFirstOutInventory[TranslatedTrade](),
+                HighestInFirstOutInventory[TranslatedTrade](), FixedPointFirstInFirstOutInventory[TranslatedTrade]()]
+
+    def test_matches_single_process(self) -> None:
+        trades = _random_translated_trades(6, 400)
+        for inventory in self._engines():
+            expected = inventory.match_trades(trades)
+            for jobs in (2, 3, 8):
+                actual = ShardedInventoryAccountant(inventory, jobs).match_trades(trades)
+                self.assertEqual([(m.buy_trade, m.sell_trade, m.quantity) for m in actual],
+                                 [(m.buy_trade, m.sell_trade, m.quantity) for m in expected])
+                self.assertTrue(all(a.sell_trade is e.sell_trade for a, e in zip(actual, expected)))
+
+    def test_resume_matches_single_process(self) -> None:
+        trades = sorted(_random_translated_trades(7, 400), key=_get_date)
+        earlier = trades[:200]
+        later = trades[200:]
+        for inventory in self._engines():
+            expected_state = InventoryState[TranslatedTrade]()
+            expected = inventory.match_trades(earlier, expected_state)
+            expected += inventory.match_trades(later, expected_state)
+            sharded = ShardedInventoryAccountant(inventory, 3)
+            state = InventoryState[TranslatedTrade]()
+            actual = sharded.match_trades(earlier, state)
+            actual += sharded.match_trades(later, state)
+            self.assertEqual(_match_values(actual), _match_values(expected))
+            self.assertEqual(list(state.current_balance.items()), list(expected_state.current_balance.items()))
+            self.assertEqual({code: [(lot.trade, lot.remaining_quantity) for lot in lots]
+                              for code, lots in state.open_lots.items()},
+                             {code: [(lot.trade, lot.remaining_quantity) for lot in lots]
+                              for code, lots in expected_state.open_lots.items()})
+            self.assertEqual(list(state.open_lots), list(expected_state.open_lots))
+
+    def test_proceeds_and_gains_match_single_process(self) -> None:
+        trades = _random_translated_trades(8, 400)
+        _, expected = ForeignCurrencyProceedsCalculator(
+            QueuedFirstInFirstOutInventory[TranslatedTrade]()).calculate_proceeds_and_matches(trades)
+        _, actual = ForeignCurrencyProceedsCalculator(ShardedInventoryAccountant(
+            QueuedFirstInFirstOutInventory[TranslatedTrade](), 2)).calculate_proceeds_and_matches(trades)
+        self.assertEqual(_match_values(actual), _match_values(expected))
+        self.assertEqual(
+            [gain.taxable_gain for gain in CapitalGainsTaxAggregator(DiscountCapitalGainsTaxMethod())
+             .calculate(-100, actual)],
+            [gain.taxable_gain for gain in CapitalGainsTaxAggregator(DiscountCapitalGainsTaxMethod())
+             .calculate(-100, expected)])
+
+    def test_requires_date_order(self) -> None:
+        trades = sorted(_random_translated_trades(9, 50), key=_get_date)
+        trades.reverse()
+        with self.assertRaises(ValueError):
+            list(ShardedInventoryAccountant(QueuedFirstInFirstOutInventory[TranslatedTrade](), 2)
+                 .iter_match_trades(trades))
+
+
+class BalanceIndexTests(TestCase):
+    def test_balance_matches_running_sum(self) -> None:
+        trades = _random_translated_trades(10, 300)
+        index = BalanceIndex(trades, {'ES': 2, 'AUD.JPY': -5})
+        dates = sorted({trade.date for trade in trades})
+        queries = [dates[0] - timedelta(days=1), dates[-1] + timedelta(days=1)] + dates[::7] \
+            + [date + timedelta(minutes=1) for date in dates[::11]]
+        for asset_code in ['ES', 'BHP', 'USD.AUD', 'AUD.JPY']:
+            opening = {'ES': 2, 'AUD.JPY': -5}.get(asset_code, 0)
+            for date in queries:
+                expected = opening + sum(trade.quantity for trade in trades
+                                         if trade.asset_code == asset_code and trade.date <= date)
+                self.assertAlmostEqual(index.get_balance(asset_code, date), expected, places=6)
+            self.assertEqual(list(index.get_balances(asset_code, queries)),
+                             [index.get_balance(asset_code, date) for date in queries])
+        self.assertEqual(index.get_balance('SPI', dates[-1]), 0)
+        self.assertEqual(list(index.get_balances('SPI', queries)), [0] * len(queries))
+        self.assertEqual(index.get_final_balance('AUD.JPY'), -5)
+
+    def test_open_lots_report(self) -> None:
+        trades = _random_translated_trades(11, 300)
+        state = InventoryState[TranslatedTrade]()
+        QueuedFirstInFirstOutInventory[TranslatedTrade]().match_trades(sorted(trades, key=_get_date), state)
+        output = io.StringIO()
+        write_open_lots_report(output, state, BalanceIndex(trades))
+        lines = output.getvalue().splitlines()
+        number_of_lots: int = sum(len(lots) for lots in state.open_lots.values())
+        self.assertEqual(len(lines), number_of_lots)
+        self.assertTrue(all(line.startswith('unmatched inventory: ') for line in lines))
+
+        asset_code = next(iter(state.open_lots))
+        state.open_lots[asset_code][0].remaining_quantity += 1
+        output = io.StringIO()
+        write_open_lots_report(output, state, BalanceIndex(trades))
+        self.assertEqual([line for line in output.getvalue().splitlines() if line.startswith('balance mismatch')],
+                         ['balance mismatch: ' + asset_code + ' open lots '
+                          + str(sum(lot.remaining_quantity for lot in state.open_lots[asset_code])) + ', trades '
+                          + str(BalanceIndex(trades).get_final_balance(asset_code))])
+
+
+class QueryServiceTests(TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.directory)
+
+    # Forex statement of (date, quantity, price) orders, after any ES futures orders, whose commissions are in USD.
+    def _write_statement(self,
+                         name: str,
+                         orders: List[Tuple[str, float, float]],
+                         futures_orders: Sequence[Tuple[str, float, float]] = ()) -> str:
+        file_path = os.path.join(self.directory, name)
+        with open(file_path, 'w') as file:
+            if len(futures_orders) > 0:
+                file.write('Trades,Header,DataDiscriminator,Asset Category,Currency,Account,Symbol,Date/Time,Exchange,'
+                           'Quantity,T. Price,Notional Value,Comm/Fee,Code\n')
+            for date, quantity, price in futures_orders:
+                file.write('Trades,Data,Order,Futures,USD,U111111,ES,"' + date + '",-,' + str(quantity) + ','
+                           + str(price) + ',' + str(-quantity * price * 50) + ',' + str(-2.1 * abs(quantity)) + ',O\n')
+            file.write('Trades,Header,DataDiscriminator,Asset Category,Currency,Account,Symbol,Date/Time,Exchange,'
+                       'Quantity,T. Price,Proceeds,Comm in AUD,Code\n')
+            for date, quantity, price in orders:
+                file.write('Trades,Data,Order,Forex,USD,U111111,AUD.USD,"' + date + '",-,' + str(quantity) + ','
+                           + str(price) + ',' + str(-quantity * price) + ',-2,\n')
+        return file_path
+
+    def _statements(self) -> List[str]:
+        return [self._write_statement('a.csv', [('2019-07-01, 10:00:00', 10000, 0.70),
+                                                ('2019-09-02, 10:00:00', -4000, 0.68),
+                                                ('2020-03-02, 10:00:00', -3000, 0.62)]),
+                self._write_statement('b.csv', [('2020-08-03, 10:00:00', -5000, 0.72),
+                                                ('2020-09-01, 10:00:00', 2000, 0.73),
+                                                ('2020-10-01, 10:00:00', 1000, 0.71)])]
+
+    def _answers(self, pipeline: WarmPipeline) -> List[object]:
+        index = pipeline.index
+        return [index.gains(2020), index.gains(2021), index.open_lots(),
+                index.carried_capital_losses(datetime(2020, 6, 30)), index.number_of_gains]
+
+    def test_financial_year(self) -> None:
+        self.assertEqual(financial_year(datetime(2019, 7, 1)), 2020)
+        self.assertEqual(financial_year(datetime(2020, 6, 30, 23, 59)), 2020)
+
+    def test_add_statement_matches_full_load(self) -> None:
+        first, second = self._statements()
+        expected = WarmPipeline('./test_data/f11.1-data.csv', -100)
+        expected.load([first, second])
+        self.assertGreater(expected.index.number_of_gains, 0)
+        self.assertNotEqual(expected.index.gains(2021)['matches'], 0)
+
+        pipeline = WarmPipeline('./test_data/f11.1-data.csv', -100)
+        pipeline.load([first])
+        self.assertTrue(pipeline.add_statement(second))
+        self.assertEqual(self._answers(pipeline), self._answers(expected))
+
+        # A changed statement re-matches everything.
+        self._write_statement('a.csv', [('2019-07-01, 10:00:00', 10000, 0.70), ('2019-09-02, 10:00:00', -8000, 0.68)])
+        self.assertFalse(pipeline.add_statement(first))
+        expected = WarmPipeline('./test_data/f11.1-data.csv', -100)
+        expected.load([first, second])
+        self.assertEqual(self._answers(pipeline), self._answers(expected))
+
+    # Closing a lot with a USD commission adds a commission trade dated when it opened, before the new statement, so
+    # the statement is matched on from the rematch point at its opening rather than from the open lots.
+    def test_add_statement_resumes_after_foreign_commissions(self) -> None:
+        first = self._write_statement('a.csv', [('2019-07-01, 10:00:00', 10000, 0.70),
+                                                ('2019-09-02, 10:00:00', -4000, 0.68)],
+                                      [('2019-07-02, 10:00:00', 2, 2950), ('2019-08-01, 10:00:00', -1, 2980)])
+        second = self._write_statement('b.csv', [('2020-08-03, 10:00:00', -3000, 0.72)],
+                                       [('2020-08-04, 10:00:00', -1, 3250)])
+        expected = WarmPipeline('./test_data/f11.1-data.csv', -100)
+        expected.load([first, second])
+        pipeline = WarmPipeline('./test_data/f11.1-data.csv', -100)
+        pipeline.load([first])
+        self.assertTrue(pipeline.add_statement(second))
+        self.assertEqual(self._answers(pipeline), self._answers(expected))
+        self.assertEqual(pipeline.index.open_lots(), expected.index.open_lots())
+
+    def test_queries_over_socket(self) -> None:
+        first, second = self._statements()
+        expected = WarmPipeline('./test_data/f11.1-data.csv')
+        expected.load([first, second])
+        pipeline = WarmPipeline('./test_data/f11.1-data.csv')
+        pipeline.load([first])
+
+        async def run() -> List[Dict[str, object]]:
+            service = QueryService(pipeline)
+            server = await service.start(0)
+            port: int = server.sockets[0].getsockname()[1]
+            client = await QueryClient.connect(port)
+            try:
+                return [await client.query({'query': 'add_statement', 'path': second}),
+                        await client.query({'query': 'gains', 'financial_year': 2021}),
+                        await client.query({'query': 'open_lots', 'asset_code': 'USD.AUD'}),
+                        await client.query({'query': 'carried_losses', 'date': '2020-06-30'}),
+                        await client.query({'query': 'tax_owed'}),
+                        await client.query({'query': 'gains'})]
+            finally:
+                await client.close()
+                server.close()
+                await server.wait_closed()
+                service.close()
+
+        added, gains, open_lots, losses, unknown, missing = asyncio.run(run())
+        self.assertEqual(added, {'ok': True, 'result': {'resumed': True, 'gains': expected.index.number_of_gains}})
+        self.assertEqual(gains['result'], json.loads(json.dumps(expected.index.gains(2021))))
+        self.assertEqual(open_lots['result'], json.loads(json.dumps(expected.index.open_lots('USD.AUD'))))
+        self.assertEqual(losses['result'], expected.index.carried_capital_losses(datetime(2020, 6, 30, 23, 59)))
+        self.assertFalse(unknown['ok'])
+        self.assertFalse(missing['ok'])
+
+
+class InventorySnapshotTests(TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self) -> None:
+        trades = _random_translated_trades(3, 100)
+        state = InventoryState[TranslatedTrade]()
+        QueuedFirstInFirstOutInventory[TranslatedTrade]().match_trades(trades, state)
+        path = os.path.join(self.directory, 'snapshot.json')
+        write_snapshot(path, InventorySnapshot(datetime(2019, 3, 1, 12), [ProcessedStatement('a.csv', 'abc')], state,
+                                               -12.5, -3.0))
+        snapshot = read_snapshot(path)
+        self.assertEqual(snapshot.as_of, datetime(2019, 3, 1, 12))
+        self.assertTrue(snapshot.is_processed(ProcessedStatement('renamed.csv', 'abc')))
+        self.assertEqual(snapshot.carried_capital_losses, -12.5)
+        self.assertEqual(snapshot.opening_capital_losses, -3.0)
+        self.assertEqual(dict(snapshot.inventory.current_balance), dict(state.current_balance))
+        self.assertEqual({asset_code: [(_trade_values(lot.trade), lot.remaining_quantity) for lot in lots]
+                          for asset_code, lots in snapshot.inventory.open_lots.items()},
+                         {asset_code: [(_trade_values(lot.trade), lot.remaining_quantity) for lot in lots]
+                          for asset_code, lots in state.open_lots.items()})
+
+    # Matching the first half, saving and reloading the snapshot, then matching the second half gives the same matches
+    # and open lots as matching everything in one go.
+    def test_resume_matches_full_replay(self) -> None:
+        for seed in range(5):
+            trades = sorted(_random_translated_trades(seed, 300), key=_get_date)
+            as_of = trades[150].date
+            earlier = [trade for trade in trades if trade.date <= as_of]
+            later = [trade for trade in trades if trade.date > as_of]
+            for inventory in (FirstInFirstOutInventory[TranslatedTrade](),
+                              QueuedFirstInFirstOutInventory[TranslatedTrade]()):
+                full_state = InventoryState[TranslatedTrade]()
+                expected = inventory.match_trades(trades, full_state)
+
+                state = InventoryState[TranslatedTrade]()
+                actual = inventory.match_trades(earlier, state)
+                path = os.path.join(self.directory, 'snapshot.json')
+                write_snapshot(path, InventorySnapshot(as_of, [], state, 0, 0))
+                resumed_state = read_snapshot(path).inventory
+                actual += inventory.match_trades(later, resumed_state)
+
+                self.assertEqual(_match_values(actual), _match_values(expected))
+                self.assertEqual({asset_code: [(_trade_values(lot.trade), lot.remaining_quantity) for lot in lots]
+                                  for asset_code, lots in resumed_state.open_lots.items()},
+                                 {asset_code: [(_trade_values(lot.trade), lot.remaining_quantity) for lot in lots]
+                                  for asset_code, lots in full_state.open_lots.items()})
+
+    # Proceeds and gains resumed from the rematch point of an earlier run, saved and reloaded, match a full replay. The
+    # ES trades have USD commissions, so closing a carried lot adds an FX commission trade dated before the snapshot.
+    def test_proceeds_resume_matches_full_replay(self) -> None:
+        rematch_dates: List[Optional[datetime]] = []
+        for seed in range(8):
+            for aud_commissions, net_commissions in ((False, False), (False, True), (True, False)):
+                trades = sorted(_random_translated_trades(seed, 300), key=_get_date)
+                if aud_commissions:
+                    trades = [_with_aud_commission(trade) for trade in trades]
+                as_of = trades[150].date
+                earlier = [trade for trade in trades if trade.date <= as_of]
+                later = [trade for trade in trades if trade.date > as_of]
+                calculator = ForeignCurrencyProceedsCalculator(QueuedFirstInFirstOutInventory[TranslatedTrade](),
+                                                               net_commissions=net_commissions)
+                full_state = InventoryState[TranslatedTrade]()
+                _, expected = calculator.calculate_proceeds_and_matches(trades, full_state)
+                expected_gains = [gain for gain in CapitalGainsTaxAggregator(DiscountCapitalGainsTaxMethod())
+                                  .calculate(-100, expected) if gain.matched_inventory.sell_trade.date > as_of]
+
+                state = InventoryState[TranslatedTrade]()
+                _, matches, rematch = calculator.calculate_from(RematchPoint(), earlier, state)
+                gains = CapitalGainsTaxAggregator(DiscountCapitalGainsTaxMethod()).calculate(-100, matches)
+                rematch_date = rematch.date
+                rematch_dates.append(rematch_date)
+                rematch_gains = gains if rematch_date is None \
+                    else [gain for gain in gains if gain.matched_inventory.sell_trade.date < rematch_date]
+                path = os.path.join(self.directory, 'snapshot.json')
+                write_snapshot(path, InventorySnapshot(as_of, [], state, gains[-1].carried_capital_losses, -100,
+                                                       rematch, rematch_gains[-1].carried_capital_losses
+                                                       if len(rematch_gains) > 0 else -100))
+                snapshot = read_snapshot(path)
+
+                resumed_state = InventoryState[TranslatedTrade]()
+                _, actual, _ = calculator.calculate_from(snapshot.rematch, later, resumed_state)
+                actual_gains = [gain for gain in CapitalGainsTaxAggregator(DiscountCapitalGainsTaxMethod())
+                                .calculate(snapshot.rematch_capital_losses, actual)
+                                if gain.matched_inventory.sell_trade.date > as_of]
+                self.assertEqual(_match_values([gain.matched_inventory for gain in actual_gains]),
+                                 _match_values([gain.matched_inventory for gain in expected_gains]))
+                for actual_gain, expected_gain in zip(actual_gains, expected_gains):
+                    self.assertAlmostEqual(actual_gain.carried_capital_losses, expected_gain.carried_capital_losses,
+                                           places=6)
+                self.assertEqual({asset_code: [(_trade_values(lot.trade), lot.remaining_quantity) for lot in lots]
+                                  for asset_code, lots in resumed_state.open_lots.items()},
+                                 {asset_code: [(_trade_values(lot.trade), lot.remaining_quantity) for lot in lots]
+                                  for asset_code, lots in full_state.open_lots.items()})
+        self.assertIn(None, rematch_dates)
+        self.assertTrue(any(date is not None for date in rematch_dates))
+
+
+def _with_aud_commission(trade: TranslatedTrade) -> TranslatedTrade:
+    return TranslatedTrade(Trade(trade.asset_code, trade.asset_category, trade.date, trade.price, trade.currency,
+                                 trade.quantity, Amount(trade.translated_commission, 'AUD'), trade.source),
+                           trade.translated_price, trade.exchange_rate, trade.translated_commission,
+                           trade.translated_currency)
+
+
+def _trade_values(trade: TranslatedTrade) -> Tuple[object, ...]:
+    return (trade.asset_code, trade.asset_category, trade.date, trade.price, trade.currency, trade.quantity,
+            trade.commission.value, trade.commission.currency, trade.source, trade.translated_price,
+            trade.exchange_rate, trade.translated_commission, trade.translated_currency)
+
+
 class CapitalGainsTaxTests(TestCase):
     def test_capital_gains(self) -> None:
         trade1 : TranslatedTrade = TranslatedTrade(Trade("BHP", 'FUTURES', datetime(2019, 1, 1), 10, "AUD", 12, Amount(0, "AUD"), 'Test'), 10, 1, 0, "AUD")
@@ -211,6 +1234,87 @@ class CapitalGainsTaxTests(TestCase):
         self.assertEqual(cgt_calculator.calculate_taxable_gain(0, inventory_not_discountable).taxable_gain, 0)
         self.assertEqual(cgt_calculator.calculate_taxable_gain(0, inventory_not_discountable).carried_capital_losses, -50)
 
+    def test_iter_calculate_matches_calculate(self) -> None:
+        trades = sorted(_random_translated_trades(11, 300), key=_get_date)
+        matches = QueuedFirstInFirstOutInventory[TranslatedTrade]().match_trades(trades)
+        expected = CapitalGainsTaxAggregator(DiscountCapitalGainsTaxMethod()).calculate(-100, matches)
+        aggregator = CapitalGainsTaxAggregator(DiscountCapitalGainsTaxMethod())
+        actual = list(aggregator.iter_calculate(-100, iter(matches)))
+        self.assertEqual([(g.taxable_gain, g.carried_capital_losses) for g in actual],
+                         [(g.taxable_gain, g.carried_capital_losses) for g in expected])
+        self.assertEqual(aggregator.carried_capital_losses, expected[-1].carried_capital_losses)
+
+    def test_batch_matches_scalar(self) -> None:
+        def gain_values(gains: List[CapitalGainsTax]) -> List[Tuple[object, ...]]:
+            return [(type(gain.taxable_gain), gain.taxable_gain, type(gain.carried_capital_losses),
+                     gain.carried_capital_losses, gain.buy_commission, gain.sell_commission) for gain in gains]
+
+        for seed in range(20):
+            rng = random.Random(seed)
+            matches: List[MatchedInventory[TranslatedTrade]] = []
+            for i in range(300):
+                category = rng.choice(['FOREX', 'FUTURES'])
+                buy_date = datetime(2019, 1, 1) + timedelta(days=rng.randint(0, 730), hours=rng.randint(0, 23))
+                sell_date = buy_date + timedelta(days=rng.randint(300, 430), hours=rng.randint(-30, 30))
+                buy_rate, sell_rate = rng.uniform(1.3, 1.5), rng.uniform(1.3, 1.5)
+                buy_price, sell_price = rng.uniform(90, 110), rng.uniform(90, 110)
+                if 100 <= i < 140:  # A long run of losses.
+                    sell_price = buy_price * 0.8
+                quantity = rng.randint(1, 10)
+                buy = TranslatedTrade(Trade('X', category, buy_date, buy_price, 'USD', quantity + rng.randint(0, 5),
+                                            Amount(-rng.uniform(0, 3), 'USD'), 'Test'),
+                                      buy_price * buy_rate, buy_rate, -rng.uniform(0, 4), 'AUD')
+                sell = TranslatedTrade(Trade('X', category, sell_date, sell_price, 'USD', -quantity,
+                                             Amount(rng.choice([0, -rng.uniform(0, 3)]), 'USD'), 'Test'),
+                                       sell_price * sell_rate, sell_rate, -rng.uniform(0, 4), 'AUD')
+                matches.append(MatchedInventory(buy, sell, quantity))
+            method = DiscountCapitalGainsTaxMethod()
+            for existing_capital_losses in (0, -50.5, -1e6):
+                expected: List[CapitalGainsTax] = []
+                carried_capital_losses: float = existing_capital_losses
+                for matched_inventory in matches:
+                    expected.append(method.calculate_taxable_gain(carried_capital_losses, matched_inventory))
+                    carried_capital_losses = expected[-1].carried_capital_losses
+                self.assertEqual(gain_values(method.calculate_taxable_gains(existing_capital_losses, matches)),
+                                 gain_values(expected))
+
+    def test_batch_rejects_zero_quantity_trade(self) -> None:
+        buy = TranslatedTrade(Trade("BHP", 'FUTURES', datetime(2019, 1, 2), 10, "AUD", 0, Amount(-1, "AUD"), 'Test'),
+                              10, 1, -1, "AUD")
+        sell = TranslatedTrade(Trade("BHP", 'FUTURES', datetime(2019, 2, 1), 11, "AUD", -5, Amount(-1, "AUD"), 'Test'),
+                               11, 1, -1, "AUD")
+        with self.assertRaisesRegex(ValueError, 'BHP on 2019-01-02'):
+            DiscountCapitalGainsTaxMethod().calculate_taxable_gains(0, [MatchedInventory(buy, sell, 0)])
+
+    def test_month_end_purchase(self) -> None:
+        buy = TranslatedTrade(Trade("BHP", 'FUTURES', datetime(2019, 1, 31, 10), 10, "AUD", 12, Amount(0, "AUD"), 'Test'), 10, 1, 0, "AUD")
+        early_sell = TranslatedTrade(Trade("BHP", 'FUTURES', datetime(2020, 1, 31, 23), 12, "AUD", -12, Amount(0, "AUD"), 'Test'), 12, 1, 0, "AUD")
+        sell = TranslatedTrade(Trade("BHP", 'FUTURES', datetime(2020, 2, 1), 12, "AUD", -12, Amount(0, "AUD"), 'Test'), 12, 1, 0, "AUD")
+        cgt_calculator: CapitalGainsTaxMethod = DiscountCapitalGainsTaxMethod()
+        self.assertEqual(cgt_calculator.calculate_taxable_gain(0, MatchedInventory(buy, early_sell, 1)).taxable_gain, 2.0)
+        self.assertEqual(cgt_calculator.calculate_taxable_gain(0, MatchedInventory(buy, sell, 1)).taxable_gain, 1.0)
+        self.assertEqual([gain.taxable_gain for gain in cgt_calculator.calculate_taxable_gains(
+            0, [MatchedInventory(buy, early_sell, 1), MatchedInventory(buy, sell, 1)])], [2.0, 1.0])
+
+
+class TaxCalendarTests(TestCase):
+    def test_discount_eligibility_date(self) -> None:
+        # Sally's example: bought 2 February, discount from 3 February the following year.
+        self.assertEqual(discount_eligibility_date(datetime(2019, 2, 2, 15, 30)), datetime(2020, 2, 3))
+        self.assertEqual(discount_eligibility_date(datetime(2019, 1, 31)), datetime(2020, 2, 1))
+        self.assertEqual(discount_eligibility_date(datetime(2019, 4, 30)), datetime(2020, 5, 1))
+        self.assertEqual(discount_eligibility_date(datetime(2019, 12, 31)), datetime(2021, 1, 1))
+        self.assertEqual(discount_eligibility_date(datetime(2019, 2, 28)), datetime(2020, 2, 29))
+        self.assertEqual(discount_eligibility_date(datetime(2020, 2, 28)), datetime(2021, 3, 1))
+        self.assertEqual(discount_eligibility_date(datetime(2020, 2, 29)), datetime(2021, 3, 1))
+
+    def test_matches_previous_rule_where_it_was_defined(self) -> None:
+        day = datetime(2015, 1, 1)
+        while day < datetime(2025, 1, 1):
+            if day.day + 1 <= calendar.monthrange(day.year + 1, day.month)[1]:
+                self.assertEqual(discount_eligibility_date(day), datetime(day.year + 1, day.month, day.day + 1))
+            day += timedelta(days=1)
+
 
 class IntegrationTests(TestCase):
     def test_run_test_file(self) -> None:
@@ -0,0 +1,140 @@
+from datetime import datetime
+from typing import Dict, Final, Iterable, Iterator, List, Optional, Sequence
+
+import numpy as np
+import numpy.typing as npt
+
+from model import Amount, Trade, TranslatedTrade
+
+
+# Dictionary-encoded string column: one int32 code per row plus the distinct values. Asset codes, currencies and
+# sources repeat on almost every row, so this is far smaller than a Python string per row.
+class CategoricalColumn:
+    def __init__(self, codes: npt.NDArray[np.int32], categories: List[str]):
+        self.codes: Final = codes
+        self.categories: Final = categories
+
+    @staticmethod
+    def from_values(values: Iterable[str]) -> 'CategoricalColumn':
+        positions: Dict[str, int] = dict()
+        codes: List[int] = [positions.setdefault(value, len(positions)) for value in values]
+        return CategoricalColumn(np.array(codes, dtype=np.int32), list(positions))
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    # Expands back to one string per row, as an object array.
+    def values(self) -> npt.NDArray[np.object_]:
+        return np.array(self.categories, dtype=object)[self.codes] if len(self.categories) > 0 \
+            else np.empty(len(self.codes), dtype=object)
+
+
+# Struct-of-arrays representation of a list of trades. Row i of every column belongs to the same trade. The
+# translated_* columns are only present once the table has been translated (see ForeignAssetTranslator.convert_table).
+class TradeTable:
+    def __init__(self,
+                 asset_code: CategoricalColumn,
+                 asset_category: CategoricalColumn,
+                 date: npt.NDArray[np.datetime64],
+                 price: npt.NDArray[np.float64],
+                 currency: CategoricalColumn,
+                 quantity: npt.NDArray[np.float64],
+                 commission: npt.NDArray[np.float64],
+                 commission_currency: CategoricalColumn,
+                 source: CategoricalColumn,
+                 translated_price: Optional[npt.NDArray[np.float64]] = None,
+                 exchange_rate: Optional[npt.NDArray[np.float64]] = None,
+                 translated_commission: Optional[npt.NDArray[np.float64]] = None,
+                 translated_currency: Optional[str] = None):
+        self.asset_code: Final = asset_code
+        self.asset_category: Final = asset_category
+        self.date: Final = date  # datetime64[us]
+        self.price: Final = price
+        self.currency: Final = currency
+        self.quantity: Final = quantity
+        self.commission: Final = commission
+        self.commission_currency: Final = commission_currency
+        self.source: Final = source
+        self.translated_price: Final = translated_price
+        self.exchange_rate: Final = exchange_rate
+        self.translated_commission: Final = translated_commission
+        self.translated_currency: Final = translated_currency
+
+    @staticmethod
+    def from_trades(trades: Sequence[Trade]) -> 'TradeTable':
+        translated = len(trades) > 0 and all(isinstance(trade, TranslatedTrade) for trade in trades)
+        translated_trades: List[TranslatedTrade] = [trade for trade in trades if isinstance(trade, TranslatedTrade)]
+        return TradeTable(CategoricalColumn.from_values(trade.asset_code for trade in trades),
+                          CategoricalColumn.from_values(trade.asset_category for trade in trades),
+                          np.array([trade.date for trade in trades], dtype='datetime64[us]'),
+                          np.array([trade.price for trade in trades], dtype=np.float64),
+                          CategoricalColumn.from_values(trade.currency for trade in trades),
+                          np.array([trade.quantity for trade in trades], dtype=np.float64),
+                          np.array([trade.commission.value for trade in trades], dtype=np.float64),
+                          CategoricalColumn.from_values(trade.commission.currency for trade in trades),
+                          CategoricalColumn.from_values(trade.source for trade in trades),
+                          np.array([trade.translated_price for trade in translated_trades], dtype=np.float64)
+                          if translated else None,
+                          np.array([trade.exchange_rate for trade in translated_trades], dtype=np.float64)
+                          if translated else None,
+                          np.array([trade.translated_commission for trade in translated_trades], dtype=np.float64)
+                          if translated else None,
+                          translated_trades[0].translated_currency if translated else None)
+
+    def __len__(self) -> int:
+        return len(self.price)
+
+    @property
+    def is_translated(self) -> bool:
+        return self.translated_price is not None
+
+    def with_translation(self,
+                         translated_price: npt.NDArray[np.float64],
+                         exchange_rate: npt.NDArray[np.float64],
+                         translated_commission: npt.NDArray[np.float64],
+                         translated_currency: str) -> 'TradeTable':
+        if len(translated_price) != len(self):
+            raise ValueError("Number of translated rows does not match the number of trades.")
+        return TradeTable(self.asset_code, self.asset_category, self.date, self.price, self.currency, self.quantity,
+                          self.commission, self.commission_currency, self.source,
+                          translated_price, exchange_rate, translated_commission, translated_currency)
+
+    # Builds Trade objects one row at a time, so consumers that only stream (e.g. writers) never hold them all.
+    def iter_trades(self) -> Iterator[Trade]:
+        for asset_code, asset_category, date, price, currency, quantity, commission, commission_currency, source \
+                in zip(self.asset_code.values().tolist(),
+                       self.asset_category.values().tolist(),
+                       self.date.astype(datetime).tolist(),
+                       self.price.tolist(),
+                       self.currency.values().tolist(),
+                       self.quantity.tolist(),
+                       self.commission.tolist(),
+                       self.commission_currency.values().tolist(),
+                       self.source.values().tolist()):
+            yield Trade(asset_code, asset_category, date, price, currency, quantity,
+                        Amount(commission, commission_currency), source)
+
+    def iter_translated_trades(self) -> Iterator[TranslatedTrade]:
+        if self.translated_price is None or self.exchange_rate is None or self.translated_commission is None \
+                or self.translated_currency is None:
+            raise ValueError("Trade table has not been translated.")
+        for trade, translated_price, exchange_rate, translated_commission in zip(self.iter_trades(),
+                                                                                 self.translated_price.tolist(),
+                                                                                 self.exchange_rate.tolist(),
+                                                                                 self.translated_commission.tolist()):
+            yield TranslatedTrade(trade, translated_price, exchange_rate, translated_commission,
+                                  self.translated_currency)
+
+    def to_trades(self) -> List[Trade]:
+        return list(self.iter_trades())
+
+    def to_translated_trades(self) -> List[TranslatedTrade]:
+        return list(self.iter_translated_trades())
+
+    # Total bytes held by the column arrays.
+    def nbytes(self) -> int:
+        arrays = (
+            self.asset_code.codes, self.asset_category.codes, self.date, self.price, self.currency.codes, self.quantity,
+            self.commission, self.commission_currency.codes, self.source.codes,
+            self.translated_price, self.exchange_rate, self.translated_commission)
+        return sum(array.nbytes for array in arrays if array is not None)